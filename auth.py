@@ -3,33 +3,57 @@ from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-import os
-from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 from auth_models import TokenData, UserInDB, RefreshToken
 from bson import ObjectId
 import database
 import secrets
-
-# Load environment variables
-load_dotenv("secret.env")
-
-SECRET_KEY = os.getenv("JWT_SECRET_KEY")
-if not SECRET_KEY:
-    raise Exception("JWT_SECRET_KEY environment variable is not set")
+from settings import get_settings
 
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 15
 REFRESH_TOKEN_EXPIRE_DAYS = 30
 
+PASSWORD_HASH_WORKERS = 4  # Threads doing bcrypt work, off the event loop
+PASSWORD_HASH_QUEUE_LIMIT = 64  # Max queued + running bcrypt jobs before requests are shed with 503
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+_password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+_password_jobs = 0  # Only touched from the event loop thread
+
+async def _run_password_work(fn, *args):
+    """
+    Run bcrypt work on the password thread pool so it does not block the event loop.
+    Raises 503 straight away when the pool's queue is full.
+    """
+    global _password_jobs
+    if _password_jobs >= PASSWORD_HASH_QUEUE_LIMIT:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many authentication requests, please try again shortly",
+            headers={"Retry-After": "1"},
+        )
+    _password_jobs += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_password_executor, fn, *args)
+    finally:
+        _password_jobs -= 1
+
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+async def verify_password_async(plain_password, hashed_password):
+    return await _run_password_work(verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password):
+    return await _run_password_work(get_password_hash, password)
+
 async def get_user(username: str):
     return await database.get_user(username)
 
@@ -37,7 +61,7 @@ async def authenticate_user(username: str, password: str):
     user = await get_user(username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await verify_password_async(password, user.hashed_password):
         return False
     return user
 
@@ -48,17 +72,18 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
     to_encode.update({"exp": expire, "type": "access"})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = jwt.encode(to_encode, get_settings().jwt_secret_key, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def create_refresh_token(user_id: str):
+async def create_refresh_token(user_id: str, username: str):
     expires_delta = timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
     expires_at = datetime.utcnow() + expires_delta
     token = secrets.token_urlsafe(32)
     
     refresh_token = RefreshToken(
         user_id=user_id,
-        token=token,
+        username=username,
+        token_hash=database.hash_refresh_token(token),
         expires_at=expires_at,
         blacklisted=False
     )
@@ -72,7 +97,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, get_settings().jwt_secret_key, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         token_type: str = payload.get("type")
         
@@ -89,23 +114,36 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
     except JWTError:
         raise credentials_exception
     
-    user = await get_user(username=token_data.username)
+    # The JWT is already verified, so the cached user record is good enough here. A user disabled
+    # through another process may still get through for up to USER_CACHE_TTL_SECONDS.
+    user = await database.get_user_cached(token_data.username)
     if user is None:
         raise credentials_exception
     return user
 
-async def verify_refresh_token(token: str):
-    stored_token = await database.get_refresh_token(token)
+async def rotate_refresh_token(token: str):
+    """
+    Exchange a refresh token for a new one. Returns the user and the new token,
+    or None if the old token is invalid or expired.
+    """
+    new_token = secrets.token_urlsafe(32)
+    expires_at = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    stored_token = await database.rotate_refresh_token(token, new_token, expires_at)
     if not stored_token:
         return None
-    
-    user = await database.users_collection.find_one({"_id": ObjectId(stored_token["user_id"])})
+
+    if stored_token.get("username"):
+        user = await database.get_user_cached(stored_token["username"])
+    else:
+        # Legacy tokens only know the user id
+        user = await database.users_collection.find_one({"_id": ObjectId(stored_token["user_id"])})
+        if user:
+            # Convert ObjectId to string before validation
+            user["_id"] = str(user["_id"])
+            user = UserInDB.model_validate(user)
     if not user:
         return None
-    
-    # Convert ObjectId to string before validation
-    user["_id"] = str(user["_id"])    
-    return UserInDB.model_validate(user)
+    return user, new_token
 
 async def get_current_active_user(current_user: UserInDB = Depends(get_current_user)):
     if current_user.disabled:
@@ -15,7 +15,8 @@ class TokenData(BaseModel):
 
 class RefreshToken(BaseModel):
     user_id: str
-    token: str
+    username: Optional[str] = None  # Lets a refresh find the user without another query
+    token_hash: str  # SHA-256 of the token; the token itself is never stored
     expires_at: datetime
     blacklisted: bool = False
     model_config = {"extra": "allow"}
@@ -8,8 +8,8 @@ from auth import (
     create_access_token,
     create_refresh_token,
     get_current_active_user,
-    get_password_hash,
-    verify_refresh_token
+    get_password_hash_async,
+    rotate_refresh_token
 )
 import database
 
@@ -28,7 +28,7 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     access_token = create_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
     )
-    refresh_token = await create_refresh_token(str(user.id))
+    refresh_token = await create_refresh_token(str(user.id), user.username)
     
     return {
         "access_token": access_token,
@@ -38,23 +38,20 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 
 @router.post("/refresh", response_model=Token)
 async def refresh_access_token(refresh_token: str):
-    user = await verify_refresh_token(refresh_token)
-    if not user:
+    rotated = await rotate_refresh_token(refresh_token)
+    if not rotated:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid or expired refresh token",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    user, new_refresh_token = rotated
     
-    # Create new tokens
+    # Create new access token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
     )
-    new_refresh_token = await create_refresh_token(str(user.id))
-    
-    # Blacklist the old refresh token
-    await database.blacklist_refresh_token(refresh_token)
     
     return {
         "access_token": access_token,
@@ -78,7 +75,7 @@ async def register_user(
     email: str | None = None,
     full_name: str | None = None
 ):
-    hashed_password = get_password_hash(password)
+    hashed_password = await get_password_hash_async(password)
     user = UserInDB(
         username=username,
         email=email,
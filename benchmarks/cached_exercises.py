@@ -0,0 +1,78 @@
+"""
+Latency of get_all_cached_exercises vs. cache size against a local mongod.
+
+Compares the old per-entry find_one resolution (1+N round trips) with the
+single $lookup aggregation. Run from the repo root:
+
+    MONGODB_URL=mongodb://localhost:27017 python -m benchmarks.cached_exercises
+"""
+import asyncio
+import time
+import uuid
+from datetime import datetime, timedelta
+from bson import ObjectId
+
+import database
+from db import exercises_collection, exercise_cache
+
+CACHE_SIZES = [1, 3, 10, 30, 100, 300]
+REPEATS = 20
+LANGUAGE = "cmn"
+
+async def get_all_cached_exercises_n_plus_one(language: str, user_id: str):
+    """The previous implementation, kept here as the baseline"""
+    cursor = exercise_cache.find(
+        {"language": language, "user_id": user_id, "used": False},
+        sort=[("created_at", 1)]
+    )
+    exercises = []
+    for doc in await cursor.to_list(length=None):
+        exercise = await exercises_collection.find_one({"_id": ObjectId(doc["exercise_id"])})
+        if exercise:
+            exercise["_id"] = str(exercise["_id"])
+            exercises.append(exercise)
+    return exercises
+
+async def seed(user_id: str, size: int):
+    exercises = [
+        {"type": "matching", "language": LANGUAGE, "data": {"pairs": {"你好": "hello"}}}
+        for _ in range(size)
+    ]
+    result = await exercises_collection.insert_many(exercises)
+    now = datetime.utcnow()
+    await exercise_cache.insert_many([
+        {
+            "exercise_id": str(exercise_id),
+            "language": LANGUAGE,
+            "user_id": user_id,
+            "created_at": now + timedelta(milliseconds=i),
+            "used": False
+        }
+        for i, exercise_id in enumerate(result.inserted_ids)
+    ])
+
+async def time_ms(fn, *args) -> float:
+    samples = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        await fn(*args)
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+async def main():
+    await database.connect_to_mongo()
+    print(f"{'cache size':>10} {'1+N (ms)':>10} {'$lookup (ms)':>13} {'speedup':>8}")
+    for size in CACHE_SIZES:
+        user_id = f"bench-{uuid.uuid4()}"
+        await seed(user_id, size)
+        try:
+            old = await time_ms(get_all_cached_exercises_n_plus_one, LANGUAGE, user_id)
+            new = await time_ms(database.get_all_cached_exercises, LANGUAGE, user_id)
+            print(f"{size:>10} {old:>10.2f} {new:>13.2f} {old / new:>7.1f}x")
+        finally:
+            await database.delete_exercise_cache(LANGUAGE, user_id)
+    await database.close_mongo_connection()
+
+if __name__ == "__main__":
+    asyncio.run(main())
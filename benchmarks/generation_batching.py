@@ -0,0 +1,36 @@
+"""
+Throughput of concurrent replenishers generating through the micro-batcher, with the
+deterministic fake backend, for several batch sizes (1 = no batching). Run from the repo root:
+
+    python -m benchmarks.generation_batching
+"""
+import asyncio
+import time
+import generation
+from generation import FakeGeneratorBackend, set_generator_backend
+
+REPLENISHERS = 200  # Concurrent users replenishing
+EXERCISES_PER_REPLENISHER = 3
+BATCH_SIZES = [1, 8, 32, 128]
+
+async def replenish(user: int):
+    await asyncio.gather(*(
+        generation.generate_exercise("cmn", f"token-{user}-{i}")
+        for i in range(EXERCISES_PER_REPLENISHER)
+    ))
+
+async def run(max_batch_size: int):
+    backend = FakeGeneratorBackend(latency_s=0.2, per_item_latency_s=0.002)
+    set_generator_backend(backend, max_batch_size=max_batch_size)
+    start = time.perf_counter()
+    await asyncio.gather(*(replenish(user) for user in range(REPLENISHERS)))
+    elapsed = time.perf_counter() - start
+    print(f"{max_batch_size:>10} {backend.calls:>8} {backend.requests / elapsed:>14.1f} {elapsed:>9.2f}")
+
+async def main():
+    print(f"{'batch size':>10} {'calls':>8} {'exercises/s':>14} {'total s':>9}")
+    for max_batch_size in BATCH_SIZES:
+        await run(max_batch_size)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,68 @@
+"""
+Import plus first-lookup time of a language name, and steady-state lookup time:
+pycountry (the previous runtime lookup) vs. the generated language_registry.
+
+Each cold measurement runs in a fresh interpreter so nothing is already imported or cached.
+Needs no database; pycountry is only needed for the comparison row. Run from the repo root:
+
+    python -m benchmarks.language_registry
+"""
+import subprocess
+import sys
+import timeit
+
+COLD_RUNS = 5
+LOOKUPS = 100000
+
+# Prints the seconds taken to import the module and look up one name
+COLD_SNIPPETS = {
+    "pycountry": (
+        "import time; start = time.perf_counter()\n"
+        "from pycountry import languages\n"
+        "languages.get(alpha_3='cmn').name\n"
+        "print(time.perf_counter() - start)"
+    ),
+    "registry": (
+        "import time; start = time.perf_counter()\n"
+        "from language_registry import LANGUAGE_NAMES\n"
+        "LANGUAGE_NAMES['cmn']\n"
+        "print(time.perf_counter() - start)"
+    ),
+}
+
+WARM_SETUP = {
+    "pycountry": "from pycountry import languages; languages.get(alpha_3='cmn')",
+    "registry": "from language_registry import LANGUAGE_NAMES",
+}
+WARM_STATEMENTS = {
+    "pycountry": "languages.get(alpha_3='spa').name",
+    "registry": "LANGUAGE_NAMES['spa']",
+}
+
+def cold_ms(name: str):
+    samples = []
+    for _ in range(COLD_RUNS):
+        result = subprocess.run([sys.executable, "-c", COLD_SNIPPETS[name]], capture_output=True, text=True)
+        if result.returncode != 0:
+            return None
+        samples.append(float(result.stdout) * 1000)
+    return min(samples)
+
+def warm_us(name: str):
+    seconds = timeit.timeit(WARM_STATEMENTS[name], setup=WARM_SETUP[name], number=LOOKUPS)
+    return seconds / LOOKUPS * 1_000_000
+
+def main():
+    # Compile the registry once so the cold runs measure loading it, not compiling it
+    subprocess.run([sys.executable, "-c", "import language_registry"], check=True)
+
+    print(f"{'source':>10} {'import + first lookup ms':>25} {'lookup us':>10}")
+    for name in COLD_SNIPPETS:
+        cold = cold_ms(name)
+        if cold is None:
+            print(f"{name:>10} {'not installed':>25}")
+            continue
+        print(f"{name:>10} {cold:>25.2f} {warm_us(name):>10.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""
+Load test of the API: boots main.py's app under uvicorn in a child process and drives it
+with concurrent virtual users, one scenario at a time, reporting throughput and p50/p95/p99.
+
+Point MONGODB_URL at a local mongod and MONGODB_DATABASE at a throwaway database, or pass
+--mongomock to run against mongomock-motor with no server. Mongomock implements neither
+$lookup with "let" (used by /cached-exercises) nor partial indexes (so every exercise after the
+first fails the unique content_hash index), which makes every cached_exercises and
+exercise_attempt request fail there; --mongomock leaves those two scenarios out unless they are
+named in --scenarios. Use it as a smoke test and record baselines against mongod. Run from the
+repo root:
+
+    MONGODB_URL=mongodb://localhost:27017 MONGODB_DATABASE=lexaglot_bench JWT_SECRET_KEY=bench \\
+        python -m benchmarks.load --concurrency 16 --duration 10 --save-baseline
+    MONGODB_URL=... python -m benchmarks.load --concurrency 16 --duration 10
+
+Each run is compared with the stored baseline for its backend and concurrency
+(benchmarks/baselines/load-<backend>-c<concurrency>.json). The run fails if a scenario's
+throughput drops, or its p95 rises, by more than --tolerance, or its error rate rises.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List
+import httpx
+from benchmarks.login_storm import percentile
+
+LANGUAGE = "cmn"
+SEED_TEXTS = 200
+BOOT_TIMEOUT_S = 30
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+ERROR_RATE_TOLERANCE = 0.01  # Absolute rise in error rate allowed over the baseline
+
+@dataclass
+class VirtualUser:
+    username: str
+    password: str
+    headers: Dict[str, str] = field(default_factory=dict)
+
+# A scenario does any untimed setup it needs and returns the request to time
+Scenario = Callable[[httpx.AsyncClient, VirtualUser], Awaitable[httpx.Request]]
+
+async def login(client: httpx.AsyncClient, user: VirtualUser) -> httpx.Request:
+    return client.build_request("POST", "/token", data={"username": user.username, "password": user.password})
+
+async def cached_exercises(client: httpx.AsyncClient, user: VirtualUser) -> httpx.Request:
+    return client.build_request("GET", f"/cached-exercises/{LANGUAGE}", headers=user.headers)
+
+async def exercise_attempt(client: httpx.AsyncClient, user: VirtualUser) -> httpx.Request:
+    # Attempts are unique per user and exercise, so each one needs a fresh exercise
+    response = await client.post("/exercise", json={
+        "type": "matching",
+        "language": LANGUAGE,
+        "data": {"pairs": {"你好": "hello", "再見": "goodbye"}}
+    })
+    response.raise_for_status()
+    now = datetime.utcnow().isoformat()
+    return client.build_request(
+        "POST",
+        f"/exercise-attempt/{response.json()['_id']}",
+        params={"language": LANGUAGE, "started_at": now, "total_time_spent_ms": 4200, "was_completed": True},
+        json=[{"timestamp": now, "time_spent_ms": 4200, "response": {"你好": "hello"}}],
+        headers=user.headers
+    )
+
+async def list_texts(client: httpx.AsyncClient, user: VirtualUser) -> httpx.Request:
+    return client.build_request("GET", "/texts", params={"language": LANGUAGE})
+
+async def tokenbank(client: httpx.AsyncClient, user: VirtualUser) -> httpx.Request:
+    return client.build_request("GET", f"/tokenbank/{LANGUAGE}", headers=user.headers)
+
+SCENARIOS: Dict[str, Scenario] = {
+    "login": login,
+    "cached_exercises": cached_exercises,
+    "exercise_attempt": exercise_attempt,
+    "list_texts": list_texts,
+    "tokenbank": tokenbank,
+}
+# Scenarios whose every request fails under mongomock (see above)
+MONGOMOCK_UNSUPPORTED = {"cached_exercises", "exercise_attempt"}
+
+def serve(port: int, mongomock: bool):
+    """Run the app under uvicorn; runs in the child process"""
+    import uvicorn
+    import db
+    import main
+    if mongomock:
+        from mongomock_motor import AsyncMongoMockClient
+        db.client = AsyncMongoMockClient()
+    uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning")
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def wait_until_up(client: httpx.AsyncClient, server: subprocess.Popen):
+    deadline = time.monotonic() + BOOT_TIMEOUT_S
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with code {server.returncode}")
+        try:
+            if (await client.get("/metrics")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError(f"Server did not start within {BOOT_TIMEOUT_S}s")
+
+async def seed(client: httpx.AsyncClient, concurrency: int) -> List[VirtualUser]:
+    """Register and log in one user per virtual user, and add texts to list"""
+    users = [VirtualUser(f"bench-{uuid.uuid4().hex[:12]}", uuid.uuid4().hex) for _ in range(concurrency)]
+    for user in users:
+        (await client.post("/register", params={"username": user.username, "password": user.password})).raise_for_status()
+        response = await client.post("/token", data={"username": user.username, "password": user.password})
+        response.raise_for_status()
+        user.headers["Authorization"] = f"Bearer {response.json()['access_token']}"
+    for i in range(SEED_TEXTS):
+        (await client.post("/text/info", json={
+            "language": LANGUAGE,
+            "name": f"Bench text {i}",
+            "author": None,
+            "length": 1000,
+            "source_available": False,
+            "tokens": ["我", "你", "商店", f"詞{i}"],
+            "type": "article"
+        })).raise_for_status()
+    return users
+
+async def run_scenario(client: httpx.AsyncClient, scenario: Scenario, users: List[VirtualUser], duration_s: float) -> dict:
+    latencies_ms: List[float] = []
+    errors = 0
+    setup_errors = 0
+
+    async def virtual_user(user: VirtualUser, deadline: float):
+        nonlocal errors, setup_errors
+        while time.monotonic() < deadline:
+            try:
+                request = await scenario(client, user)
+            except httpx.HTTPError:
+                # Setup failed; counted as an error with no latency sample
+                setup_errors += 1
+                await asyncio.sleep(0.01)
+                continue
+            started = time.perf_counter()
+            try:
+                response = await client.send(request)
+                failed = response.status_code >= 400
+            except httpx.TransportError:
+                failed = True
+            latencies_ms.append((time.perf_counter() - started) * 1000)
+            errors += failed
+
+    started = time.monotonic()
+    await asyncio.gather(*(virtual_user(user, started + duration_s) for user in users))
+    elapsed = time.monotonic() - started
+    attempts = len(latencies_ms) + setup_errors
+    return {
+        "requests": len(latencies_ms),
+        "error_rate": (errors + setup_errors) / max(attempts, 1),
+        "throughput_rps": len(latencies_ms) / elapsed,
+        "p50_ms": latency_percentile(latencies_ms, 50),
+        "p95_ms": latency_percentile(latencies_ms, 95),
+        "p99_ms": latency_percentile(latencies_ms, 99),
+    }
+
+def latency_percentile(latencies_ms: List[float], p: float) -> float:
+    # A scenario whose every request failed has no latency to report
+    return percentile(latencies_ms, p) if latencies_ms else float("inf")
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    """Descriptions of the regressions of results against a baseline"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {result['throughput_rps']:.1f} rps vs {base['throughput_rps']:.1f} baseline")
+        if result["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {result['p95_ms']:.1f} ms vs {base['p95_ms']:.1f} baseline")
+        if result["error_rate"] > base["error_rate"] + ERROR_RATE_TOLERANCE:
+            regressions.append(f"{name}: error rate {result['error_rate']:.1%} vs {base['error_rate']:.1%} baseline")
+    return regressions
+
+async def run(args) -> Dict[str, dict]:
+    port = free_port()
+    command = [sys.executable, "-m", "benchmarks.load", "--serve", str(port)] + (["--mongomock"] if args.mongomock else [])
+    server = subprocess.Popen(command)
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60) as client:
+            await wait_until_up(client, server)
+            users = await seed(client, args.concurrency)
+            results = {}
+            for name in args.scenarios:
+                await run_scenario(client, SCENARIOS[name], users, args.warmup)
+                results[name] = await run_scenario(client, SCENARIOS[name], users, args.duration)
+            return results
+    finally:
+        server.terminate()
+        server.wait()
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=16, help="virtual users")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per scenario")
+    parser.add_argument("--warmup", type=float, default=2, help="unrecorded seconds before each scenario")
+    parser.add_argument("--scenarios", type=lambda value: value.split(","))
+    parser.add_argument("--mongomock", action="store_true", help="use mongomock-motor instead of MONGODB_URL")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed throughput/p95 change, e.g. 0.2 = 20%%")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--serve", type=int, metavar="PORT", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.mongomock)
+        return 0
+
+    if args.scenarios is None:
+        args.scenarios = [name for name in SCENARIOS if not (args.mongomock and name in MONGOMOCK_UNSUPPORTED)]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    results = asyncio.run(run(args))
+    print(f"{'scenario':>17} {'requests':>9} {'errors':>7} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, result in results.items():
+        print(
+            f"{name:>17} {result['requests']:>9} {result['error_rate']:>7.1%} {result['throughput_rps']:>8.1f}"
+            f" {result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f} {result['p99_ms']:>8.1f}"
+        )
+
+    backend = "mongomock" if args.mongomock else "mongod"
+    baseline_path = os.path.join(BASELINE_DIR, f"load-{backend}-c{args.concurrency}.json")
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(baseline_path, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {baseline_path}")
+        return 0
+    if not os.path.exists(baseline_path):
+        print(f"No baseline at {baseline_path}; record one with --save-baseline")
+        return 0
+
+    with open(baseline_path) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
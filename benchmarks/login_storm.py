@@ -0,0 +1,70 @@
+"""
+Latency of a non-auth endpoint before and during a login storm.
+
+Probes GET /texts at a steady rate, first on an idle server and then while many
+clients hammer POST /token. With bcrypt running off the event loop, the probe's
+p99 should stay flat; shed logins show up as 503s. Start the API first, then:
+
+    BASE_URL=http://localhost:8000 python -m benchmarks.login_storm
+"""
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+BASE_URL = os.getenv("BASE_URL", "http://localhost:8000")
+PROBE_PATH = "/texts"
+PROBE_INTERVAL_S = 0.02
+PHASE_SECONDS = 10
+LOGIN_CLIENTS = 64
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+def probe(stop: threading.Event):
+    samples = []
+    with requests.Session() as session:
+        while not stop.is_set():
+            start = time.perf_counter()
+            session.get(BASE_URL + PROBE_PATH)
+            samples.append((time.perf_counter() - start) * 1000)
+            time.sleep(PROBE_INTERVAL_S)
+    return samples
+
+def login_loop(stop: threading.Event, username: str, password: str, statuses: list):
+    with requests.Session() as session:
+        while not stop.is_set():
+            response = session.post(BASE_URL + "/token", data={"username": username, "password": password})
+            statuses.append(response.status_code)
+
+def run_phase(storm: bool, username: str, password: str):
+    stop = threading.Event()
+    statuses = []
+    with ThreadPoolExecutor(max_workers=LOGIN_CLIENTS + 1) as pool:
+        probe_future = pool.submit(probe, stop)
+        if storm:
+            for _ in range(LOGIN_CLIENTS):
+                pool.submit(login_loop, stop, username, password, statuses)
+        time.sleep(PHASE_SECONDS)
+        stop.set()
+        samples = probe_future.result()
+    return samples, statuses
+
+def main():
+    username = f"bench-{uuid.uuid4().hex[:12]}"
+    password = uuid.uuid4().hex
+    requests.post(BASE_URL + "/register", params={"username": username, "password": password}).raise_for_status()
+
+    print(f"{'phase':>6} {'probes':>7} {'p50 ms':>8} {'p99 ms':>8} {'logins':>7} {'503s':>6}")
+    for name, storm in [("idle", False), ("storm", True)]:
+        samples, statuses = run_phase(storm, username, password)
+        print(
+            f"{name:>6} {len(samples):>7} {percentile(samples, 50):>8.1f} {percentile(samples, 99):>8.1f}"
+            f" {statuses.count(200):>7} {statuses.count(503):>6}"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Serialization time for large exercise and text lists: the previous path (per-document
+_id conversion, jsonable_encoder, json.dumps) vs. serialization.dumps (orjson with a single
+ObjectId encoder). Needs no database. Run from the repo root:
+
+    python -m benchmarks.serialization
+"""
+import json
+import time
+from datetime import datetime
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+from serialization import dumps
+
+SIZES = [100, 1000, 10000]
+REPEATS = 10
+
+def make_exercises(count: int):
+    return [
+        {
+            "_id": ObjectId(),
+            "type": "translate",
+            "language": "cmn",
+            "tokens": ["衣服"],
+            "created_at": datetime.utcnow(),
+            "data": {
+                "input_language": "cmn",
+                "output_language": "english",
+                "input_sentence": "我昨天在那間店裡看到一件新衣服",
+                "output_sentences": ["yesterday at the store I saw a new shirt"],
+                "chunk_options": ["yesterday", "at", "I", "of", "saw", "a new shirt", "the store"]
+            }
+        }
+        for _ in range(count)
+    ]
+
+def make_texts(count: int):
+    return [
+        {
+            "_id": ObjectId(),
+            "language": "spa",
+            "name": f"Text {i}",
+            "author": "Anónimo",
+            "length": 120000,
+            "source_available": True,
+            "type": "novel"
+        }
+        for i in range(count)
+    ]
+
+def previous_path(documents):
+    for document in documents:
+        document["_id"] = str(document["_id"])
+    content = jsonable_encoder(documents)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+def time_ms(fn, make, count) -> float:
+    samples = []
+    for _ in range(REPEATS):
+        documents = make(count)
+        start = time.perf_counter()
+        fn(documents)
+        samples.append((time.perf_counter() - start) * 1000)
+    return sorted(samples)[len(samples) // 2]
+
+def main():
+    print(f"{'kind':>9} {'docs':>6} {'before ms':>10} {'after ms':>9} {'speedup':>8}")
+    for kind, make in [("exercises", make_exercises), ("texts", make_texts)]:
+        for count in SIZES:
+            before = time_ms(previous_path, make, count)
+            after = time_ms(dumps, make, count)
+            print(f"{kind:>9} {count:>6} {before:>10.2f} {after:>9.2f} {before / after:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""
+Cold start of the API: import time of main.py, then the startup timing report of the
+lifespan hook (settings, client, ping, index check) for a first and a warm boot.
+
+Each boot runs in a fresh interpreter, as a new uvicorn worker would. The first boot may
+create indexes; later boots should only list them. Run from the repo root:
+
+    MONGODB_URL=mongodb://localhost:27017 JWT_SECRET_KEY=dev python -m benchmarks.startup
+"""
+import json
+import statistics
+import subprocess
+import sys
+
+BOOTS = 5
+
+BOOT_SNIPPET = """
+import asyncio, json, main
+
+async def boot():
+    async with main.app.router.lifespan_context(main.app):
+        pass
+    print(json.dumps(main.app.state.startup_timings))
+
+asyncio.run(boot())
+"""
+
+def boot() -> dict:
+    result = subprocess.run([sys.executable, "-c", BOOT_SNIPPET], capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    reports = [boot() for _ in range(BOOTS)]
+    steps = list(reports[0])
+    print(f"{'step':>12} {'first ms':>9} {'warm median ms':>15}")
+    for step in steps:
+        warm = statistics.median(report[step] for report in reports[1:])
+        print(f"{step:>12} {reports[0][step]:>9.1f} {warm:>15.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Tokenizer throughput in MB/s, single process vs. the process pool.
+
+Needs no database. Run from the repo root:
+
+    python -m benchmarks.tokenizer_throughput
+"""
+import random
+import time
+import tokenizer
+
+CORPUS_MB = 32
+LATIN_WORDS = ["el", "gato", "come", "pescado", "porque", "tiene", "hambre", "y", "no", "quiere", "esperar"]
+CJK_TEXT = "我昨天在那間店裡看到一件新衣服，"
+
+def make_corpus(language: str, size_bytes: int):
+    rng = random.Random(0)
+    pieces, size = [], 0
+    while size < size_bytes:
+        if language in tokenizer.CJK_LANGUAGES:
+            piece = CJK_TEXT
+        else:
+            piece = " ".join(rng.choice(LATIN_WORDS) for _ in range(12)) + ". "
+        pieces.append(piece)
+        size += len(piece.encode("utf-8"))
+    return pieces, size
+
+def measure(language: str):
+    pieces, size = make_corpus(language, CORPUS_MB * 1024 * 1024)
+    mb = size / (1024 * 1024)
+
+    start = time.perf_counter()
+    for _ in tokenizer.iter_tokens(pieces, language):
+        pass
+    single = mb / (time.perf_counter() - start)
+
+    tokenizer.get_process_pool()  # Start the workers outside the timed section
+    start = time.perf_counter()
+    tokenizer.tokenize_corpus(pieces, language)
+    pooled = mb / (time.perf_counter() - start)
+
+    print(f"{language:>4} {mb:>8.1f} {single:>12.1f} {pooled:>12.1f}")
+
+def main():
+    print(f"{'lang':>4} {'MB':>8} {'1 proc MB/s':>12} {f'{tokenizer.tokenizer_processes()} procs MB/s':>12}")
+    for language in ["spa", "cmn"]:
+        measure(language)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Generate language_registry.py, the immutable table of language codes and names used at runtime.
+
+pycountry is only needed here: it loads a large JSON database on first use, so the app reads
+the generated module instead. Re-run after upgrading pycountry or editing CUSTOM_LANGUAGE_NAMES:
+
+    python build_language_registry.py
+"""
+from importlib.metadata import version
+import os
+from pycountry import languages
+
+OUTPUT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "language_registry.py")
+
+# Add custom mappings for languages that might not be in pycountry
+CUSTOM_LANGUAGE_NAMES = {
+    'klg': 'Klingon',    # Star Trek - Has official dictionary, institute, and many speakers
+    'qya': 'Quenya',     # Tolkien's High Elvish - Extensively documented by Tolkien himself
+    'sjn': 'Sindarin',   # Tolkien's Elvish - Well documented with substantial vocabulary
+    'dth': 'Dothraki',   # Game of Thrones - Created by linguist David Peterson, has official dictionary
+    'hva': 'High Valyrian' # Game of Thrones - Created by Peterson, has Duolingo course and extensive documentation
+}
+
+def format_mapping(name: str, comment: str, mapping: dict) -> str:
+    lines = [f"# {comment}", f"{name} = MappingProxyType({{"]
+    lines += [f"    {key!r}: {value!r}," for key, value in sorted(mapping.items())]
+    lines.append("})")
+    return "\n".join(lines)
+
+def build_registry() -> str:
+    names = {language.alpha_3: language.name for language in languages}
+    alpha_2_to_3 = {
+        language.alpha_2: language.alpha_3
+        for language in languages
+        if hasattr(language, "alpha_2")
+    }
+    return "\n\n".join([
+        '"""\n'
+        f"ISO 639-3 language codes and names, generated from pycountry {version('pycountry')}\n"
+        "by build_language_registry.py. Do not edit by hand.\n"
+        '"""\n'
+        "from types import MappingProxyType",
+        format_mapping("ISO_639_3_NAMES", "ISO 639-3 code -> English name", names),
+        format_mapping("ALPHA_2_TO_3", "ISO 639-1 code -> ISO 639-3 code", alpha_2_to_3),
+        format_mapping("CUSTOM_LANGUAGE_NAMES", "Constructed languages not (or differently) named in ISO 639-3", CUSTOM_LANGUAGE_NAMES),
+        "# Every supported code -> display name; custom names take precedence\n"
+        "LANGUAGE_NAMES = MappingProxyType({**ISO_639_3_NAMES, **CUSTOM_LANGUAGE_NAMES})\n"
+    ])
+
+if __name__ == "__main__":
+    registry = build_registry()
+    with open(OUTPUT_PATH, "w", encoding="utf-8") as f:
+        f.write(registry)
+    print(f"Wrote {OUTPUT_PATH}")
@@ -0,0 +1,107 @@
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from typing import NamedTuple, Optional
+import math
+import time
+from db import cache_profiles_collection, counters_collection
+from generation import generation_latency
+from metrics import GENERATION_BUDGET_DENIED
+
+# Each user/language has a cache profile in cache_profiles:
+#   {_id: "<user_id>:<language>", user_id, language, attempt_rate, last_attempt_at, shrunk}
+# attempt_rate is an exponentially decaying moving average of attempts per second. The cache
+# is sized to last CACHE_HORIZON_SECONDS at that rate, and refilled while it still holds enough
+# exercises to cover a few generation latencies, so active users do not run out.
+
+DEFAULT_CACHE_SIZE = 3  # Exercises cached for a new user/language, and the least an active one gets
+MAX_CACHE_SIZE = 20
+INACTIVE_CACHE_SIZE = 1  # Kept for inactive users so a returning user does not start with a 202
+INACTIVE_AFTER = timedelta(days=3)  # Caches of users with no attempts for this long are shrunk
+ATTEMPT_RATE_TIME_CONSTANT_SECONDS = 300  # How quickly the attempt rate forgets older attempts
+CACHE_HORIZON_SECONDS = 120  # A full cache should last this long at the user's attempt rate
+LATENCY_SAFETY_FACTOR = 2.0  # Refill while the cache still covers this many generation latencies
+GENERATION_BUDGET_PER_MINUTE = 600  # Exercises all workers together may generate per minute
+URGENT_BUDGET_RESERVE = 0.25  # Share of the budget kept for refilling caches that are empty
+
+class CacheSizing(NamedTuple):
+    target_size: int  # Fill the cache up to this many unused exercises
+    refill_threshold: int  # Refill once this many or fewer are left
+
+def cache_profile_id(user_id: str, language: str) -> str:
+    return f"{user_id}:{language}"
+
+def current_attempt_rate(profile: dict, now: datetime) -> float:
+    """A profile's attempt rate (per second), decayed to now"""
+    elapsed = max((now - profile["last_attempt_at"]).total_seconds(), 0)
+    return profile["attempt_rate"] * math.exp(-elapsed / ATTEMPT_RATE_TIME_CONSTANT_SECONDS)
+
+def compute_cache_sizing(profile: Optional[dict], latency_s: float, now: Optional[datetime] = None) -> CacheSizing:
+    """
+    Size a cache by Little's law: refill while the cache holds more than the exercises the user
+    will attempt during LATENCY_SAFETY_FACTOR generation latencies, and fill it with enough
+    on top of that to last CACHE_HORIZON_SECONDS
+    """
+    if profile is None:
+        return CacheSizing(DEFAULT_CACHE_SIZE, DEFAULT_CACHE_SIZE - 1)
+    now = now or datetime.utcnow()
+    if now - profile["last_attempt_at"] > INACTIVE_AFTER:
+        return CacheSizing(INACTIVE_CACHE_SIZE, 0)
+
+    rate = current_attempt_rate(profile, now)
+    refill_threshold = math.ceil(rate * latency_s * LATENCY_SAFETY_FACTOR)
+    target_size = max(DEFAULT_CACHE_SIZE, min(refill_threshold + math.ceil(rate * CACHE_HORIZON_SECONDS), MAX_CACHE_SIZE))
+    return CacheSizing(target_size, min(refill_threshold, target_size - 1))
+
+async def get_cache_sizing(user_id: str, language: str) -> CacheSizing:
+    profile = await cache_profiles_collection.find_one({"_id": cache_profile_id(user_id, language)})
+    return compute_cache_sizing(profile, generation_latency())
+
+async def record_attempt_activity(user_id: str, language: str, count: int = 1):
+    """
+    Fold count new attempts into a user/language's attempt rate. The decay is computed by
+    the server in one update, so concurrent attempts from several workers are not lost.
+    """
+    now = datetime.utcnow()
+    # exp(-seconds since the last attempt / time constant); null for a new profile
+    decay = {"$exp": {"$divide": [
+        {"$subtract": ["$last_attempt_at", now]},
+        ATTEMPT_RATE_TIME_CONSTANT_SECONDS * 1000
+    ]}}
+    await cache_profiles_collection.update_one(
+        {"_id": cache_profile_id(user_id, language)},
+        [{"$set": {
+            "user_id": user_id,
+            "language": language,
+            "attempt_rate": {"$add": [
+                {"$multiply": [{"$ifNull": ["$attempt_rate", 0]}, {"$ifNull": [decay, 0]}]},
+                count / ATTEMPT_RATE_TIME_CONSTANT_SECONDS
+            ]},
+            "last_attempt_at": now,
+            "shrunk": False
+        }}],
+        upsert=True
+    )
+
+async def take_generation_budget(count: int, urgent: bool) -> int:
+    """
+    Take up to count exercises from the generation budget all workers share for the current
+    minute. Returns how many may be generated. Refills of caches that are not empty (urgent=False)
+    cannot use the last URGENT_BUDGET_RESERVE of the budget.
+    """
+    if count <= 0:
+        return 0
+    window = int(time.time() // 60)
+    counter_id = f"generation_budget:{window}"
+    limit = GENERATION_BUDGET_PER_MINUTE if urgent else int(GENERATION_BUDGET_PER_MINUTE * (1 - URGENT_BUDGET_RESERVE))
+    counter = await counters_collection.find_one_and_update(
+        {"_id": counter_id},
+        {"$inc": {"used": count}, "$setOnInsert": {"expires_at": datetime.utcnow() + timedelta(minutes=2)}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    granted = max(0, min(count, limit - (counter["used"] - count)))
+    if granted < count:
+        # Give back what was not granted
+        await counters_collection.update_one({"_id": counter_id}, {"$inc": {"used": granted - count}})
+        GENERATION_BUDGET_DENIED.labels(str(urgent).lower()).inc(count - granted)
+    return granted
@@ -2,99 +2,295 @@ from fastapi import HTTPException
 from models import Exercise, ExerciseAttempt, TextInfo, TextSource
 from auth_models import UserInDB, RefreshToken
 from generation import generate_exercise
+from cache import TTLCache
+from metrics import register_cache
+from tokenbank import buffer_token_deltas, token_deltas_for_attempt
+from tokenizer import CorpusTokenizer
+from text_index import index_existing_texts, index_text
+from retention import get_archived_exercise, get_archived_exercises
+from stats import record_attempt_stats
+from language_registry import ALPHA_2_TO_3
+from language_utils import normalize_language
+from jobs import URGENT_PRIORITY, DEFAULT_PRIORITY, enqueue_job
+from cache_sizing import (
+    DEFAULT_CACHE_SIZE, INACTIVE_AFTER, INACTIVE_CACHE_SIZE,
+    get_cache_sizing, record_attempt_activity, take_generation_budget
+)
 from bson import ObjectId
-from datetime import datetime
-from typing import Dict, Optional, List
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, Optional, List, Tuple
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from gridfs.errors import NoFile
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import socket
+import uuid
 from db import (
     exercises_collection, users_collection, attempts_collection,
     refresh_tokens_collection, exercise_cache,
-    text_info_collection, text_source_collection,
+    text_info_collection, text_source_collection, text_source_bucket,
+    replenish_leases_collection, seen_exercises_collection, cache_profiles_collection,
+    tokenbank_collection, tokenbank_tokens_collection, daily_stats_collection,
+    token_vocabulary_collection, token_texts_collection, text_token_index_collection,
     connect as connect_to_mongo,
     close as close_mongo_connection
 )
 
+logger = logging.getLogger("uvicorn")
+
 # Constants
-DEFAULT_CACHE_SIZE = 3  # Number of exercises to cache per user/language
+GENERATION_CONCURRENCY = 4  # Max concurrent generate_exercise calls per replenish
+REPLENISH_LEASE_SECONDS = 120  # How long a worker may hold a replenish lease before others can take over
+CACHE_SWEEP_INTERVAL_SECONDS = 3600  # How often inactive users' caches are shrunk
+
+TEXT_SOURCE_CHUNK_SIZE = 64 * 1024  # Bytes per stored text source chunk and per streamed read
+TEXT_PAGE_SIZE = 50  # Default number of texts per /texts page
+MAX_TEXT_PAGE_SIZE = 500  # Largest /texts page a client may ask for
+USER_CACHE_SIZE = 10000  # Max users kept in the authenticated user cache
+# How long a cached user is trusted before it is re-read. invalidate_cached_user only clears this
+# process, so other uvicorn workers can keep accepting a disabled user or an old password for up to this long
+USER_CACHE_TTL_SECONDS = 60
+
+# Identifies this process as a replenish lease owner across uvicorn workers
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# In-flight replenish tasks in this process, keyed by (user_id, language)
+_replenish_tasks: Dict[Tuple[str, str], asyncio.Task] = {}
+
+# UserInDB records by username, for the authenticated request path
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS)
+register_cache("user", user_cache)
 
 async def create_text_info(text_info: TextInfo) -> dict:
     """Create a new text info entry"""
     text_info_dict = text_info.model_dump()
     result = await text_info_collection.insert_one(text_info_dict)
-    text_info_dict["_id"] = str(result.inserted_id)
+    if text_info.tokens:
+        await index_text(result.inserted_id, text_info.language, text_info.tokens)
     return text_info_dict
 
-async def create_text_source(text_source: TextSource) -> dict:
-    """Create a new text source entry"""
-    # Verify text_info exists
+async def _require_text_info(text_info_id: str) -> dict:
+    """
+    Get a text info's language. Raises 400 if text_info_id is malformed, 404 if the text info does not exist.
+    """
     try:
-        text_info = await text_info_collection.find_one({"_id": ObjectId(text_source.text_info_id)})
-        if not text_info:
-            raise HTTPException(status_code=404, detail="Text info not found")
+        object_id = ObjectId(text_info_id)
     except:
         raise HTTPException(status_code=400, detail="Invalid text_info_id format")
-    
-    text_source_dict = text_source.model_dump()
-    result = await text_source_collection.insert_one(text_source_dict)
-    text_source_dict["_id"] = str(result.inserted_id)
-    return text_source_dict
+    text_info = await text_info_collection.find_one({"_id": object_id}, projection={"language": 1})
+    if not text_info:
+        raise HTTPException(status_code=404, detail="Text info not found")
+    return text_info
+
+async def store_text_source(text_info_id: str, chunks: AsyncIterator[bytes]) -> dict:
+    """
+    Store text content streamed in as UTF-8 bytes, split into TEXT_SOURCE_CHUNK_SIZE GridFS chunks.
+    Replaces any content previously stored for the text. The content is tokenized as it streams in,
+    and the text info's tokens and length are updated to match.
+    """
+    text_info = await _require_text_info(text_info_id)
+    corpus_tokenizer = CorpusTokenizer(text_info["language"])
+
+    grid_in = text_source_bucket.open_upload_stream(
+        text_info_id,
+        chunk_size_bytes=TEXT_SOURCE_CHUNK_SIZE,
+        metadata={"text_info_id": text_info_id}
+    )
+    try:
+        async for chunk in chunks:
+            await corpus_tokenizer.feed(chunk)
+            await grid_in.write(chunk)
+        tokens, length = await corpus_tokenizer.result()
+    except BaseException:
+        await grid_in.abort()
+        raise
+    await grid_in.close()
+
+    await text_info_collection.update_one(
+        {"_id": text_info["_id"]},
+        {"$set": {"tokens": tokens, "length": length}}
+    )
+    await index_text(text_info["_id"], text_info["language"], tokens)
+
+    # Remove older versions of the content
+    async for old_file in text_source_bucket.find({"filename": text_info_id, "_id": {"$ne": grid_in._id}}):
+        await text_source_bucket.delete(old_file._id)
+
+    return {"_id": str(grid_in._id), "text_info_id": text_info_id, "length": length, "token_count": len(tokens)}
+
+async def create_text_source(text_source: TextSource) -> dict:
+    """Create a new text source entry"""
+    async def content_chunks():
+        yield text_source.content.encode("utf-8")
+
+    return await store_text_source(text_source.text_info_id, content_chunks())
+
+class LegacyTextSource:
+    """The content of a text source still stored as a single document, read like a GridFS file"""
+
+    def __init__(self, content: str):
+        self._data = content.encode("utf-8")
+        self._position = 0
+        self.length = len(self._data)
+
+    def seek(self, position: int):
+        self._position = position
+
+    async def read(self, size: int) -> bytes:
+        data = self._data[self._position:self._position + size]
+        self._position += len(data)
+        return data
+
+async def open_text_source(text_info_id: str):
+    """
+    Open the stored content of a text for reading, or return None if it has none.
+    Text sources still stored as a single legacy document are read from it as they are;
+    migrate_legacy_text_sources moves them to chunked storage.
+    """
+    try:
+        return await text_source_bucket.open_download_stream_by_name(text_info_id)
+    except NoFile:
+        pass
+
+    legacy_source = await text_source_collection.find_one({"text_info_id": text_info_id})
+    if not legacy_source:
+        return None
+    return LegacyTextSource(legacy_source["content"])
+
+async def migrate_legacy_text_sources() -> int:
+    """
+    Move text sources stored as a single document to chunked storage. A text that already has
+    chunked content (e.g. re-uploaded since) keeps it, and its stale legacy document is dropped.
+    Safe to rerun. Returns the number of text sources migrated.
+    """
+    migrated = 0
+    async for legacy_source in text_source_collection.find({}):
+        stored = await text_source_bucket.find({"filename": legacy_source["text_info_id"]}, limit=1).to_list(length=1)
+        if not stored:
+            await create_text_source(TextSource.model_validate(legacy_source))
+            migrated += 1
+        await text_source_collection.delete_one({"_id": legacy_source["_id"]})
+    return migrated
+
+async def dedupe_attempts() -> int:
+    """
+    Delete all but the first recorded attempt of each user and exercise, so the unique
+    (user_id, exercise_id) index can be built over attempts recorded before it existed.
+    Safe to rerun. Returns the number of attempts deleted.
+    """
+    deleted = 0
+    cursor = attempts_collection.aggregate(
+        [
+            {"$group": {
+                "_id": {"user_id": "$user_id", "exercise_id": "$exercise_id"},
+                "ids": {"$push": "$_id"},
+                "count": {"$sum": 1}
+            }},
+            {"$match": {"count": {"$gt": 1}}}
+        ],
+        allowDiskUse=True
+    )
+    async for group in cursor:
+        result = await attempts_collection.delete_many({"_id": {"$in": sorted(group["ids"])[1:]}})
+        deleted += result.deleted_count
+    return deleted
+
+async def read_text_source(grid_out, start: int, end: int) -> AsyncIterator[bytes]:
+    """
+    Yield the bytes of opened text content from start up to (not including) end, a chunk at a time
+    """
+    grid_out.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        data = await grid_out.read(min(TEXT_SOURCE_CHUNK_SIZE, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
 
 async def get_text_info(text_info_id: str) -> Optional[dict]:
     """Get text info by ID"""
     try:
         text_info = await text_info_collection.find_one({"_id": ObjectId(text_info_id)})
         if text_info:
-            text_info["_id"] = str(text_info["_id"])
             return text_info
         return None
     except:
         raise HTTPException(status_code=400, detail="Invalid ID format")
 
-async def get_text_source(text_info_id: str) -> Optional[dict]:
-    """Get text source by text_info_id"""
-    try:
-        text_source = await text_source_collection.find_one({"text_info_id": text_info_id})
-        if text_source:
-            text_source["_id"] = str(text_source["_id"])
-            return text_source
-        return None
-    except:
-        raise HTTPException(status_code=400, detail="Invalid ID format")
-
-async def list_texts(language: Optional[str] = None, type: Optional[str] = None) -> List[dict]:
-    """List all texts, optionally filtered by language and/or type"""
+def _find_texts(
+    language: Optional[str],
+    type: Optional[str],
+    after: Optional[str],
+    limit: Optional[int],
+    include_tokens: bool
+):
+    """Cursor over texts in _id order, starting after the given _id (keyset pagination)"""
     query = {}
     if language:
         query["language"] = language
     if type:
         query["type"] = type
-        
-    cursor = text_info_collection.find(query)
-    texts = await cursor.to_list(length=None)
-    
-    # Convert ObjectIds to strings
-    for text in texts:
-        text["_id"] = str(text["_id"])
-    
-    return texts
+    if after:
+        try:
+            query["_id"] = {"$gt": ObjectId(after)}
+        except:
+            raise HTTPException(status_code=400, detail="Invalid cursor format")
+
+    # The token lists can be huge, so they are left out unless asked for
+    projection = None if include_tokens else {"tokens": 0}
+    cursor = text_info_collection.find(query, projection=projection, sort=[("_id", 1)])
+    if limit:
+        cursor = cursor.limit(limit)
+    return cursor
+
+async def list_texts(
+    language: Optional[str] = None,
+    type: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = TEXT_PAGE_SIZE,
+    include_tokens: bool = False
+) -> List[dict]:
+    """
+    List a page of texts, optionally filtered by language and/or type.
+    Pass the _id of the last text of a page as after to get the next page.
+    """
+    limit = max(1, min(limit, MAX_TEXT_PAGE_SIZE))
+    return await _find_texts(language, type, after, limit, include_tokens).to_list(length=limit)
+
+async def stream_texts(
+    language: Optional[str] = None,
+    type: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: Optional[int] = None,
+    include_tokens: bool = False
+) -> AsyncIterator[dict]:
+    """
+    Yield texts one at a time as the cursor produces them, optionally filtered by language and/or type
+    """
+    async for text in _find_texts(language, type, after, limit, include_tokens):
+        yield text
 
 async def create_exercise(exercise: Exercise):
     exercise_dict = {
         "type": exercise.type,
         "data": exercise.data.model_dump()
     }
-    result = await exercises_collection.insert_one(exercise_dict)
-    exercise_dict["_id"] = str(result.inserted_id)
+    await exercises_collection.insert_one(exercise_dict)
     return exercise_dict
 
 async def get_exercise_by_id(id: str) -> Exercise:
-    try:
-        exercise = await exercises_collection.find_one({"_id": ObjectId(id)})
-        if exercise:
-            exercise["_id"] = str(exercise["_id"])
-            return exercise
-        raise HTTPException(status_code=404, detail="Exercise not found")
-    except:
+    if not ObjectId.is_valid(id):
         raise HTTPException(status_code=400, detail="Invalid ID format")
+    # Old attempted exercises live in the archive
+    exercise = await exercises_collection.find_one({"_id": ObjectId(id)}) or await get_archived_exercise(ObjectId(id))
+    if exercise:
+        return exercise
+    raise HTTPException(status_code=404, detail="Exercise not found")
 
 async def get_user(username: str):
     user = await users_collection.find_one({"username": username})
@@ -103,6 +299,26 @@ async def get_user(username: str):
         return UserInDB.model_validate(user)
     return None
 
+async def get_user_cached(username: str):
+    """
+    Get a user through the in-process user cache. Missing users are not cached.
+    Any write to a user must call invalidate_cached_user, which only reaches this process;
+    other processes see the change within USER_CACHE_TTL_SECONDS.
+    """
+    user = user_cache.get(username)
+    if user is None:
+        user = await get_user(username)
+        if user:
+            user_cache.set(username, user)
+    return user
+
+def invalidate_cached_user(username: str):
+    user_cache.invalidate(username)
+
+def user_cache_stats() -> Dict[str, int]:
+    """Hit/miss counters and current size of the user cache"""
+    return user_cache.stats()
+
 async def create_user(user: UserInDB):
     existing_user = await get_user(user.username)
     if existing_user:
@@ -110,102 +326,472 @@ async def create_user(user: UserInDB):
     
     user_dict = user.model_dump(exclude={"id"})
     result = await users_collection.insert_one(user_dict)
+    invalidate_cached_user(user.username)
     user_dict["_id"] = str(result.inserted_id)
     return UserInDB.model_validate(user_dict)
 
-async def replenish_cache(language: str, user_id: str, token: str):
+async def generate_exercises(
+    language: str,
+    token: str,
+    count: int,
+    concurrency: int = GENERATION_CONCURRENCY
+) -> List[dict]:
     """
-    Replenish the cache up to DEFAULT_CACHE_SIZE if needed
+    Generate up to count exercises concurrently, with at most concurrency generations in flight.
+    Failed generations are logged and skipped; the successful ones are returned.
+    Raises the first error if every generation failed.
     """
-    try:
-        cache_count = await count_cached_exercises(language, user_id, token)
-        exercises_needed = DEFAULT_CACHE_SIZE - cache_count
-        
-        for _ in range(exercises_needed):
+    if count <= 0:
+        return []
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def generate_one():
+        async with semaphore:
             exercise = await generate_exercise(language, token)
-            exercise_dict = exercise.model_dump()
-            await cache_exercise(exercise_dict, language, user_id, token)
+            return exercise.model_dump()
+
+    results = await asyncio.gather(*(generate_one() for _ in range(count)), return_exceptions=True)
+    exercises = [result for result in results if not isinstance(result, BaseException)]
+    errors = [result for result in results if isinstance(result, BaseException)]
+
+    for error in errors:
+        logger.error(f"Exercise generation failed for {language}/{token}: {error!r}")
+    if errors and not exercises:
+        raise errors[0]
+    return exercises
+
+def _replenish_lease_id(language: str, user_id: str) -> str:
+    return f"{user_id}:{language}"
+
+async def acquire_replenish_lease(language: str, user_id: str) -> bool:
+    """
+    Try to take the replenish lease for a user/language across all workers.
+    Returns False if another worker holds an unexpired lease.
+    """
+    now = datetime.utcnow()
+    try:
+        # Only matches a missing or expired lease; otherwise the upsert collides on _id
+        await replenish_leases_collection.update_one(
+            {"_id": _replenish_lease_id(language, user_id), "expires_at": {"$lte": now}},
+            {"$set": {
+                "owner": WORKER_ID,
+                "expires_at": now + timedelta(seconds=REPLENISH_LEASE_SECONDS)
+            }},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+async def release_replenish_lease(language: str, user_id: str):
+    """
+    Release the replenish lease for a user/language if this worker still owns it.
+    """
+    await replenish_leases_collection.delete_one({
+        "_id": _replenish_lease_id(language, user_id),
+        "owner": WORKER_ID
+    })
+
+async def _replenish_cache_leased(language: str, user_id: str, token: str, concurrency: int):
+    if not await acquire_replenish_lease(language, user_id):
+        # Another worker is already replenishing this cache
+        return
+    try:
+        cache_count, sizing = await asyncio.gather(
+            count_cached_exercises(language, user_id, token),
+            get_cache_sizing(user_id, language)
+        )
+        if cache_count <= sizing.refill_threshold:
+            # An empty cache means the user is waiting, so it may use the budget's reserve
+            await fill_cache_from_pool(
+                language, user_id, token, sizing.target_size - cache_count, concurrency, urgent=cache_count == 0
+            )
+    finally:
+        await release_replenish_lease(language, user_id)
+
+async def replenish_cache(language: str, user_id: str, token: str, concurrency: int = GENERATION_CONCURRENCY):
+    """
+    Refill the cache up to its target size once it is down to its refill threshold (see cache_sizing.py).
+    Unseen exercises from the shared pool are used first; the rest are generated concurrently.
+    Only one replenish runs per user/language: calls made while one is in flight in this
+    process join it, and a Mongo lease keeps other workers from running their own.
+    """
+    key = (user_id, language)
+    task = _replenish_tasks.get(key)
+    if task is None:
+        task = asyncio.create_task(_replenish_cache_leased(language, user_id, token, concurrency))
+        _replenish_tasks[key] = task
+        task.add_done_callback(lambda done: _replenish_tasks.pop(key, None) if _replenish_tasks.get(key) is done else None)
+    # Shielded so a cancelled caller does not cancel the replenish for everyone who joined it
+    await asyncio.shield(task)
+
+async def enqueue_replenish(language: str, user_id: str, token: str, urgent: bool = False):
+    """
+    Queue a replenish_cache job for a job worker (see worker.py). A user/language has at most one
+    replenish queued; urgent jobs, for users whose cache is empty, are claimed first.
+    """
+    await enqueue_job(
+        "replenish_cache",
+        {"language": language, "user_id": user_id, "token": token},
+        priority=URGENT_PRIORITY if urgent else DEFAULT_PRIORITY,
+        dedupe_key=f"replenish_cache:{user_id}:{language}"
+    )
+
+def _mark_used_filter(attempt: ExerciseAttempt) -> dict:
+    return {
+        "exercise_id": attempt.exercise_id,
+        "user_id": attempt.user_id,
+        "language": attempt.language,
+        "used": False
+    }
+
+async def get_attempted_exercises(exercise_ids: List[str]) -> Dict[str, dict]:
+    """
+    Get the tokens and type of each exercise, by exercise id, with one query, and one more
+    for any that have been archived
+    """
+    object_ids = [ObjectId(exercise_id) for exercise_id in exercise_ids if ObjectId.is_valid(exercise_id)]
+    if not object_ids:
+        return {}
+    cursor = exercises_collection.find({"_id": {"$in": object_ids}}, projection={"tokens": 1, "type": 1})
+    exercises = {str(doc["_id"]): doc async for doc in cursor}
+    archived = await get_archived_exercises([object_id for object_id in object_ids if str(object_id) not in exercises])
+    for exercise_id, exercise in archived.items():
+        exercises[exercise_id] = {key: exercise[key] for key in ("_id", "tokens", "type") if key in exercise}
+    return exercises
+
+def _buffer_attempt_token_deltas(attempt: ExerciseAttempt, exercises: Dict[str, dict]):
+    tokens = exercises.get(attempt.exercise_id, {}).get("tokens", [])
+    deltas = token_deltas_for_attempt(attempt.was_completed, tokens)
+    buffer_token_deltas(attempt.user_id, attempt.language, deltas)
+
+async def _record_attempt_stats(attempts: List[ExerciseAttempt], exercises: Dict[str, dict]):
+    exercise_types = {exercise_id: exercise.get("type") for exercise_id, exercise in exercises.items()}
+    try:
+        await record_attempt_stats(attempts, exercise_types)
     except Exception as e:
-        raise
+        # Only affects stats, so the attempts still count. The rollups stay short until the backfill in
+        # stats.py is rerun with a --before past their day, while no attempts for it are being recorded
+        logger.error(f"Failed to update daily stats for {len(attempts)} attempts: {e!r}")
 
 async def record_attempt(attempt: ExerciseAttempt):
-    # Check if attempt already exists for this exercise and user
-    existing_attempt = await attempts_collection.find_one({
-        "exercise_id": attempt.exercise_id,
-        "user_id": attempt.user_id
-    })
-    
-    if existing_attempt:
+    """
+    Record an attempt. The unique (user_id, exercise_id) index makes the insert idempotent,
+    so a retried request cannot create a second attempt.
+    """
+    attempt_dict = attempt.model_dump()
+
+    # Record the attempt, mark the exercise as used in the cache and look up its tokens concurrently.
+    # Marking used is harmless if the attempt turns out to be a duplicate.
+    insert, _, exercises = await asyncio.gather(
+        attempts_collection.insert_one(attempt_dict),
+        exercise_cache.update_one(_mark_used_filter(attempt), {"$set": {"used": True, "used_at": datetime.utcnow()}}),
+        get_attempted_exercises([attempt.exercise_id]),
+        return_exceptions=True
+    )
+    if isinstance(insert, DuplicateKeyError):
         raise HTTPException(
             status_code=400,
             detail="An attempt for this exercise has already been recorded"
         )
-    
-    attempt_dict = attempt.model_dump()
-    
-    # Mark the exercise as used in the cache
-    await exercise_cache.update_one(
-        {
-            "exercise_id": attempt.exercise_id,
-            "user_id": attempt.user_id,
-            "language": attempt.language,
-            "used": False
-        },
-        {"$set": {"used": True}}
-    )
-    
-    # Record the attempt
-    result = await attempts_collection.insert_one(attempt_dict)
-    attempt_dict["_id"] = str(result.inserted_id)
+    if isinstance(insert, BaseException):
+        raise insert
+    if isinstance(exercises, BaseException):
+        # The attempt is recorded, and a retry would be rejected as a duplicate, so carry on without them
+        logger.error(f"Failed to look up exercise {attempt.exercise_id} of an attempt: {exercises!r}")
+        exercises = {}
+
+    # Only once the attempt is recorded, so retried duplicates do not count as activity
+    try:
+        await record_attempt_activity(attempt.user_id, attempt.language)
+    except Exception as e:
+        # Only affects cache sizing, so the attempt still counts
+        logger.error(f"Failed to record attempt activity for {attempt.user_id}/{attempt.language}: {e!r}")
+
+    _buffer_attempt_token_deltas(attempt, exercises)
+    await _record_attempt_stats([attempt], exercises)
+
+    # insert_one has set attempt_dict["_id"]
     return attempt_dict
 
+async def record_attempts(attempts: List[ExerciseAttempt]) -> List[dict]:
+    """
+    Record many attempts with one unordered bulk_write, e.g. from a client syncing after being offline.
+    Returns one result per attempt, in order, with status "recorded", "duplicate" or "error".
+    """
+    if not attempts:
+        return []
+
+    attempt_dicts = [attempt.model_dump() for attempt in attempts]
+    try:
+        await attempts_collection.bulk_write(
+            [InsertOne(attempt_dict) for attempt_dict in attempt_dicts],
+            ordered=False
+        )
+        write_errors = []
+    except BulkWriteError as e:
+        write_errors = e.details.get("writeErrors", [])
+
+    errors_by_index = {error["index"]: error for error in write_errors}
+    recorded_per_language: Dict[Tuple[str, str], int] = {}
+    for i, attempt in enumerate(attempts):
+        if i not in errors_by_index:
+            key = (attempt.user_id, attempt.language)
+            recorded_per_language[key] = recorded_per_language.get(key, 0) + 1
+
+    used_at = datetime.utcnow()
+    mark_used, exercises, *activities = await asyncio.gather(
+        exercise_cache.bulk_write(
+            [UpdateOne(_mark_used_filter(attempt), {"$set": {"used": True, "used_at": used_at}}) for attempt in attempts],
+            ordered=False
+        ),
+        get_attempted_exercises([attempt.exercise_id for attempt in attempts]),
+        *(
+            record_attempt_activity(user_id, language, count)
+            for (user_id, language), count in recorded_per_language.items()
+        ),
+        return_exceptions=True
+    )
+    # The attempts are already written, so these failures are logged rather than failing the batch
+    if isinstance(mark_used, BaseException):
+        logger.error(f"Failed to mark {len(attempts)} batch attempts' exercises used: {mark_used!r}")
+    if isinstance(exercises, BaseException):
+        logger.error(f"Failed to look up exercises of {len(attempts)} batch attempts: {exercises!r}")
+        exercises = {}
+    for (user_id, language), activity in zip(recorded_per_language, activities):
+        if isinstance(activity, BaseException):
+            logger.error(f"Failed to record attempt activity for {user_id}/{language}: {activity!r}")
+
+    results = []
+    for i, (attempt, attempt_dict) in enumerate(zip(attempts, attempt_dicts)):
+        result = {"exercise_id": attempt_dict["exercise_id"]}
+        error = errors_by_index.get(i)
+        if error is None:
+            result["status"] = "recorded"
+            result["_id"] = attempt_dict["_id"]
+            _buffer_attempt_token_deltas(attempt, exercises)
+        elif error.get("code") == 11000:
+            result["status"] = "duplicate"
+            result["detail"] = "An attempt for this exercise has already been recorded"
+        else:
+            result["status"] = "error"
+            result["detail"] = error.get("errmsg", "Failed to record attempt")
+        results.append(result)
+
+    await _record_attempt_stats([attempt for i, attempt in enumerate(attempts) if i not in errors_by_index], exercises)
+    return results
+
 async def get_user_attempts(user_id: str, language: str):
     cursor = attempts_collection.find(
         {"user_id": user_id, "language": language}
     ).sort("completed_at", -1)
-    attempts = await cursor.to_list(length=None)
-    for attempt in attempts:
-        attempt["_id"] = str(attempt["_id"])
-    return attempts 
+    return await cursor.to_list(length=None)
+
+def hash_refresh_token(token: str) -> str:
+    """Refresh tokens are stored and looked up by hash, never in plain text"""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+def _refresh_token_filter(token: str) -> dict:
+    # Tokens issued before hashing was introduced are still stored in plain text until they expire
+    return {"$or": [{"token_hash": hash_refresh_token(token)}, {"token": token}]}
 
 async def store_refresh_token(refresh_token: RefreshToken):
     token_dict = refresh_token.model_dump()
-    result = await refresh_tokens_collection.insert_one(token_dict)
-    token_dict["_id"] = str(result.inserted_id)
+    await refresh_tokens_collection.insert_one(token_dict)
     return token_dict
 
 async def get_refresh_token(token: str):
-    return await refresh_tokens_collection.find_one({"token": token, "blacklisted": False})
+    return await refresh_tokens_collection.find_one({**_refresh_token_filter(token), "blacklisted": False})
+
+async def rotate_refresh_token(token: str, new_token: str, new_expires_at: datetime) -> Optional[dict]:
+    """
+    Atomically swap a valid refresh token for a new one in a single find_one_and_update.
+    The old token stops working at once. Returns the token's owner fields, or None if the
+    token is unknown, blacklisted or expired.
+    """
+    return await refresh_tokens_collection.find_one_and_update(
+        {**_refresh_token_filter(token), "blacklisted": False, "expires_at": {"$gt": datetime.utcnow()}},
+        {
+            "$set": {"token_hash": hash_refresh_token(new_token), "expires_at": new_expires_at},
+            "$unset": {"token": ""}
+        },
+        projection={"_id": 0, "user_id": 1, "username": 1}
+    )
 
 async def blacklist_refresh_token(token: str):
+    # Expiring it now lets the TTL index prune the blacklisted token
     result = await refresh_tokens_collection.update_one(
-        {"token": token},
-        {"$set": {"blacklisted": True}}
+        _refresh_token_filter(token),
+        {"$set": {"blacklisted": True, "expires_at": datetime.utcnow()}}
     )
     return result.modified_count > 0 
 
-async def cache_exercise(exercise: dict, language: str, user_id: str, token: str):
+def exercise_content_hash(exercise: dict) -> str:
+    """Hash of what makes an exercise distinct: its language, tokens, type and content"""
+    content = {key: exercise.get(key) for key in ("language", "tokens", "type", "data")}
+    return hashlib.sha256(json.dumps(content, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+async def get_seen_exercise_ids(language: str, user_id: str, token: str) -> List[str]:
+    """Ids of the pool exercises a user has already been given for a token"""
+    cursor = seen_exercises_collection.find(
+        {"user_id": user_id, "language": language, "token": token},
+        projection={"_id": 0, "exercise_id": 1}
+    )
+    return [doc["exercise_id"] async for doc in cursor]
+
+async def mark_exercises_seen(language: str, user_id: str, token: str, exercise_ids: List[str]):
+    """Record that a user has been given these exercises, so the pool does not offer them again"""
+    if not exercise_ids:
+        return
+    try:
+        await seen_exercises_collection.insert_many(
+            [
+                {"user_id": user_id, "exercise_id": exercise_id, "language": language, "token": token}
+                for exercise_id in exercise_ids
+            ],
+            ordered=False
+        )
+    except BulkWriteError:
+        # Already marked seen
+        pass
+
+async def take_pool_exercises(language: str, token: str, count: int, exclude_ids: List[str]) -> List[str]:
+    """Ids of up to count pool exercises practicing a token, skipping exclude_ids"""
+    if count <= 0:
+        return []
+    cursor = exercises_collection.find(
+        {
+            "language": language,
+            "tokens": token,
+            "content_hash": {"$exists": True},
+            "archiving": {"$exists": False},  # About to move to the archive (see retention.py)
+            "_id": {"$nin": [ObjectId(exercise_id) for exercise_id in exclude_ids]}
+        },
+        projection={"_id": 1},
+        sort=[("_id", 1)],
+        limit=count
+    )
+    return [str(doc["_id"]) async for doc in cursor]
+
+async def add_to_pool(exercises: List[dict]) -> List[str]:
     """
-    Cache a generated exercise for future use. First stores the exercise in the exercises collection,
-    then stores a reference to it in the cache.
+    Store generated exercises in the shared pool, deduplicated by content hash, so identical
+    generations for different users become one document. Returns their ids, in the order given.
     """
-    # Ensure _id is not in the exercise dict if it exists
-    if "_id" in exercise:
-        del exercise["_id"]
-        
-    # First store the exercise
-    exercise_result = await exercises_collection.insert_one(exercise)
-    exercise_id = str(exercise_result.inserted_id)
+    if not exercises:
+        return []
 
-    # Then store the reference in cache (without token)
-    cache_doc = {
-        "exercise_id": exercise_id,
-        "language": language,
-        "user_id": user_id,
-        "created_at": datetime.utcnow(),
-        "used": False
-    }
-    await exercise_cache.insert_one(cache_doc)
+    hashes = []
+    requests = []
+    now = datetime.utcnow()
+    for exercise in exercises:
+        exercise.pop("_id", None)
+        content_hash = exercise_content_hash(exercise)
+        hashes.append(content_hash)
+        requests.append(UpdateOne(
+            {"content_hash": content_hash},
+            {"$setOnInsert": {**exercise, "content_hash": content_hash, "created_at": now}},
+            upsert=True
+        ))
+    try:
+        await exercises_collection.bulk_write(requests, ordered=False)
+    except BulkWriteError as e:
+        # Concurrent upserts of the same content collide on the unique hash; the winner is kept
+        if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+            raise
+
+    cursor = exercises_collection.find({"content_hash": {"$in": hashes}}, projection={"content_hash": 1})
+    ids_by_hash = {doc["content_hash"]: str(doc["_id"]) async for doc in cursor}
+    return [ids_by_hash[content_hash] for content_hash in hashes]
+
+async def fill_cache_from_pool(
+    language: str,
+    user_id: str,
+    token: str,
+    count: int,
+    concurrency: int = GENERATION_CONCURRENCY,
+    urgent: bool = True
+) -> List[str]:
+    """
+    Add up to count exercises to a user's cache. Pool exercises for the token that the user has not seen
+    are taken first; only the shortfall is generated, as far as the generation budget allows, and the
+    new exercises join the pool. Returns the ids of the exercises cached.
+    """
+    if count <= 0:
+        return []
+
+    seen_ids = await get_seen_exercise_ids(language, user_id, token)
+    exercise_ids = await take_pool_exercises(language, token, count, seen_ids)
+
+    generate_count = await take_generation_budget(count - len(exercise_ids), urgent)
+    generated = await generate_exercises(language, token, generate_count, concurrency)
+    for exercise in generated:
+        exercise.setdefault("tokens", [token])
+    repeats = []
+    unavailable = set(seen_ids) | set(exercise_ids)
+    for exercise, exercise_id in zip(generated, await add_to_pool(generated)):
+        if exercise_id in unavailable:
+            repeats.append(exercise)
+        else:
+            exercise_ids.append(exercise_id)
+            unavailable.add(exercise_id)
+
+    await mark_exercises_seen(language, user_id, token, exercise_ids)
+    await cache_exercise_ids(exercise_ids, language, user_id)
+    # Generations identical to something the user already has are cached as private copies
+    exercise_ids += await cache_exercises(repeats, language, user_id, token)
+    return exercise_ids
+
+async def cache_exercise_ids(exercise_ids: List[str], language: str, user_id: str):
+    """
+    Add references to stored exercises to a user's cache with one insert_many. created_at is
+    staggered so the oldest-first ordering matches the order the exercises were given in.
+    """
+    if not exercise_ids:
+        return
+    now = datetime.utcnow()
+    cache_docs = [
+        {
+            "exercise_id": exercise_id,
+            "language": language,
+            "user_id": user_id,
+            "created_at": now + timedelta(milliseconds=i),
+            "used": False
+        }
+        for i, exercise_id in enumerate(exercise_ids)
+    ]
+    await exercise_cache.insert_many(cache_docs)
+
+async def cache_exercises(exercises: List[dict], language: str, user_id: str, token: str) -> List[str]:
+    """
+    Cache exercises for one user only, outside the shared pool. Stores the exercises in the
+    exercises collection with one insert_many, then stores references to them in the cache.
+    Returns the ids of the stored exercises, in the order given.
+    """
+    if not exercises:
+        return []
+
+    # Ensure _id is not in the exercise dicts if it exists, and record the token
+    # each exercise practices so attempts can update the tokenbank
+    for exercise in exercises:
+        exercise.pop("_id", None)
+        if token is not None:
+            exercise.setdefault("tokens", [token])
+
+    # First store the exercises
+    exercise_result = await exercises_collection.insert_many(exercises)
+    exercise_ids = [str(exercise_id) for exercise_id in exercise_result.inserted_ids]
+
+    # Then store the references in cache (without token)
+    await cache_exercise_ids(exercise_ids, language, user_id)
+    return exercise_ids
+
+async def cache_exercise(exercise: dict, language: str, user_id: str, token: str):
+    """
+    Cache a single generated exercise for future use.
+    """
+    await cache_exercises([exercise], language, user_id, token)
 
 async def count_cached_exercises(language: str, user_id: str, token: str) -> int:
     """
@@ -220,7 +806,8 @@ async def count_cached_exercises(language: str, user_id: str, token: str) -> int
 async def delete_exercise_cache(language: str, user_id: str):
     """
     Delete all cached exercises for a specific user and language.
-    Also removes the exercises from the exercises collection.
+    Also removes the user's private exercises from the exercises collection;
+    shared pool exercises are kept for other users.
     """
     # First get all cached exercises for this user/language
     cached_exercises = await exercise_cache.find({
@@ -231,7 +818,7 @@ async def delete_exercise_cache(language: str, user_id: str):
     # Delete the exercises from exercises collection
     exercise_ids = [ObjectId(ex["exercise_id"]) for ex in cached_exercises]
     if exercise_ids:
-        await exercises_collection.delete_many({"_id": {"$in": exercise_ids}})
+        await exercises_collection.delete_many({"_id": {"$in": exercise_ids}, "content_hash": {"$exists": False}})
     
     # Delete from cache
     result = await exercise_cache.delete_many({
@@ -241,45 +828,159 @@ async def delete_exercise_cache(language: str, user_id: str):
     
     return result.deleted_count
 
+async def trim_exercise_cache(language: str, user_id: str, keep: int) -> int:
+    """
+    Remove all but the oldest keep unused exercises from a user's cache. Trimmed private exercises
+    are deleted; trimmed pool exercises can be offered to the user again. Returns how many were removed.
+    """
+    cursor = exercise_cache.find(
+        {"language": language, "user_id": user_id, "used": False},
+        projection={"exercise_id": 1},
+        sort=[("created_at", 1)],
+        skip=keep
+    )
+    entries = await cursor.to_list(length=None)
+    if not entries:
+        return 0
+
+    exercise_ids = [entry["exercise_id"] for entry in entries]
+    await asyncio.gather(
+        exercise_cache.delete_many({"_id": {"$in": [entry["_id"] for entry in entries]}}),
+        exercises_collection.delete_many({
+            "_id": {"$in": [ObjectId(exercise_id) for exercise_id in exercise_ids if ObjectId.is_valid(exercise_id)]},
+            "content_hash": {"$exists": False}
+        }),
+        seen_exercises_collection.delete_many({"user_id": user_id, "exercise_id": {"$in": exercise_ids}})
+    )
+    return len(entries)
+
+async def shrink_inactive_caches() -> int:
+    """
+    Trim the caches of users with no attempts for INACTIVE_AFTER down to INACTIVE_CACHE_SIZE.
+    Returns how many cache entries were removed.
+    """
+    removed = 0
+    cursor = cache_profiles_collection.find({
+        "shrunk": False,
+        "last_attempt_at": {"$lt": datetime.utcnow() - INACTIVE_AFTER}
+    })
+    async for profile in cursor:
+        removed += await trim_exercise_cache(profile["language"], profile["user_id"], INACTIVE_CACHE_SIZE)
+        # Unless an attempt came in meanwhile, which makes the profile active again
+        await cache_profiles_collection.update_one(
+            {"_id": profile["_id"], "last_attempt_at": profile["last_attempt_at"]},
+            {"$set": {"shrunk": True}}
+        )
+    return removed
+
+async def run_cache_sweeper():
+    """Shrink inactive users' caches every CACHE_SWEEP_INTERVAL_SECONDS, until cancelled"""
+    while True:
+        try:
+            removed = await shrink_inactive_caches()
+            if removed:
+                logger.info(f"Shrank inactive exercise caches by {removed} exercises")
+        except Exception as e:
+            logger.error(f"Inactive cache sweep failed: {e!r}")
+        await asyncio.sleep(CACHE_SWEEP_INTERVAL_SECONDS)
+
 async def regenerate_exercise_cache(language: str, user_id: str, token: str, target_count: int = DEFAULT_CACHE_SIZE):
     """
     Regenerate the exercise cache for a specific user and language up to target_count.
-    First deletes existing cache, then generates new exercises.
+    First deletes existing cache, then fills it with new exercises.
     """
     # First delete existing cache
     await delete_exercise_cache(language, user_id)
     
-    # Generate new exercises up to target count
-    for _ in range(target_count):
-        exercise = await generate_exercise(language, token)
-        exercise_dict = exercise.model_dump()
-        await cache_exercise(exercise_dict, language, user_id, token)
+    # Fill up to target count, from the pool first
+    await fill_cache_from_pool(language, user_id, token, target_count)
     
     return await count_cached_exercises(language, user_id, token) 
 
-async def get_all_cached_exercises(language: str, user_id: str):
+async def get_all_cached_exercises(language: str, user_id: str, limit: Optional[int] = None):
     """
-    Get all unused cached exercises for a specific user and language
+    Get unused cached exercises for a specific user and language, oldest first.
+    Resolves the cache references with a single $lookup aggregation instead of one
+    find_one per cache entry. Cache entries whose exercise no longer exists are dropped.
     """
-    # Find all unused exercises
-    cursor = exercise_cache.find(
-        {
-            "language": language,
-            "user_id": user_id,
-            "used": False
-        },
-        sort=[("created_at", 1)]  # Get oldest first
-    )
-    
-    cache_docs = await cursor.to_list(length=None)
-    exercises = []
-    
-    # Fetch each exercise from exercises collection
-    for doc in cache_docs:
-        exercise = await exercises_collection.find_one({"_id": ObjectId(doc["exercise_id"])})
-        if exercise:
-            exercise = dict(exercise)  # Convert from MongoDB document to dict
-            exercise["_id"] = str(exercise["_id"])
-            exercises.append(exercise)
-    
-    return exercises 
\ No newline at end of file
+    pipeline = [
+        {"$match": {"language": language, "user_id": user_id, "used": False}},
+        {"$sort": {"created_at": 1}},  # Get oldest first
+    ]
+    pipeline += [
+        {"$lookup": {
+            "from": exercises_collection.name,
+            "let": {"exercise_oid": {"$convert": {
+                "input": "$exercise_id", "to": "objectId", "onError": None, "onNull": None
+            }}},
+            "pipeline": [{"$match": {"$expr": {"$eq": ["$_id", "$$exercise_oid"]}}}],
+            "as": "exercise"
+        }},
+        # Drops dangling cache entries, keeps the cache ordering
+        {"$unwind": "$exercise"},
+        {"$replaceRoot": {"newRoot": "$exercise"}},
+    ]
+    if limit is not None:
+        # After the $unwind, so dropped entries do not count towards it
+        pipeline.append({"$limit": limit})
+
+    cursor = exercise_cache.aggregate(pipeline)
+    return await cursor.to_list(length=None)
+
+async def migrate_language_codes() -> int:
+    """
+    Rewrite ISO 639-1 language codes stored before codes were normalized to ISO 639-3 (e.g. "zh" to "zho").
+    Tokenbank values and daily stats stored under both codes are summed. Cache profiles and the text
+    index are derived data: their entries under the old code are dropped and rebuilt.
+    Safe to rerun. Returns the number of documents changed.
+    """
+    alpha_2_codes = {"$in": [code for code in ALPHA_2_TO_3 if normalize_language(code)]}
+    changed = 0
+    for collection in (
+        exercises_collection, attempts_collection, exercise_cache, seen_exercises_collection,
+        text_info_collection, tokenbank_collection
+    ):
+        for code in await collection.distinct("language", {"language": alpha_2_codes}):
+            result = await collection.update_many({"language": code}, {"$set": {"language": normalize_language(code)}})
+            changed += result.modified_count
+
+    # Unique per language: merged into any document already stored under the new code.
+    # Each old document is deleted before it is merged, so an interrupted run cannot count it twice.
+    async for token in tokenbank_tokens_collection.find({"language": alpha_2_codes}):
+        await tokenbank_tokens_collection.delete_one({"_id": token["_id"]})
+        await tokenbank_tokens_collection.update_one(
+            {"user_id": token["user_id"], "language": normalize_language(token["language"]), "token": token["token"]},
+            {"$inc": {"value": token["value"]}},
+            upsert=True
+        )
+        changed += 1
+    async for day in daily_stats_collection.find({"language": alpha_2_codes}):
+        increments = {
+            field: day[field] for field in ("attempts", "completions", "skips", "total_time_spent_ms") if field in day
+        }
+        for exercise_type, counts in day.get("by_type", {}).items():
+            for counter, value in counts.items():
+                increments[f"by_type.{exercise_type}.{counter}"] = value
+        await daily_stats_collection.delete_one({"_id": day["_id"]})
+        await daily_stats_collection.update_one(
+            {"user_id": day["user_id"], "language": normalize_language(day["language"]), "day": day["day"]},
+            {"$inc": increments},
+            upsert=True
+        )
+        changed += 1
+
+    result = await cache_profiles_collection.delete_many({"language": alpha_2_codes})
+    changed += result.deleted_count
+    # Token ids are per language, so texts moved to the new code are indexed again under it
+    for collection in (text_token_index_collection, token_vocabulary_collection, token_texts_collection):
+        await collection.delete_many({"language": alpha_2_codes})
+    await index_existing_texts()
+    return changed
+
+async def main():
+    print(f"Deleted {await dedupe_attempts()} duplicate attempts")
+    print(f"Migrated {await migrate_language_codes()} documents to ISO 639-3 language codes")
+    print(f"Migrated {await migrate_legacy_text_sources()} text sources")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,42 +1,259 @@
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase, AsyncIOMotorGridFSBucket
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+from typing import Callable, Dict, List, Optional, Tuple
+import asyncio
 import logging
-import os
-from dotenv import load_dotenv
+import time
+from settings import get_settings
+from metrics import MongoCommandMetrics
 
 logger = logging.getLogger("uvicorn")
 
-# Load environment variables
-load_dotenv("secret.env")
+# Created on first use (normally by connect() in the app's lifespan), so importing
+# this module opens no connections and needs no configuration
+client: Optional[AsyncIOMotorClient] = None
+startup_timings: Dict[str, float] = {}  # Milliseconds taken by each step of the last connect()
 
-MONGODB_URL = os.getenv("MONGODB_URL")
-if not MONGODB_URL:
-    logger.error("MONGODB_URL environment variable is not set")
-    exit(1)
+def get_client() -> AsyncIOMotorClient:
+    global client
+    if client is None:
+        settings = get_settings()
+        settings.require("mongodb_url")
+        client = AsyncIOMotorClient(
+            settings.mongodb_url,
+            maxPoolSize=settings.mongodb_max_pool_size,
+            minPoolSize=settings.mongodb_min_pool_size,
+            maxIdleTimeMS=settings.mongodb_max_idle_time_ms,
+            serverSelectionTimeoutMS=settings.mongodb_server_selection_timeout_ms,
+            event_listeners=[MongoCommandMetrics()]
+        )
+    return client
 
-client = AsyncIOMotorClient(MONGODB_URL)
-db = client.lexaglot
+def get_database() -> AsyncIOMotorDatabase:
+    return get_client()[get_settings().mongodb_database]
+
+class LazyHandle:
+    """
+    Stands in for a handle on the database (a collection, a GridFS bucket) so it can be imported
+    before the client exists. The handle is built on first use, and rebuilt if the client is replaced.
+    """
+
+    def __init__(self, build: Callable[[AsyncIOMotorDatabase], object], name: Optional[str] = None):
+        self.name = name
+        self._build = build
+        self._client = None
+        self._handle = None
+
+    def __getattr__(self, attr):
+        current = get_client()
+        if self._client is not current:
+            self._handle = self._build(get_database())
+            self._client = current
+        return getattr(self._handle, attr)
+
+def lazy_collection(name: str) -> LazyHandle:
+    return LazyHandle(lambda database: database[name], name)
 
 # Collections
-exercises_collection = db.exercises
-users_collection = db.users
-attempts_collection = db.attempts
-refresh_tokens_collection = db.refresh_tokens
-tokenbank_collection = db.tokenbank
-exercise_cache = db.exercise_cache
-text_info_collection = db.text_info
-text_source_collection = db.text_source
+exercises_collection = lazy_collection("exercises")
+users_collection = lazy_collection("users")
+attempts_collection = lazy_collection("attempts")
+refresh_tokens_collection = lazy_collection("refresh_tokens")
+tokenbank_collection = lazy_collection("tokenbank")  # Legacy one-document-per-user tokenbanks
+tokenbank_tokens_collection = lazy_collection("tokenbank_tokens")
+exercise_cache = lazy_collection("exercise_cache")
+seen_exercises_collection = lazy_collection("seen_exercises")
+text_info_collection = lazy_collection("text_info")
+text_source_collection = lazy_collection("text_source")  # Legacy single-document text sources
+replenish_leases_collection = lazy_collection("replenish_leases")
+counters_collection = lazy_collection("counters")
+token_vocabulary_collection = lazy_collection("token_vocabulary")
+token_texts_collection = lazy_collection("token_texts")
+text_token_index_collection = lazy_collection("text_token_index")
+cache_profiles_collection = lazy_collection("cache_profiles")
+jobs_collection = lazy_collection("jobs")
+exercise_archive_collection = lazy_collection("exercise_archive")  # Compressed old exercises (see retention.py)
+daily_stats_collection = lazy_collection("daily_stats")  # Per user/language/day attempt rollups (see stats.py)
+
+USED_CACHE_ENTRY_TTL_SECONDS = 24 * 3600  # How long a cache entry is kept after its exercise is attempted
+
+# Text source content, stored as fixed-size chunks (text_source.files / text_source.chunks)
+TEXT_SOURCE_BUCKET = "text_source"
+text_source_bucket = LazyHandle(lambda database: AsyncIOMotorGridFSBucket(database, bucket_name=TEXT_SOURCE_BUCKET))
+
+# Index manifest, applied at startup. Every query shape in the codebase must be served
+# by one of these (see query_plans.py).
+INDEXES = {
+    users_collection.name: [
+        IndexModel([("username", ASCENDING)], unique=True),
+    ],
+    refresh_tokens_collection.name: [
+        # TTL index for refresh tokens
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+        IndexModel([("token_hash", ASCENDING)], unique=True, partialFilterExpression={"token_hash": {"$exists": True}}),
+        # Plain-text tokens from before hashing; can go once they have all expired
+        IndexModel([("token", ASCENDING)]),
+    ],
+    replenish_leases_collection.name: [
+        # TTL index so abandoned replenish leases get cleaned up
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+    exercises_collection.name: [
+        # Shared exercise pool: identical generations are stored once
+        IndexModel(
+            [("content_hash", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"content_hash": {"$exists": True}}
+        ),
+        IndexModel([("language", ASCENDING), ("tokens", ASCENDING), ("type", ASCENDING)]),
+        # Exercises marked for the archive (see retention.py)
+        IndexModel([("archiving", ASCENDING)], sparse=True),
+    ],
+    seen_exercises_collection.name: [
+        IndexModel([("user_id", ASCENDING), ("exercise_id", ASCENDING)], unique=True),
+        IndexModel([("user_id", ASCENDING), ("language", ASCENDING), ("token", ASCENDING)]),
+    ],
+    exercise_cache.name: [
+        IndexModel([("user_id", ASCENDING), ("language", ASCENDING), ("used", ASCENDING), ("created_at", ASCENDING)]),
+        # TTL index so used entries get cleaned up; also finds legacy used entries without used_at
+        IndexModel([("used_at", ASCENDING)], expireAfterSeconds=USED_CACHE_ENTRY_TTL_SECONDS),
+        # Archiving skips exercises still waiting in a cache
+        IndexModel([("exercise_id", ASCENDING)], partialFilterExpression={"used": False}),
+    ],
+    attempts_collection.name: [
+        # One attempt per user and exercise; makes attempt recording idempotent. Attempts recorded
+        # before it existed may have duplicates, which `python database.py` removes: run it before
+        # deploying over existing data, or building this index fails and the API does not start
+        IndexModel([("user_id", ASCENDING), ("exercise_id", ASCENDING)], unique=True),
+        IndexModel([("user_id", ASCENDING), ("language", ASCENDING), ("completed_at", ASCENDING)]),
+        # Archiving only moves exercises that have been attempted
+        IndexModel([("exercise_id", ASCENDING)]),
+    ],
+    tokenbank_tokens_collection.name: [
+        IndexModel([("user_id", ASCENDING), ("language", ASCENDING), ("token", ASCENDING)], unique=True),
+        # Lowest-valued tokens first, for next-token selection
+        IndexModel([("user_id", ASCENDING), ("language", ASCENDING), ("value", ASCENDING), ("token", ASCENDING)]),
+    ],
+    text_info_collection.name: [
+        # Keyset pagination of /texts walks these in _id order
+        IndexModel([("language", ASCENDING), ("type", ASCENDING), ("_id", ASCENDING)]),
+        IndexModel([("language", ASCENDING), ("_id", ASCENDING)]),
+        IndexModel([("type", ASCENDING), ("_id", ASCENDING)]),
+    ],
+    text_source_collection.name: [
+        IndexModel([("text_info_id", ASCENDING)]),
+    ],
+    token_vocabulary_collection.name: [
+        IndexModel([("language", ASCENDING), ("token", ASCENDING)], unique=True),
+    ],
+    token_texts_collection.name: [
+        IndexModel([("language", ASCENDING), ("token_id", ASCENDING)], unique=True),
+    ],
+    text_token_index_collection.name: [
+        IndexModel([("language", ASCENDING), ("updated_at", ASCENDING)]),
+    ],
+    counters_collection.name: [
+        # TTL index so per-minute generation budget counters get cleaned up
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+    cache_profiles_collection.name: [
+        # Inactive-cache sweep
+        IndexModel([("shrunk", ASCENDING), ("last_attempt_at", ASCENDING)]),
+    ],
+    jobs_collection.name: [
+        # Claiming: highest priority first, then oldest
+        IndexModel([("status", ASCENDING), ("priority", DESCENDING), ("run_at", ASCENDING)]),
+        # Expired lease sweep
+        IndexModel([("status", ASCENDING), ("lease_expires_at", ASCENDING)]),
+        # At most one queued job per dedupe key
+        IndexModel([("dedupe_key", ASCENDING)], unique=True, partialFilterExpression={"dedupe_key": {"$exists": True}}),
+        # TTL index so finished jobs get cleaned up
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+    daily_stats_collection.name: [
+        IndexModel([("user_id", ASCENDING), ("language", ASCENDING), ("day", ASCENDING)], unique=True),
+    ],
+    # Same indexes GridFS creates on first upload, so reads are covered before that
+    f"{TEXT_SOURCE_BUCKET}.files": [
+        IndexModel([("filename", ASCENDING), ("uploadDate", ASCENDING)]),
+    ],
+    f"{TEXT_SOURCE_BUCKET}.chunks": [
+        IndexModel([("files_id", ASCENDING), ("n", ASCENDING)], unique=True),
+    ],
+}
+
+# What makes two indexes different, for comparing the manifest against list_indexes
+INDEX_OPTIONS = ("key", "unique", "sparse", "partialFilterExpression", "expireAfterSeconds")
+
+def index_matches(existing: Optional[dict], index: IndexModel) -> bool:
+    """Whether an index from list_indexes has exactly the manifest index's keys and options"""
+    if existing is None:
+        return False
+    return all(existing.get(option) == index.document.get(option) for option in INDEX_OPTIONS)
+
+async def get_index_changes(collection_name: str) -> Tuple[List[str], List[IndexModel]]:
+    """
+    The indexes to drop from a collection the manifest owns (ones it does not list, and ones whose
+    options changed), and the manifest indexes to create
+    """
+    existing = {index["name"]: index async for index in get_database()[collection_name].list_indexes()}
+    manifest = {index.document["name"]: index for index in INDEXES[collection_name]}
+    to_create = [index for name, index in manifest.items() if not index_matches(existing.get(name), index)]
+    to_drop = [
+        name for name in existing
+        if name != "_id_" and (name not in manifest or not index_matches(existing[name], manifest[name]))
+    ]
+    return to_drop, to_create
+
+async def create_indexes() -> int:
+    """
+    Bring each collection's indexes in line with the manifest: drop indexes it does not list or
+    whose options changed, and create the missing ones, so a warm start only lists indexes.
+    Returns how many were created.
+    """
+    database = get_database()
+    changes = await asyncio.gather(*(get_index_changes(name) for name in INDEXES))
+    created = 0
+    for collection_name, (to_drop, to_create) in zip(INDEXES, changes):
+        for name in to_drop:
+            logger.warning(f"Dropping index {collection_name}.{name}, which is not in the index manifest as it is")
+            try:
+                await database[collection_name].drop_index(name)
+            except OperationFailure as e:
+                # Another process starting up dropped it first
+                if e.code != 27:  # IndexNotFound
+                    raise
+        if to_create:
+            await database[collection_name].create_indexes(to_create)
+            created += len(to_create)
+    return created
 
 async def connect():
+    """Create the client, check the connection and apply the index manifest, timing each step"""
+    startup_timings.clear()
+    step_started = time.perf_counter()
+
+    def step_done(step: str):
+        nonlocal step_started
+        now = time.perf_counter()
+        startup_timings[f"{step}_ms"] = (now - step_started) * 1000
+        step_started = now
+
     try:
+        get_client()
+        step_done("client")
         await client.admin.command('ping')
-        # Create unique index on username
-        await users_collection.create_index("username", unique=True)
-        # Create TTL index for refresh tokens
-        await refresh_tokens_collection.create_index("expires_at", expireAfterSeconds=0)
-        logger.info("Successfully connected to MongoDB")
+        step_done("ping")
+        created = await create_indexes()
+        step_done("indexes")
+        logger.info(f"Successfully connected to MongoDB ({created} indexes created)")
     except Exception as e:
         logger.error(f"Error connecting to MongoDB: {e}")
         exit(1)
 
 async def close():
-    client.close() 
\ No newline at end of file
+    global client
+    if client is not None:
+        client.close()
+        client = None
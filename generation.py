@@ -1,15 +1,31 @@
-from typing import Optional
-from models import Exercise, TranslateExercise, MatchingExercise, FillBlankExercise, AudioTranscribeExercise
+from abc import ABC, abstractmethod
+from typing import List, Optional, Set, Tuple, Union
+from models import Exercise, GenerationRequest, TranslateExercise, MatchingExercise, FillBlankExercise, AudioTranscribeExercise
 from recommendation import get_next_exercise_type
+from metrics import GENERATION_BATCH_LATENCY, GENERATION_BATCH_SIZE, GENERATION_REQUEST_LATENCY
+import asyncio
+import hashlib
+import time
 
-async def generate_exercise(language: str, token: Optional[str] = None) -> Exercise:
+GENERATION_MAX_BATCH_SIZE = 32  # Most requests sent to the backend in one call
+GENERATION_MAX_WAIT_MS = 5  # How long a request may wait for others to join its batch
+GENERATION_LATENCY_ESTIMATE_SECONDS = 2.0  # Assumed backend latency until one has been measured
+GENERATION_LATENCY_SMOOTHING = 0.2  # Weight of each new batch in the moving average of backend latency
+
+class GeneratorBackend(ABC):
     """
-    Simulate exercise generation. In reality, this would call an AI model.
-    Returns a predefined exercise for demonstration.
+    Generates exercises in batches. Returns one result per request, in order;
+    a result is an exception if only that request failed.
+    """
+
+    @abstractmethod
+    async def generate_batch(self, requests: List[GenerationRequest]) -> List[Union[Exercise, BaseException]]:
+        ...
+
+def build_template_exercise(language: str, exercise_type: str) -> Exercise:
+    """
+    Build a predefined exercise of the given type for demonstration.
     """
-    # Get recommended exercise type for this user and language
-    exercise_type = await get_next_exercise_type(None if token is None else token, language)
-    
     if exercise_type == "translate":
         data = TranslateExercise(
             input_language=language,
@@ -53,5 +69,130 @@ async def generate_exercise(language: str, token: Optional[str] = None) -> Exerc
             input_sentence="我 {} 去商店",
             correct_fills=["要", "想", "會"]
         )
-    
-    return Exercise(type=exercise_type, language=language, data=data)
\ No newline at end of file
+
+    return Exercise(type=exercise_type, language=language, data=data)
+
+class TemplateGeneratorBackend(GeneratorBackend):
+    """
+    Simulates generation with predefined exercises. In reality, this would call an AI model.
+    """
+
+    async def generate_batch(self, requests: List[GenerationRequest]) -> List[Union[Exercise, BaseException]]:
+        return [build_template_exercise(request.language, request.exercise_type) for request in requests]
+
+class FakeGeneratorBackend(TemplateGeneratorBackend):
+    """
+    Deterministic local stand-in for a batched model backend, for benchmarking.
+    Each call takes latency_s plus per_item_latency_s per request, and at most max_concurrent_calls
+    run at once, like a rate-limited model endpoint. Each exercise is tagged with a hash of its
+    request so identical requests give identical results.
+    """
+
+    def __init__(self, latency_s: float = 0.5, per_item_latency_s: float = 0.01, max_concurrent_calls: int = 4):
+        self.latency_s = latency_s
+        self.per_item_latency_s = per_item_latency_s
+        self.calls = 0
+        self.requests = 0
+        self._capacity = asyncio.Semaphore(max_concurrent_calls)
+
+    async def generate_batch(self, requests: List[GenerationRequest]) -> List[Union[Exercise, BaseException]]:
+        self.calls += 1
+        self.requests += len(requests)
+        async with self._capacity:
+            await asyncio.sleep(self.latency_s + self.per_item_latency_s * len(requests))
+        exercises = await super().generate_batch(requests)
+        for request, exercise in zip(requests, exercises):
+            key = f"{request.language}|{request.token}|{request.exercise_type}"
+            exercise.generation_key = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+        return exercises
+
+class MicroBatcher:
+    """
+    Collects generation requests from concurrent callers (e.g. replenishers for different users)
+    for up to max_wait_ms, or until max_batch_size are waiting, and sends them as one backend call.
+    """
+
+    def __init__(
+        self,
+        backend: GeneratorBackend,
+        max_batch_size: int = GENERATION_MAX_BATCH_SIZE,
+        max_wait_ms: float = GENERATION_MAX_WAIT_MS
+    ):
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._pending: List[Tuple[GenerationRequest, asyncio.Future]] = []
+        self._flush_timer: Optional[asyncio.TimerHandle] = None
+        self._batch_tasks: Set[asyncio.Task] = set()  # Referenced until done so they are not garbage collected
+        self.average_latency_s = GENERATION_LATENCY_ESTIMATE_SECONDS  # Of successful backend calls
+
+    async def submit(self, request: GenerationRequest) -> Exercise:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((request, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_timer is None:
+            self._flush_timer = loop.call_later(self.max_wait_ms / 1000, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._run_batch(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _run_batch(self, batch: List[Tuple[GenerationRequest, asyncio.Future]]):
+        GENERATION_BATCH_SIZE.observe(len(batch))
+        started = time.perf_counter()
+        outcome = "success"
+        try:
+            results = await self.backend.generate_batch([request for request, _ in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(f"Generator backend returned {len(results)} results for {len(batch)} requests")
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            outcome = "error"
+            results = [e] * len(batch)
+        duration = time.perf_counter() - started
+        GENERATION_BATCH_LATENCY.labels(outcome).observe(duration)
+        if outcome == "success":
+            self.average_latency_s += GENERATION_LATENCY_SMOOTHING * (duration - self.average_latency_s)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+_batcher = MicroBatcher(TemplateGeneratorBackend())
+
+def set_generator_backend(
+    backend: GeneratorBackend,
+    max_batch_size: int = GENERATION_MAX_BATCH_SIZE,
+    max_wait_ms: float = GENERATION_MAX_WAIT_MS
+):
+    """Replace the backend (and batching settings) used by generate_exercise"""
+    global _batcher
+    _batcher = MicroBatcher(backend, max_batch_size, max_wait_ms)
+
+def generation_latency() -> float:
+    """Moving average of how long the generator backend takes to answer, in seconds"""
+    return _batcher.average_latency_s
+
+async def generate_exercise(language: str, token: Optional[str] = None) -> Exercise:
+    """
+    Generate one exercise. Concurrent calls are batched into single backend calls.
+    """
+    # Get recommended exercise type for this user and language
+    exercise_type = await get_next_exercise_type(None if token is None else token, language)
+    with GENERATION_REQUEST_LATENCY.time():
+        return await _batcher.submit(GenerationRequest(language=language, token=token, exercise_type=exercise_type))
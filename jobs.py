@@ -0,0 +1,220 @@
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from typing import Any, Dict, List, Optional
+import random
+from db import jobs_collection
+from metrics import JOBS_ENQUEUED
+
+# A durable job queue in the jobs collection. A job document looks like:
+#   {type, payload, priority, status, attempts, max_attempts, run_at, dedupe_key, job_key,
+#    owner, lease_expires_at, last_error, created_at, finished_at, expires_at}
+# status goes queued -> running -> done, or back to queued (with a backoff delay in run_at)
+# when an attempt fails, until max_attempts is reached and it is marked failed.
+# A worker holds a running job under a lease; a job whose lease expires without being
+# extended (e.g. its worker died) becomes visible to other workers again.
+# dedupe_key is only set while a job is queued; job_key keeps it, so it can be restored when
+# the job is queued again for a retry.
+
+URGENT_PRIORITY = 10  # For users who have run out of exercises and are waiting
+DEFAULT_PRIORITY = 0
+DEFAULT_MAX_ATTEMPTS = 5
+JOB_LEASE_SECONDS = 60  # Visibility timeout: how long a claimed job is hidden from other workers
+RETRY_BASE_SECONDS = 2  # First retry delay; doubles with every failed attempt
+RETRY_MAX_SECONDS = 300
+FINISHED_JOB_RETENTION = timedelta(days=1)  # Done jobs are kept this long for inspection
+FAILED_JOB_RETENTION = timedelta(days=7)
+
+async def enqueue_job(
+    type: str,
+    payload: Dict[str, Any],
+    priority: int = DEFAULT_PRIORITY,
+    dedupe_key: Optional[str] = None,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS
+):
+    """
+    Queue a job. With a dedupe_key, a job that is already queued under the same key (including
+    one waiting to be retried) is reused instead of adding another: it takes the new payload and
+    the higher of the two priorities.
+    """
+    now = datetime.utcnow()
+    job = {
+        "type": type,
+        "payload": payload,
+        "status": "queued",
+        "attempts": 0,
+        "max_attempts": max_attempts,
+        "run_at": now,
+        "created_at": now
+    }
+    JOBS_ENQUEUED.labels(type).inc()
+    if dedupe_key is None:
+        await jobs_collection.insert_one({**job, "priority": priority})
+        return
+    try:
+        await jobs_collection.update_one(
+            {"dedupe_key": dedupe_key, "status": "queued"},
+            {
+                # status comes from the filter
+                "$setOnInsert": {
+                    **{key: value for key, value in job.items() if key not in ("status", "payload")},
+                    "job_key": dedupe_key
+                },
+                "$set": {"payload": payload},
+                "$max": {"priority": priority}
+            },
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # A concurrent enqueue with the same key won the upsert; it covers this one
+        pass
+
+async def claim_job(owner: str, types: List[str]) -> Optional[dict]:
+    """
+    Claim the highest-priority job that is due, leasing it to owner for JOB_LEASE_SECONDS.
+    Returns None if there is nothing to do.
+    """
+    now = datetime.utcnow()
+    return await jobs_collection.find_one_and_update(
+        {"status": "queued", "type": {"$in": types}, "run_at": {"$lte": now}},
+        {
+            "$set": {
+                "status": "running",
+                "owner": owner,
+                "claimed_at": now,
+                "lease_expires_at": now + timedelta(seconds=JOB_LEASE_SECONDS)
+            },
+            # Once running, the job no longer absorbs new enqueues; they queue a fresh one
+            "$unset": {"dedupe_key": ""},
+            "$inc": {"attempts": 1}
+        },
+        sort=[("priority", -1), ("run_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def extend_job_lease(job: dict) -> bool:
+    """Extend the lease on a running job. Returns False if the lease was lost to another worker."""
+    result = await jobs_collection.update_one(
+        {"_id": job["_id"], "owner": job["owner"], "status": "running"},
+        {"$set": {"lease_expires_at": datetime.utcnow() + timedelta(seconds=JOB_LEASE_SECONDS)}}
+    )
+    return result.modified_count == 1
+
+async def complete_job(job: dict):
+    now = datetime.utcnow()
+    await jobs_collection.update_one(
+        {"_id": job["_id"], "owner": job["owner"], "status": "running"},
+        {"$set": {"status": "done", "finished_at": now, "expires_at": now + FINISHED_JOB_RETENTION}}
+    )
+
+def retry_delay(attempts: int) -> float:
+    """Exponential backoff with full jitter, in seconds"""
+    return random.uniform(0, min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS))
+
+async def fail_job(job: dict, error: str) -> bool:
+    """
+    Record a failed attempt. The job is retried after a backoff delay, or marked failed once
+    it has used max_attempts. Returns whether it will be retried.
+    """
+    now = datetime.utcnow()
+    retry = job["attempts"] < job["max_attempts"]
+    if retry:
+        update = {"status": "queued", "run_at": now + timedelta(seconds=retry_delay(job["attempts"]))}
+    else:
+        update = {"status": "failed", "finished_at": now, "expires_at": now + FAILED_JOB_RETENTION}
+    job_filter = {"_id": job["_id"], "owner": job["owner"], "status": "running"}
+    update = {"$set": {**update, "last_error": error}, "$unset": {"owner": "", "lease_expires_at": ""}}
+    if retry:
+        await _requeue(job, job_filter, update)
+    else:
+        await jobs_collection.update_one(job_filter, update)
+    return retry
+
+async def release_job(job: dict):
+    """Put a running job back in the queue without counting the attempt, e.g. when its worker shuts down"""
+    await _requeue(
+        job,
+        {"_id": job["_id"], "owner": job["owner"], "status": "running"},
+        {
+            "$set": {"status": "queued", "run_at": datetime.utcnow()},
+            "$unset": {"owner": "", "lease_expires_at": ""},
+            "$inc": {"attempts": -1}
+        }
+    )
+
+async def _requeue(job: dict, job_filter: dict, update: dict) -> bool:
+    """
+    Apply an update that puts a running job back in the queue, restoring its dedupe_key so new
+    enqueues fold into it again. If a job has been queued under the same key in the meantime, that
+    one covers this job's work: it takes the higher of the two priorities and this job is closed.
+    Returns whether the job was found.
+    """
+    while True:
+        if not job.get("job_key"):
+            result = await jobs_collection.update_one(job_filter, update)
+            return result.modified_count == 1
+        try:
+            result = await jobs_collection.update_one(
+                job_filter, {**update, "$set": {**update["$set"], "dedupe_key": job["job_key"]}}
+            )
+            return result.modified_count == 1
+        except DuplicateKeyError:
+            pass
+        queued = await jobs_collection.find_one_and_update(
+            {"dedupe_key": job["job_key"], "status": "queued"},
+            {"$max": {"priority": job["priority"]}},
+            projection={"_id": 1}
+        )
+        if queued is None:
+            # It was claimed before it could take this job over; try restoring the key again
+            continue
+        now = datetime.utcnow()
+        result = await jobs_collection.update_one(
+            job_filter,
+            {
+                "$set": {
+                    **{key: value for key, value in update["$set"].items() if key == "last_error"},
+                    "status": "done",
+                    "superseded_by": queued["_id"],
+                    "finished_at": now,
+                    "expires_at": now + FINISHED_JOB_RETENTION
+                },
+                "$unset": {"owner": "", "lease_expires_at": ""}
+            }
+        )
+        return result.modified_count == 1
+
+async def requeue_expired_jobs() -> int:
+    """
+    Return running jobs whose lease has expired to the queue, or mark them failed if they have
+    used all their attempts. Returns how many were requeued or failed.
+    """
+    now = datetime.utcnow()
+    expired = {"status": "running", "lease_expires_at": {"$lte": now}}
+    failed = await jobs_collection.update_many(
+        {**expired, "$expr": {"$gte": ["$attempts", "$max_attempts"]}},
+        {
+            "$set": {"status": "failed", "finished_at": now, "expires_at": now + FAILED_JOB_RETENTION, "last_error": "Lease expired"},
+            "$unset": {"owner": "", "lease_expires_at": ""}
+        }
+    )
+    # One at a time, so each gets its own dedupe_key back
+    requeued = 0
+    async for job in jobs_collection.find(expired, projection={"_id": 1, "priority": 1, "job_key": 1}):
+        requeued += await _requeue(
+            job,
+            {**expired, "_id": job["_id"]},
+            {
+                "$set": {"status": "queued", "run_at": now, "last_error": "Lease expired"},
+                "$unset": {"owner": "", "lease_expires_at": ""}
+            }
+        )
+    return failed.modified_count + requeued
+
+async def count_queued_jobs() -> Dict[str, int]:
+    """Number of queued jobs by type"""
+    cursor = jobs_collection.aggregate([
+        {"$match": {"status": "queued"}},
+        {"$group": {"_id": "$type", "count": {"$sum": 1}}}
+    ])
+    return {doc["_id"]: doc["count"] async for doc in cursor}
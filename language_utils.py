@@ -1,36 +1,58 @@
-from pycountry import languages
+from fastapi import HTTPException
 from typing import Optional
+from language_registry import ALPHA_2_TO_3, ISO_639_3_NAMES, LANGUAGE_NAMES
 
 def get_language_name(iso_code: str) -> Optional[str]:
     """
     Convert ISO 639-3 language code to its full name.
     Returns None if the code is not found.
-    
+
     Example:
         get_language_name('cmn') -> 'Mandarin Chinese'
         get_language_name('spa') -> 'Spanish'
     """
-    try:
-        return languages.get(alpha_3=iso_code).name
-    except AttributeError:
-        return None
-
-# Add custom mappings for languages that might not be in pycountry
-CUSTOM_LANGUAGE_NAMES = {   
-    'klg': 'Klingon',    # Star Trek - Has official dictionary, institute, and many speakers
-    'qya': 'Quenya',     # Tolkien's High Elvish - Extensively documented by Tolkien himself
-    'sjn': 'Sindarin',   # Tolkien's Elvish - Well documented with substantial vocabulary
-    'dth': 'Dothraki',   # Game of Thrones - Created by linguist David Peterson, has official dictionary
-    'hva': 'High Valyrian' # Game of Thrones - Created by Peterson, has Duolingo course and extensive documentation
-}
+    return ISO_639_3_NAMES.get(iso_code)
 
 def get_language_name_with_fallback(iso_code: str) -> str:
     """
     Get language name with fallback to custom mappings.
     Returns the ISO code itself if no name is found.
     """
-    if iso_code in CUSTOM_LANGUAGE_NAMES:
-        return CUSTOM_LANGUAGE_NAMES[iso_code]
-    
-    name = get_language_name(iso_code)
-    return name if name else iso_code 
\ No newline at end of file
+    return LANGUAGE_NAMES.get(iso_code, iso_code)
+
+def normalize_language(code: str) -> Optional[str]:
+    """
+    The ISO 639-3 (or custom) code for a language code, accepting any case and ISO 639-1 codes.
+    Returns None if the code is not a known language. Data stored under ISO 639-1 codes before
+    they were normalized is moved to the new codes by `python database.py`.
+
+    Example:
+        normalize_language('CMN') -> 'cmn'
+        normalize_language('es') -> 'spa'
+    """
+    code = code.strip().lower()
+    code = ALPHA_2_TO_3.get(code, code)
+    return code if code in LANGUAGE_NAMES else None
+
+def validate_language(code: str) -> str:
+    """Normalize a language code, raising ValueError if it is unknown (for pydantic validators)"""
+    language = normalize_language(code)
+    if language is None:
+        raise ValueError(f"Unknown language code: {code}")
+    return language
+
+async def valid_language(language: str) -> str:
+    """
+    Dependency for endpoints taking a language (as a path or query parameter):
+    returns the normalized code, or raises 422 if it is unknown
+    """
+    normalized = normalize_language(language)
+    if normalized is None:
+        raise HTTPException(status_code=422, detail=f"Unknown language code: {language}")
+    return normalized
+
+async def optional_language(language: Optional[str] = None) -> Optional[str]:
+    """Like valid_language, for endpoints where the language is an optional filter"""
+    if language is None:
+        return None
+    return await valid_language(language)
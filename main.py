@@ -1,56 +1,114 @@
-from fastapi import FastAPI, Depends, HTTPException, BackgroundTasks
+import time
+IMPORT_STARTED = time.perf_counter()  # For the startup timing report
+
+from fastapi import FastAPI, Depends, HTTPException, Header, Request
 from contextlib import asynccontextmanager
-from models import Exercise, ExerciseAttempt, AttemptDetail, TextInfo, TextSource
+from models import (
+    Exercise, ExerciseAttempt, ExerciseAttemptSubmission, AttemptDetail, TextInfo, TextSource,
+    ExerciseOut, AttemptOut, AttemptResult, TextInfoOut, ReadableTextOut, StatsOut
+)
 import database
-from database import DEFAULT_CACHE_SIZE
+from cache_sizing import get_cache_sizing
 from auth_router import router as auth_router
 from auth import get_current_active_user
 from auth_models import User
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
 from datetime import datetime
 import random 
 from generation import generate_exercise
 from recommendation import get_next_token
-from tokenbank import get_user_tokenbank
-from fastapi.responses import JSONResponse
+from tokenbank import get_user_tokenbank, get_known_tokens, flush_token_deltas, migrate_legacy_tokenbanks
+from text_index import rank_texts_by_coverage
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from serialization import MongoJSONResponse, dumps
+from language_utils import valid_language, optional_language
+from settings import get_settings
+from db import startup_timings
+from worker import Worker
+from retention import run_retention_sweeper
+from stats import MAX_STATS_DAYS, STATS_DAYS, get_daily_stats, total_stats
+from metrics import EXERCISE_CACHE_REQUESTS, MetricsMiddleware, render_metrics, set_startup_timings
+import asyncio
+import json
+import logging
+import re
+
+logger = logging.getLogger("uvicorn")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
+    started = time.perf_counter()
+    get_settings().require("jwt_secret_key")
+    settings_ms = (time.perf_counter() - started) * 1000
     await database.connect_to_mongo()
+    # Users whose tokenbank is still in the legacy layout would otherwise read an empty one
+    migrated = await migrate_legacy_tokenbanks()
+    if migrated:
+        logger.info(f"Migrated {migrated} legacy tokenbanks")
+    # One line per boot, so boot time can be tracked across releases
+    timings = {
+        "import_ms": IMPORT_MS,
+        "settings_ms": settings_ms,
+        **startup_timings,
+        "startup_ms": (time.perf_counter() - started) * 1000
+    }
+    app.state.startup_timings = {step: round(ms, 1) for step, ms in timings.items()}
+    set_startup_timings(timings)
+    logger.info(f"Startup timings: {json.dumps(app.state.startup_timings)}")
+    cache_sweeper = asyncio.create_task(database.run_cache_sweeper())
+    retention_sweeper = asyncio.create_task(run_retention_sweeper(database.WORKER_ID))
+    # Job loops in this process; dedicated workers (worker.py) can take over with API_JOB_CONCURRENCY=0
+    job_worker = Worker(get_settings().api_job_concurrency)
+    job_worker_task = asyncio.create_task(job_worker.run()) if job_worker.concurrency > 0 else None
     yield
     # Shutdown
+    cache_sweeper.cancel()
+    retention_sweeper.cancel()
+    await asyncio.gather(cache_sweeper, retention_sweeper, return_exceptions=True)
+    if job_worker_task:
+        job_worker.stop()
+        await job_worker_task
+    await flush_token_deltas()
     await database.close_mongo_connection()
 
 app = FastAPI(
     title="Lexaglot API",
     description="API for Lexaglot language learning application",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=MongoJSONResponse
 )
 
+app.add_middleware(MetricsMiddleware)
+
 # Include authentication router
 app.include_router(auth_router, tags=["authentication"])
 
-@app.post("/exercise")
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus metrics for this worker"""
+    content, content_type = render_metrics()
+    return Response(content, media_type=content_type)
+
+@app.post("/exercise", response_model=ExerciseOut)
 async def create_exercise(exercise: Exercise):
     """Create a new exercise (AI-generated, single-use)"""
     return await database.create_exercise(exercise)
 
-@app.get("/exercise/{id}")
+@app.get("/exercise/{id}", response_model=ExerciseOut)
 async def get_exercise(id: str):
     """Get a specific exercise by ID"""
     return await database.get_exercise_by_id(id)
 
-@app.post("/exercise-attempt/{exercise_id}")
+@app.post("/exercise-attempt/{exercise_id}", response_model=AttemptOut)
 async def record_attempt(
     exercise_id: str,
-    language: str,
     started_at: datetime,
     total_time_spent_ms: int,
     was_completed: bool,
     attempt_history: List[Dict[str, Any]],
-    background_tasks: BackgroundTasks,
+    language: str = Depends(valid_language),
     current_user: User = Depends(get_current_active_user)
 ):
     """
@@ -79,15 +137,39 @@ async def record_attempt(
     # Get the current token for replenishment
     token = await get_next_token(str(current_user.id), language)
     if token:
-        background_tasks.add_task(
-            database.replenish_cache,
-            language,
-            str(current_user.id),
-            token
-        )
+        await database.enqueue_replenish(language, str(current_user.id), token)
     
     return result
 
+@app.post("/exercise-attempts", response_model=List[AttemptResult], response_model_exclude_none=True)
+async def record_attempts(
+    submissions: List[ExerciseAttemptSubmission],
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    Record many attempts at once, e.g. from a client that was offline.
+    Returns a result per attempt, in order: "recorded", "duplicate" or "error".
+    """
+    received_at = datetime.utcnow()
+    attempts = [
+        ExerciseAttempt(
+            user_id=str(current_user.id),
+            completed_at=submission.completed_at or received_at,
+            **submission.model_dump(exclude={"completed_at"})
+        )
+        for submission in submissions
+    ]
+
+    results = await database.record_attempts(attempts)
+
+    # Replenish once per language touched by the batch
+    for language in {attempt.language for attempt in attempts}:
+        token = await get_next_token(str(current_user.id), language)
+        if token:
+            await database.enqueue_replenish(language, str(current_user.id), token)
+
+    return results
+
 # @app.get("/user-attempts/{language}")
 # async def get_user_attempts(
 #     language: str,
@@ -98,12 +180,25 @@ async def record_attempt(
 
 @app.get("/tokenbank/{language}")
 async def get_tokenbank(
-    language: str,
+    language: str = Depends(valid_language),
     current_user: User = Depends(get_current_active_user)
 ) -> Dict[str, int]:
     """Get the user's token bank for a specific language"""
     return await get_user_tokenbank(str(current_user.id), language)
 
+@app.get("/stats/{language}", response_model=StatsOut)
+async def get_stats(
+    language: str = Depends(valid_language),
+    days: int = STATS_DAYS,
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    The user's attempt statistics for the last days days (including today), from the daily rollups:
+    one entry per day with attempts, oldest first, and their totals.
+    """
+    daily = await get_daily_stats(str(current_user.id), language, max(1, min(days, MAX_STATS_DAYS)))
+    return {"days": daily, "totals": total_stats(daily)}
+
 # @app.put("/tokenbank/{language}")
 # async def update_tokenbank(
 #     language: str,
@@ -152,18 +247,21 @@ async def get_tokenbank(
 #     count = await database.regenerate_exercise_cache(language, str(current_user.id), token)
 #     return {"cached_exercises": count}
 
-@app.get("/cached-exercises/{language}")
+@app.get("/cached-exercises/{language}", response_model=List[ExerciseOut])
 async def get_cached_exercises(
-    language: str,
-    background_tasks: BackgroundTasks,
+    language: str = Depends(valid_language),
     current_user: User = Depends(get_current_active_user)
 ):
     """Get all unused cached exercises for the current user and language"""
-    # Get all cached exercises
-    exercises = await database.get_all_cached_exercises(language, str(current_user.id))
+    # Get all cached exercises, and how big this user's cache should be
+    exercises, sizing = await asyncio.gather(
+        database.get_all_cached_exercises(language, str(current_user.id)),
+        get_cache_sizing(str(current_user.id), language)
+    )
     
     # If we have no exercises, trigger generation and return a wait message
     if not exercises:
+        EXERCISE_CACHE_REQUESTS.labels("miss").inc()
         token = await get_next_token(str(current_user.id), language)
         if not token:
             raise HTTPException(
@@ -171,32 +269,27 @@ async def get_cached_exercises(
                 detail="No tokens available for practice"
             )
             
-        background_tasks.add_task(
-            database.replenish_cache,
-            language,
-            str(current_user.id),
-            token
-        )
+        # The user is waiting, so this refill is claimed ahead of others
+        await database.enqueue_replenish(language, str(current_user.id), token, urgent=True)
         return JSONResponse(
             status_code=202,
             content={"detail": "Exercises are being generated. Please try again in a few moments."}
         )
     
-    # If we have some exercises but fewer than target, trigger background replenishment
-    elif len(exercises) < DEFAULT_CACHE_SIZE:
+    # If we are down to the refill threshold, refill in the background before the cache runs out
+    elif len(exercises) <= sizing.refill_threshold:
+        EXERCISE_CACHE_REQUESTS.labels("partial").inc()
         token = await get_next_token(str(current_user.id), language)
         if token:
-            background_tasks.add_task(
-                database.replenish_cache,
-                language,
-                str(current_user.id),
-                token
-            )
-    
-    return exercises
+            await database.enqueue_replenish(language, str(current_user.id), token)
+    else:
+        EXERCISE_CACHE_REQUESTS.labels("hit").inc()
+
+    # Hot path: serialize the documents directly rather than validating them against the response model
+    return MongoJSONResponse(exercises)
 
 # Text management endpoints
-@app.post("/text/info")
+@app.post("/text/info", response_model=TextInfoOut)
 async def create_text_info(text_info: TextInfo):
     """Create a new text info entry"""
     return await database.create_text_info(text_info)
@@ -206,7 +299,15 @@ async def create_text_source(text_source: TextSource):
     """Create a new text source entry"""
     return await database.create_text_source(text_source)
 
-@app.get("/text/info/{text_info_id}")
+@app.put("/text/source/{text_info_id}")
+async def upload_text_source(text_info_id: str, request: Request):
+    """
+    Store a text's content from a raw UTF-8 request body, streamed into chunked storage
+    so large texts never have to be held in memory or in a single document
+    """
+    return await database.store_text_source(text_info_id, request.stream())
+
+@app.get("/text/info/{text_info_id}", response_model=TextInfoOut)
 async def get_text_info(text_info_id: str):
     """Get text info by ID"""
     text_info = await database.get_text_info(text_info_id)
@@ -214,15 +315,123 @@ async def get_text_info(text_info_id: str):
         raise HTTPException(status_code=404, detail="Text info not found")
     return text_info
 
+@app.get("/texts/readable/{language}", response_model=List[ReadableTextOut])
+async def list_readable_texts(
+    language: str = Depends(valid_language),
+    limit: int = 20,
+    type: Optional[str] = None,
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    Texts ranked by how many of their tokens are already in the user's token bank, best first.
+    Each text has coverage (0-1), known_tokens and total_tokens added.
+    """
+    known_tokens = await get_known_tokens(str(current_user.id), language)
+    texts = await rank_texts_by_coverage(language, known_tokens, max(1, min(limit, 100)), type)
+    return MongoJSONResponse(texts)
+
+BYTE_RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)")  # A single byte range; anything else is ignored
+
+def parse_byte_range(range_header: str, length: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single-range "bytes=start-end" Range header into a half-open (start, end) span.
+    Returns None for a header that must be ignored (another unit, several ranges or invalid syntax),
+    and raises 416 for a valid range that cannot be satisfied.
+    """
+    match = BYTE_RANGE_RE.fullmatch(range_header.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    first, last = match.groups()
+    if first and last and int(last) < int(first):
+        return None
+    if first:
+        start = int(first)
+        end = min(int(last) + 1, length) if last else length
+    else:
+        # Suffix range: the last N bytes
+        start = max(length - int(last), 0)
+        end = length
+    if start >= end:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{length}"}
+        )
+    return start, end
+
 @app.get("/text/source/{text_info_id}")
-async def get_text_source(text_info_id: str):
-    """Get text source by text_info_id"""
-    text_source = await database.get_text_source(text_info_id)
+async def get_text_source(
+    text_info_id: str,
+    offset: int = 0,
+    limit: Optional[int] = None,
+    range_header: Optional[str] = Header(None, alias="Range")
+):
+    """
+    Stream a text's content as UTF-8 text.
+    A byte span can be requested with an HTTP Range header or with offset/limit (in bytes).
+    """
+    text_source = await database.open_text_source(text_info_id)
     if not text_source:
         raise HTTPException(status_code=404, detail="Text source not found")
-    return text_source
 
-@app.get("/texts")
-async def list_texts(language: Optional[str] = None, type: Optional[str] = None):
-    """List all texts, optionally filtered by language and/or type"""
-    return await database.list_texts(language, type)
\ No newline at end of file
+    length = text_source.length
+    headers = {"Accept-Ranges": "bytes"}
+    status_code = 200
+    byte_range = parse_byte_range(range_header, length) if range_header else None
+    if byte_range:
+        start, end = byte_range
+    else:
+        start = min(max(offset, 0), length)
+        end = length if limit is None else min(start + max(limit, 0), length)
+    if byte_range or start > 0 or end < length:
+        if end <= start:
+            # A partial read of nothing has no valid Content-Range
+            raise HTTPException(
+                status_code=416,
+                detail="Requested range not satisfiable",
+                headers={"Content-Range": f"bytes */{length}"}
+            )
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{length}"
+    headers["Content-Length"] = str(end - start)
+
+    return StreamingResponse(
+        database.read_text_source(text_source, start, end),
+        status_code=status_code,
+        media_type="text/plain; charset=utf-8",
+        headers=headers
+    )
+
+@app.get("/texts", response_model=List[TextInfoOut])
+async def list_texts(
+    language: Optional[str] = Depends(optional_language),
+    type: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: Optional[int] = None,
+    include_tokens: bool = False,
+    stream: bool = False
+):
+    """
+    List texts, optionally filtered by language and/or type.
+    - after: the _id of the last text of the previous page
+    - limit: page size (default and maximum apply unless streaming)
+    - include_tokens: include each text's token list
+    - stream: stream every matching text as NDJSON instead of returning a page
+    """
+    if stream:
+        texts = database.stream_texts(language, type, after, limit, include_tokens)
+        # Validate the cursor before the response starts
+        first = await anext(texts, None)
+
+        async def ndjson():
+            if first is not None:
+                yield dumps(first) + b"\n"
+            async for text in texts:
+                yield dumps(text) + b"\n"
+
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+    texts = await database.list_texts(language, type, after, limit or database.TEXT_PAGE_SIZE, include_tokens)
+    return MongoJSONResponse(texts)
+
+IMPORT_MS = (time.perf_counter() - IMPORT_STARTED) * 1000
@@ -0,0 +1,170 @@
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, REGISTRY, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from pymongo import monitoring
+from typing import Dict, Tuple
+from cache import TTLCache
+import threading
+import time
+
+# Instrumentation, exposed in Prometheus text format on /metrics. Everything is recorded in
+# process memory; with several uvicorn workers each one reports its own series.
+
+# Request latency buckets run from well under a millisecond (cache hits) to slow uploads
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+UNMATCHED_ROUTE = "unmatched"  # Route label for requests that matched no route, so paths cannot blow up cardinality
+# Commands tracked as in flight at once; far above any pool size, it only bounds entries for commands
+# that never got a succeeded or failed event (e.g. their connection was closed mid-flight)
+MAX_IN_FLIGHT_COMMANDS = 10000
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Time to handle a request, including streaming the body",
+    ["method", "route"], buckets=LATENCY_BUCKETS
+)
+REQUESTS = Counter("http_requests", "Requests handled, by response status", ["method", "route", "status"])
+REQUESTS_IN_PROGRESS = Gauge("http_requests_in_progress", "Requests being handled")
+
+MONGO_COMMAND_LATENCY = Histogram(
+    "mongo_command_duration_seconds", "Time for MongoDB to answer a command",
+    ["collection", "command"], buckets=LATENCY_BUCKETS
+)
+MONGO_COMMAND_FAILURES = Counter("mongo_command_failures", "MongoDB commands that failed", ["collection", "command"])
+
+JOBS_ENQUEUED = Counter("jobs_enqueued", "Jobs added to the queue, or merged into a queued job with the same key", ["type"])
+JOBS_QUEUED = Gauge("jobs_queued", "Jobs waiting in the queue, as last counted by this worker", ["type"])
+JOBS_RUNNING = Gauge("jobs_running", "Jobs running in this process", ["type"])
+JOB_QUEUE_WAIT = Histogram(
+    "job_queue_wait_seconds", "Time from a job becoming due to being claimed",
+    ["type"], buckets=LATENCY_BUCKETS
+)
+JOB_DURATION = Histogram(
+    "job_duration_seconds", "Time to run a job",
+    ["type", "outcome"], buckets=LATENCY_BUCKETS
+)
+
+GENERATION_REQUEST_LATENCY = Histogram(
+    "generation_request_duration_seconds", "Time to generate one exercise, including waiting to be batched",
+    buckets=LATENCY_BUCKETS
+)
+GENERATION_BATCH_LATENCY = Histogram(
+    "generation_batch_duration_seconds", "Time for the generator backend to answer one batch",
+    ["outcome"], buckets=LATENCY_BUCKETS
+)
+GENERATION_BATCH_SIZE = Histogram(
+    "generation_batch_size", "Requests per generator backend call",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
+GENERATION_BUDGET_DENIED = Counter(
+    "generation_budget_denied", "Exercises not generated because the shared generation budget was used up", ["urgent"]
+)
+
+EXERCISE_CACHE_REQUESTS = Counter(
+    "exercise_cache_requests", "Reads of a user's exercise cache: hit, partial (down to its refill threshold) or miss (empty)", ["result"]
+)
+RETENTION_DOCUMENTS_REMOVED = Counter(
+    "retention_documents_removed", "Documents deleted or archived by the retention sweep", ["collection"]
+)
+RETENTION_BYTES_RECLAIMED = Counter(
+    "retention_bytes_reclaimed", "BSON bytes of the documents the retention sweep removed", ["collection"]
+)
+RETENTION_BYTES_ARCHIVED = Counter("retention_bytes_archived", "Compressed bytes written to the exercise archive")
+STARTUP_DURATION = Gauge("app_startup_duration_seconds", "Time taken by each step of the last boot", ["step"])
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording latency and status per route. Routes are labelled with their
+    path template (e.g. /tokenbank/{language}), not the requested path.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        REQUESTS_IN_PROGRESS.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            duration = time.perf_counter() - started
+            REQUESTS_IN_PROGRESS.dec()
+            # The router stores the matched route in the scope
+            route = scope.get("route")
+            route_label = getattr(route, "path", UNMATCHED_ROUTE)
+            REQUEST_LATENCY.labels(scope["method"], route_label).observe(duration)
+            REQUESTS.labels(scope["method"], route_label, str(status_code)).inc()
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every command a MongoClient sends, by collection and command name"""
+
+    def __init__(self):
+        # (connection, request id) -> collection of commands in flight, oldest first
+        self._collections: Dict[Tuple[object, int], str] = {}
+        self._lock = threading.Lock()  # Events arrive on the driver's threads
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        target = event.command.get(event.command_name)
+        if not isinstance(target, str):
+            # getMore names its collection separately; database commands have none
+            target = event.command.get("collection", "")
+        with self._lock:
+            self._collections[(event.connection_id, event.request_id)] = target
+            while len(self._collections) > MAX_IN_FLIGHT_COMMANDS:
+                del self._collections[next(iter(self._collections))]
+
+    def _pop(self, event) -> str:
+        with self._lock:
+            return self._collections.pop((event.connection_id, event.request_id), "")
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        collection = self._pop(event)
+        MONGO_COMMAND_LATENCY.labels(collection, event.command_name).observe(event.duration_micros / 1_000_000)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        collection = self._pop(event)
+        MONGO_COMMAND_LATENCY.labels(collection, event.command_name).observe(event.duration_micros / 1_000_000)
+        MONGO_COMMAND_FAILURES.labels(collection, event.command_name).inc()
+
+class CacheCollector:
+    """Reports the hit/miss counters of in-process caches when scraped, so lookups pay nothing extra"""
+
+    def __init__(self):
+        self.caches: Dict[str, TTLCache] = {}
+
+    def collect(self):
+        hits = CounterMetricFamily("cache_hits", "In-process cache hits", labels=["cache"])
+        misses = CounterMetricFamily("cache_misses", "In-process cache misses", labels=["cache"])
+        size = GaugeMetricFamily("cache_entries", "Entries in an in-process cache", labels=["cache"])
+        for name, cache in self.caches.items():
+            stats = cache.stats()
+            hits.add_metric([name], stats["hits"])
+            misses.add_metric([name], stats["misses"])
+            size.add_metric([name], stats["size"])
+        yield hits
+        yield misses
+        yield size
+
+_cache_collector = CacheCollector()
+REGISTRY.register(_cache_collector)
+
+def register_cache(name: str, cache: TTLCache):
+    _cache_collector.caches[name] = cache
+
+def set_startup_timings(timings: Dict[str, float]):
+    """Record a startup timing report (step -> milliseconds)"""
+    for step, ms in timings.items():
+        STARTUP_DURATION.labels(step.removesuffix("_ms")).set(ms / 1000)
+
+def render_metrics() -> Tuple[bytes, str]:
+    """The current metrics in Prometheus text format, and their content type"""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -1,6 +1,18 @@
-from pydantic import BaseModel
-from typing import Dict, List, Union, Optional, Any
-from datetime import datetime
+from pydantic import AfterValidator, BaseModel, BeforeValidator, Field
+from typing import Annotated, Dict, List, Union, Optional, Any
+from datetime import datetime, timezone
+from language_utils import validate_language
+
+# A Mongo ObjectId, returned to clients as a string
+PyObjectId = Annotated[str, BeforeValidator(str)]
+# A language code from a client, normalized to its ISO 639-3 (or custom) code
+LanguageCode = Annotated[str, AfterValidator(validate_language)]
+
+def to_naive_utc(value: datetime) -> datetime:
+    return value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo is not None else value
+
+# A datetime stored as naive UTC, like everything else in Mongo; aware ones are converted
+UtcDatetime = Annotated[datetime, AfterValidator(to_naive_utc)]
 
 class MatchingExercise(BaseModel):
     pairs: Dict[str, str]
@@ -29,10 +41,17 @@ class AudioTranscribeExercise(BaseModel):
 
 class Exercise(BaseModel):
     type: str
-    language: str # The language the user is learning
+    language: LanguageCode # The language the user is learning
     data: Union[MatchingExercise, TranslateExercise, FillBlankExercise, AudioTranscribeExercise]
     model_config = {"extra": "allow"}
 
+class GenerationRequest(BaseModel):
+    """A request for one generated exercise"""
+    language: str
+    token: Optional[str] = None  # The token the exercise should practice
+    exercise_type: str
+    model_config = {"extra": "allow"}
+
 class AttemptDetail(BaseModel):
     timestamp: datetime
     time_spent_ms: int
@@ -43,16 +62,28 @@ class ExerciseAttempt(BaseModel):
     user_id: str
     exercise_id: str
     language: str
-    started_at: datetime  # When they first started the exercise
-    completed_at: datetime  # When they either completed or skipped
+    started_at: UtcDatetime  # When they first started the exercise
+    completed_at: UtcDatetime  # When they either completed or skipped
     was_completed: bool  # True if completed, False if skipped
     total_time_spent_ms: int  # Total time across all attempts
     attempt_history: List[AttemptDetail]  # All attempts made before completion/skip
     model_config = {"extra": "allow"}
 
+class ExerciseAttemptSubmission(BaseModel):
+    """An attempt as submitted by a client, e.g. in a batch synced after being offline"""
+    exercise_id: str
+    language: LanguageCode
+    started_at: datetime
+    completed_at: Optional[datetime] = None  # Defaults to when the server receives it
+    was_completed: bool
+    total_time_spent_ms: int
+    attempt_history: List[AttemptDetail]
+    # Unknown fields are dropped so a client cannot set server-owned ones such as user_id
+    model_config = {"extra": "ignore"}
+
 class TextInfo(BaseModel):
     """Metadata about a text source for language learning"""
-    language: str
+    language: LanguageCode
     name: str
     author: Optional[str]
     length: int  # Number of characters in the text
@@ -66,3 +97,63 @@ class TextSource(BaseModel):
     text_info_id: str  # Reference to the TextInfo document
     content: str  # The full text content
     model_config = {"extra": "allow"}
+
+class ExerciseOut(BaseModel):
+    """An exercise as returned by the API"""
+    id: PyObjectId = Field(alias="_id")
+    type: str
+    language: Optional[str] = None
+    data: Dict[str, Any]
+    model_config = {"extra": "allow", "populate_by_name": True}
+
+class AttemptOut(ExerciseAttempt):
+    """A recorded attempt as returned by the API"""
+    id: PyObjectId = Field(alias="_id")
+    model_config = {"extra": "allow", "populate_by_name": True}
+
+class AttemptResult(BaseModel):
+    """The outcome of recording one attempt of a batch"""
+    exercise_id: str
+    status: str  # "recorded", "duplicate" or "error"
+    id: Optional[PyObjectId] = Field(None, alias="_id")
+    detail: Optional[str] = None
+    model_config = {"extra": "allow", "populate_by_name": True}
+
+class TextInfoOut(BaseModel):
+    """Text metadata as returned by the API; tokens are only included when asked for"""
+    id: PyObjectId = Field(alias="_id")
+    language: str
+    name: str
+    author: Optional[str] = None
+    length: int
+    source_available: bool
+    tokens: Optional[List[str]] = None
+    type: str
+    model_config = {"extra": "allow", "populate_by_name": True}
+
+class ExerciseTypeStats(BaseModel):
+    attempts: int
+    completions: int
+    accuracy: float  # Share of attempts completed rather than skipped
+
+class StatsTotals(BaseModel):
+    """Attempt statistics over a period"""
+    attempts: int
+    completions: int
+    skips: int
+    total_time_spent_ms: int
+    by_type: Dict[str, ExerciseTypeStats]  # By exercise type
+
+class DailyStats(StatsTotals):
+    day: datetime  # Midnight UTC
+
+class StatsOut(BaseModel):
+    """A user's statistics for a language: one entry per day with attempts, and their totals"""
+    days: List[DailyStats]
+    totals: StatsTotals
+
+class ReadableTextOut(TextInfoOut):
+    """A text ranked by how much of it the user can already read"""
+    coverage: float  # Share of the text's tokens that are in the user's token bank
+    known_tokens: int
+    total_tokens: int
@@ -0,0 +1,362 @@
+"""
+Verify that every query shape in the codebase is served by an index.
+
+Applies the index manifest from db.py, runs explain on each query shape below and
+exits non-zero if any winning plan contains a COLLSCAN. Run from the repo root:
+
+    python query_plans.py
+
+When adding a query to database.py, tokenbank.py, cache_sizing.py, jobs.py, retention.py, stats.py or auth.py, add its shape here.
+"""
+import asyncio
+import sys
+from typing import List
+from datetime import datetime
+from bson import ObjectId
+from db import (
+    get_database, create_indexes, close,
+    exercises_collection, users_collection, attempts_collection,
+    refresh_tokens_collection, tokenbank_tokens_collection, exercise_cache,
+    text_info_collection, text_source_collection, replenish_leases_collection,
+    token_vocabulary_collection, token_texts_collection, text_token_index_collection,
+    seen_exercises_collection, cache_profiles_collection, counters_collection, jobs_collection,
+    exercise_archive_collection, daily_stats_collection,
+    TEXT_SOURCE_BUCKET
+)
+
+USER_ID = str(ObjectId())
+EXERCISE_ID = str(ObjectId())
+LANGUAGE = "cmn"
+NOW = datetime.utcnow()
+
+# (description, command to explain)
+QUERY_SHAPES = [
+    ("database.get_text_info", {
+        "find": text_info_collection.name, "filter": {"_id": ObjectId()}
+    }),
+    ("database.open_text_source", {
+        "find": f"{TEXT_SOURCE_BUCKET}.files", "filter": {"filename": str(ObjectId())},
+        "sort": {"uploadDate": -1}, "limit": 1
+    }),
+    ("database.open_text_source (chunks)", {
+        "find": f"{TEXT_SOURCE_BUCKET}.chunks", "filter": {"files_id": ObjectId(), "n": {"$gte": 0}},
+        "sort": {"n": 1}
+    }),
+    ("database.open_text_source (legacy)", {
+        "find": text_source_collection.name, "filter": {"text_info_id": str(ObjectId())}
+    }),
+    ("database.list_texts", {
+        "find": text_info_collection.name, "filter": {"_id": {"$gt": ObjectId()}},
+        "sort": {"_id": 1}, "limit": 50
+    }),
+    ("database.list_texts (language)", {
+        "find": text_info_collection.name, "filter": {"language": LANGUAGE, "_id": {"$gt": ObjectId()}},
+        "sort": {"_id": 1}, "limit": 50
+    }),
+    ("database.list_texts (type)", {
+        "find": text_info_collection.name, "filter": {"type": "novel", "_id": {"$gt": ObjectId()}},
+        "sort": {"_id": 1}, "limit": 50
+    }),
+    ("database.list_texts (language, type)", {
+        "find": text_info_collection.name,
+        "filter": {"language": LANGUAGE, "type": "novel", "_id": {"$gt": ObjectId()}},
+        "sort": {"_id": 1}, "limit": 50
+    }),
+    ("database.get_exercise_by_id", {
+        "find": exercises_collection.name, "filter": {"_id": ObjectId(EXERCISE_ID)}
+    }),
+    ("database.get_user", {
+        "find": users_collection.name, "filter": {"username": "johndoe"}
+    }),
+    ("auth.rotate_refresh_token (legacy user)", {
+        "find": users_collection.name, "filter": {"_id": ObjectId(USER_ID)}
+    }),
+    ("database.acquire_replenish_lease", {
+        "update": replenish_leases_collection.name,
+        "updates": [{
+            "q": {"_id": f"{USER_ID}:{LANGUAGE}", "expires_at": {"$lte": NOW}},
+            "u": {"$set": {"expires_at": NOW}},
+            "upsert": True
+        }]
+    }),
+    ("database.record_attempt (mark used)", {
+        "update": exercise_cache.name,
+        "updates": [{
+            "q": {"exercise_id": EXERCISE_ID, "user_id": USER_ID, "language": LANGUAGE, "used": False},
+            "u": {"$set": {"used": True}}
+        }]
+    }),
+    ("database.get_user_attempts", {
+        "find": attempts_collection.name,
+        "filter": {"user_id": USER_ID, "language": LANGUAGE},
+        "sort": {"completed_at": -1}
+    }),
+    ("database.get_refresh_token", {
+        "find": refresh_tokens_collection.name,
+        "filter": {"$or": [{"token_hash": "hash"}, {"token": "token"}], "blacklisted": False}
+    }),
+    ("database.rotate_refresh_token", {
+        "findAndModify": refresh_tokens_collection.name,
+        "query": {"$or": [{"token_hash": "hash"}, {"token": "token"}], "blacklisted": False, "expires_at": {"$gt": NOW}},
+        "update": {"$set": {"token_hash": "new-hash", "expires_at": NOW}, "$unset": {"token": ""}}
+    }),
+    ("database.blacklist_refresh_token", {
+        "update": refresh_tokens_collection.name,
+        "updates": [{
+            "q": {"$or": [{"token_hash": "hash"}, {"token": "token"}]},
+            "u": {"$set": {"blacklisted": True, "expires_at": NOW}}
+        }]
+    }),
+    ("database.get_seen_exercise_ids", {
+        "find": seen_exercises_collection.name,
+        "filter": {"user_id": USER_ID, "language": LANGUAGE, "token": "你好"}
+    }),
+    ("database.take_pool_exercises", {
+        "find": exercises_collection.name,
+        "filter": {
+            "language": LANGUAGE, "tokens": "你好", "content_hash": {"$exists": True},
+            "archiving": {"$exists": False}, "_id": {"$nin": [ObjectId(EXERCISE_ID)]}
+        },
+        "sort": {"_id": 1}, "limit": 3
+    }),
+    ("database.add_to_pool", {
+        "find": exercises_collection.name, "filter": {"content_hash": {"$in": ["a", "b"]}}
+    }),
+    ("database.count_cached_exercises", {
+        "count": exercise_cache.name, "query": {"language": LANGUAGE, "user_id": USER_ID, "used": False}
+    }),
+    ("database.delete_exercise_cache", {
+        "delete": exercise_cache.name,
+        "deletes": [{"q": {"language": LANGUAGE, "user_id": USER_ID}, "limit": 0}]
+    }),
+    ("database.get_all_cached_exercises", {
+        "aggregate": exercise_cache.name,
+        "pipeline": [
+            {"$match": {"language": LANGUAGE, "user_id": USER_ID, "used": False}},
+            {"$sort": {"created_at": 1}},
+        ],
+        "cursor": {}
+    }),
+    ("database.trim_exercise_cache", {
+        "find": exercise_cache.name,
+        "filter": {"language": LANGUAGE, "user_id": USER_ID, "used": False},
+        "sort": {"created_at": 1}, "skip": 1
+    }),
+    ("database.trim_exercise_cache (seen)", {
+        "delete": seen_exercises_collection.name,
+        "deletes": [{"q": {"user_id": USER_ID, "exercise_id": {"$in": [EXERCISE_ID]}}, "limit": 0}]
+    }),
+    ("database.shrink_inactive_caches", {
+        "find": cache_profiles_collection.name, "filter": {"shrunk": False, "last_attempt_at": {"$lt": NOW}}
+    }),
+    ("cache_sizing.get_cache_sizing", {
+        "find": cache_profiles_collection.name, "filter": {"_id": f"{USER_ID}:{LANGUAGE}"}
+    }),
+    ("cache_sizing.record_attempt_activity", {
+        "update": cache_profiles_collection.name,
+        "updates": [{
+            "q": {"_id": f"{USER_ID}:{LANGUAGE}"},
+            "u": [{"$set": {"last_attempt_at": NOW, "shrunk": False}}],
+            "upsert": True
+        }]
+    }),
+    ("cache_sizing.take_generation_budget", {
+        "findAndModify": counters_collection.name,
+        "query": {"_id": "generation_budget:0"},
+        "update": {"$inc": {"used": 1}},
+        "upsert": True
+    }),
+    ("jobs.enqueue_job", {
+        "update": jobs_collection.name,
+        "updates": [{
+            "q": {"dedupe_key": f"replenish_cache:{USER_ID}:{LANGUAGE}", "status": "queued"},
+            "u": {"$set": {"payload": {}}, "$max": {"priority": 0}},
+            "upsert": True
+        }]
+    }),
+    ("jobs.claim_job", {
+        "findAndModify": jobs_collection.name,
+        "query": {"status": "queued", "type": {"$in": ["replenish_cache"]}, "run_at": {"$lte": NOW}},
+        "sort": {"priority": -1, "run_at": 1},
+        "update": {"$set": {"status": "running"}, "$inc": {"attempts": 1}}
+    }),
+    ("jobs.complete_job", {
+        "update": jobs_collection.name,
+        "updates": [{
+            "q": {"_id": ObjectId(), "owner": "worker", "status": "running"},
+            "u": {"$set": {"status": "done"}}
+        }]
+    }),
+    ("jobs.requeue_expired_jobs (failed)", {
+        "update": jobs_collection.name,
+        "updates": [{
+            "q": {"status": "running", "lease_expires_at": {"$lte": NOW}},
+            "u": {"$set": {"status": "failed"}},
+            "multi": True
+        }]
+    }),
+    ("jobs.requeue_expired_jobs (requeue)", {
+        "find": jobs_collection.name,
+        "filter": {"status": "running", "lease_expires_at": {"$lte": NOW}},
+        "projection": {"_id": 1, "priority": 1, "job_key": 1}
+    }),
+    ("jobs._requeue (superseded)", {
+        "findAndModify": jobs_collection.name,
+        "query": {"dedupe_key": f"replenish_cache:{USER_ID}:{LANGUAGE}", "status": "queued"},
+        "update": {"$max": {"priority": 0}}
+    }),
+    ("jobs.count_queued_jobs", {
+        "aggregate": jobs_collection.name,
+        "pipeline": [{"$match": {"status": "queued"}}, {"$group": {"_id": "$type", "count": {"$sum": 1}}}],
+        "cursor": {}
+    }),
+    ("retention.get_archived_exercise", {
+        "find": exercise_archive_collection.name, "filter": {"_id": ObjectId(EXERCISE_ID)}
+    }),
+    ("retention.get_archived_exercises", {
+        "find": exercise_archive_collection.name, "filter": {"_id": {"$in": [ObjectId(EXERCISE_ID)]}}
+    }),
+    ("retention.sweep_used_cache_entries", {
+        "find": exercise_cache.name, "filter": {"used_at": {"$exists": False}, "used": True}, "limit": 1000
+    }),
+    ("retention.archive_exercises", {
+        "find": exercises_collection.name, "filter": {"_id": {"$lt": ObjectId(), "$gt": ObjectId(EXERCISE_ID)}},
+        "projection": {"_id": 1}, "sort": {"_id": 1}, "limit": 500
+    }),
+    ("retention.archive_exercises (marked)", {
+        "find": exercises_collection.name, "filter": {"archiving": {"$lte": NOW}},
+        "projection": {"_id": 1}, "sort": {"_id": 1}, "limit": 500
+    }),
+    ("retention.archive_exercises (checkpoint)", {
+        "find": counters_collection.name, "filter": {"_id": "retention:archive_checkpoint"}
+    }),
+    ("retention.acquire_sweep_lease", {
+        "update": counters_collection.name,
+        "updates": [{
+            "q": {"_id": "retention:sweep_lease", "expires_at": {"$lte": NOW}},
+            "u": {"$set": {"expires_at": NOW}},
+            "upsert": True
+        }]
+    }),
+    ("retention.archive_exercises (attempted)", {
+        "distinct": attempts_collection.name, "key": "exercise_id", "query": {"exercise_id": {"$in": [EXERCISE_ID]}}
+    }),
+    ("retention.archive_exercises (cached)", {
+        "distinct": exercise_cache.name, "key": "exercise_id",
+        "query": {"exercise_id": {"$in": [EXERCISE_ID]}, "used": False}
+    }),
+    ("stats.record_attempt_stats", {
+        "update": daily_stats_collection.name,
+        "updates": [{
+            "q": {"user_id": USER_ID, "language": LANGUAGE, "day": NOW},
+            "u": {"$inc": {"attempts": 1}},
+            "upsert": True
+        }]
+    }),
+    ("stats.get_daily_stats", {
+        "find": daily_stats_collection.name,
+        "filter": {"user_id": USER_ID, "language": LANGUAGE, "day": {"$gte": NOW}},
+        "sort": {"day": 1}
+    }),
+    ("stats.backfill_stats (first user)", {
+        "find": attempts_collection.name, "filter": {},
+        "projection": {"_id": 0, "user_id": 1, "language": 1}, "sort": {"user_id": 1, "language": 1}, "limit": 1
+    }),
+    ("stats.backfill_stats (next user)", {
+        "find": attempts_collection.name,
+        "filter": {"$or": [{"user_id": USER_ID, "language": {"$gt": LANGUAGE}}, {"user_id": {"$gt": USER_ID}}]},
+        "projection": {"_id": 0, "user_id": 1, "language": 1}, "sort": {"user_id": 1, "language": 1}, "limit": 1
+    }),
+    ("stats.backfill_stats", {
+        "find": attempts_collection.name,
+        "filter": {"user_id": USER_ID, "language": LANGUAGE, "completed_at": {"$lt": NOW}}
+    }),
+    ("stats.get_exercise_types", {
+        "find": exercises_collection.name, "filter": {"_id": {"$in": [ObjectId(EXERCISE_ID)]}}
+    }),
+    ("tokenbank.get_user_tokenbank", {
+        "find": tokenbank_tokens_collection.name, "filter": {"user_id": USER_ID, "language": LANGUAGE}
+    }),
+    ("tokenbank.get_lowest_tokens", {
+        "find": tokenbank_tokens_collection.name,
+        "filter": {"user_id": USER_ID, "language": LANGUAGE},
+        "sort": {"value": 1, "token": 1},
+        "limit": 5
+    }),
+    ("tokenbank.get_known_tokens", {
+        "find": tokenbank_tokens_collection.name,
+        "filter": {"user_id": USER_ID, "language": LANGUAGE, "value": {"$gte": 1}}
+    }),
+    ("text_index.assign_token_ids", {
+        "find": token_vocabulary_collection.name,
+        "filter": {"language": LANGUAGE, "token": {"$in": ["你好", "再見"]}}
+    }),
+    ("text_index.index_text", {
+        "update": token_texts_collection.name,
+        "updates": [{
+            "q": {"language": LANGUAGE, "token_id": 1},
+            "u": {"$addToSet": {"text_ids": ObjectId()}},
+            "upsert": True
+        }]
+    }),
+    ("text_index.LanguageTextIndex.refresh", {
+        "find": text_token_index_collection.name,
+        "filter": {"language": LANGUAGE, "updated_at": {"$gte": NOW}},
+        "sort": {"updated_at": 1}
+    }),
+    ("tokenbank.flush_token_deltas", {
+        "update": tokenbank_tokens_collection.name,
+        "updates": [{
+            "q": {"user_id": USER_ID, "language": LANGUAGE, "token": "你好", "last_flush": {"$ne": "flush"}},
+            "u": {"$inc": {"value": 1}, "$set": {"last_flush": "flush"}},
+            "upsert": True
+        }]
+    }),
+    ("tokenbank.update_token_value", {
+        "update": tokenbank_tokens_collection.name,
+        "updates": [{
+            "q": {"user_id": USER_ID, "language": LANGUAGE, "token": "你好"},
+            "u": {"$set": {"value": 1}},
+            "upsert": True
+        }]
+    }),
+]
+
+def find_collscans(plan) -> bool:
+    """Whether any stage in an explain plan is a collection scan"""
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            return True
+        return any(find_collscans(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(find_collscans(value) for value in plan)
+    return False
+
+def winning_plan(explain: dict) -> dict:
+    if "queryPlanner" in explain:
+        return explain["queryPlanner"]["winningPlan"]
+    # Aggregations report the plan of their first stage
+    for stage in explain.get("stages", []):
+        if "$cursor" in stage:
+            return stage["$cursor"]["queryPlanner"]["winningPlan"]
+    return explain
+
+async def check_query_plans() -> List[str]:
+    """Explain every query shape and return the descriptions of those that do a COLLSCAN"""
+    await create_indexes()
+    failures = []
+    for description, command in QUERY_SHAPES:
+        explain = await get_database().command("explain", command, verbosity="queryPlanner")
+        if find_collscans(winning_plan(explain)):
+            failures.append(description)
+    return failures
+
+async def main() -> int:
+    failures = await check_query_plans()
+    for description, _ in QUERY_SHAPES:
+        print(f"{'COLLSCAN' if description in failures else 'ok':>8}  {description}")
+    await close()
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -1,16 +1,17 @@
-from tokenbank import get_user_tokenbank
-from typing import Optional
+from tokenbank import get_lowest_tokens
+from typing import List, Optional
 import asyncio
 import random
 
 async def get_next_token(user_id: Optional[str], language: str):
-    tokenbank = await get_user_tokenbank(user_id, language)
-    if not tokenbank:
-        return None
-    lowest_token = min(tokenbank.items(), key=lambda x: x[1])
-    return lowest_token[0]
+    tokens = await get_next_tokens(user_id, language, 1)
+    return tokens[0] if tokens else None
+
+async def get_next_tokens(user_id: Optional[str], language: str, k: int) -> List[str]:
+    """Get the k tokens the user should practice next, lowest-valued first"""
+    return await get_lowest_tokens(user_id, language, k)
 
 async def get_next_exercise_type(user_id: Optional[str], language: str):
     # exercise_types = ["matching", "translate", "fill_blank", "audio_transcribe"]
     exercise_types = ["matching", "translate"]
-    return random.choice(exercise_types)
\ No newline at end of file
+    return random.choice(exercise_types)
@@ -0,0 +1,233 @@
+"""
+Retention: removes used exercise cache entries and moves old, attempted exercises out of the
+exercises collection into a zlib-compressed cold archive (exercise_archive), from which
+/exercise/{id} still serves them. Every API process runs the sweeper, and a lease in counters
+lets one of them sweep per RETENTION_SWEEP_INTERVAL_SECONDS; to run one sweep and print what it
+reclaimed, from the repo root:
+
+    MONGODB_URL=mongodb://localhost:27017 python retention.py
+"""
+from bson import BSON, Binary, ObjectId
+from datetime import datetime, timedelta
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import json
+import logging
+import os
+import zlib
+from db import (
+    attempts_collection, counters_collection, exercise_archive_collection, exercise_cache,
+    exercises_collection, connect, close
+)
+from metrics import RETENTION_BYTES_ARCHIVED, RETENTION_BYTES_RECLAIMED, RETENTION_DOCUMENTS_REMOVED
+from settings import get_settings
+
+logger = logging.getLogger("uvicorn")
+
+# Used cache entries normally expire through the TTL index on used_at (see db.py); entries
+# marked used before used_at was recorded are swept in batches
+SWEEP_BATCH_SIZE = 1000
+ARCHIVE_BATCH_SIZE = 500
+RETENTION_SWEEP_INTERVAL_SECONDS = 3600
+COMPRESSION_LEVEL = 6  # zlib level for archived exercises
+# Exercises are marked "archiving" (which hides them from the pool) this long before they are archived,
+# so pool exercises taken just before the mark have reached a cache, and are kept, by the time they are re-checked
+ARCHIVE_GRACE_SECONDS = 30
+ARCHIVE_RESCAN_DAYS = 7  # How often the scan starts over, for old exercises attempted since they were scanned
+ARCHIVE_CHECKPOINT_ID = "retention:archive_checkpoint"  # In counters: the last exercise the scan reached
+SWEEP_LEASE_ID = "retention:sweep_lease"  # In counters: held by the process sweeping, for RETENTION_SWEEP_INTERVAL_SECONDS
+
+def compress_exercise(exercise: dict) -> dict:
+    """The archive document for an exercise: its _id and its BSON, compressed"""
+    return {
+        "_id": exercise["_id"],
+        "archived_at": datetime.utcnow(),
+        "content": Binary(zlib.compress(BSON.encode(exercise), COMPRESSION_LEVEL))
+    }
+
+def decompress_exercise(archived: dict) -> dict:
+    return BSON(zlib.decompress(archived["content"])).decode()
+
+async def get_archived_exercise(exercise_id: ObjectId) -> Optional[dict]:
+    archived = await exercise_archive_collection.find_one({"_id": exercise_id})
+    return decompress_exercise(archived) if archived else None
+
+async def get_archived_exercises(exercise_ids: List[ObjectId]) -> Dict[str, dict]:
+    """Archived exercises by exercise id, with one query"""
+    if not exercise_ids:
+        return {}
+    cursor = exercise_archive_collection.find({"_id": {"$in": exercise_ids}})
+    return {str(archived["_id"]): decompress_exercise(archived) async for archived in cursor}
+
+async def sweep_used_cache_entries() -> Tuple[int, int]:
+    """
+    Delete used cache entries that have no used_at for the TTL index to act on.
+    Returns how many were deleted and their size in bytes.
+    """
+    deleted = 0
+    bytes_reclaimed = 0
+    while True:
+        cursor = exercise_cache.find({"used_at": {"$exists": False}, "used": True}, limit=SWEEP_BATCH_SIZE)
+        entries = await cursor.to_list(length=None)
+        if not entries:
+            return deleted, bytes_reclaimed
+        result = await exercise_cache.delete_many({"_id": {"$in": [entry["_id"] for entry in entries]}})
+        deleted += result.deleted_count
+        bytes_reclaimed += sum(len(BSON.encode(entry)) for entry in entries)
+
+async def _archivable_ids(exercise_ids: List[ObjectId]) -> List[ObjectId]:
+    """The exercises among exercise_ids that have been attempted and are not waiting in anyone's cache"""
+    ids = [str(exercise_id) for exercise_id in exercise_ids]
+    attempted, cached = await asyncio.gather(
+        attempts_collection.distinct("exercise_id", {"exercise_id": {"$in": ids}}),
+        exercise_cache.distinct("exercise_id", {"exercise_id": {"$in": ids}, "used": False})
+    )
+    keep = set(attempted) - set(cached)
+    return [exercise_id for exercise_id in exercise_ids if str(exercise_id) in keep]
+
+async def _mark_archivable(older_than: timedelta) -> int:
+    """
+    Scan exercises created more than older_than ago, from where the last scan stopped, and mark the
+    archivable ones "archiving". The scan starts over every ARCHIVE_RESCAN_DAYS. Returns how many were marked.
+    """
+    now = datetime.utcnow()
+    cutoff = ObjectId.from_datetime(now - older_than)
+    checkpoint = await counters_collection.find_one({"_id": ARCHIVE_CHECKPOINT_ID}) or {}
+    if checkpoint.get("pass_started_at", datetime.min) <= now - timedelta(days=ARCHIVE_RESCAN_DAYS):
+        checkpoint = {"pass_started_at": now}
+    last_id = checkpoint.get("last_id")
+    marked = 0
+    while True:
+        id_filter = {"$lt": cutoff} if last_id is None else {"$lt": cutoff, "$gt": last_id}
+        cursor = exercises_collection.find(
+            {"_id": id_filter}, projection={"_id": 1}, sort=[("_id", 1)], limit=ARCHIVE_BATCH_SIZE
+        )
+        batch = [doc["_id"] async for doc in cursor]
+        if not batch:
+            return marked
+        last_id = batch[-1]
+
+        exercise_ids = await _archivable_ids(batch)
+        if exercise_ids:
+            result = await exercises_collection.update_many(
+                {"_id": {"$in": exercise_ids}, "archiving": {"$exists": False}}, {"$set": {"archiving": now}}
+            )
+            marked += result.modified_count
+        # Saved after every batch, so an interrupted sweep resumes here
+        await counters_collection.update_one(
+            {"_id": ARCHIVE_CHECKPOINT_ID},
+            {"$set": {"last_id": last_id, "pass_started_at": checkpoint["pass_started_at"]}},
+            upsert=True
+        )
+
+async def archive_exercises(older_than: timedelta) -> Dict[str, int]:
+    """
+    Move exercises created more than older_than ago that have been attempted, and are not in any
+    user's unused cache, to the archive. They are first marked "archiving", which takes them out of
+    the pool, and only archived if they are still not cached ARCHIVE_GRACE_SECONDS later.
+    Returns how many were archived, the bytes removed from the exercises collection and the bytes
+    they take up in the archive.
+    """
+    if await _mark_archivable(older_than):
+        await asyncio.sleep(ARCHIVE_GRACE_SECONDS)
+    # Also picks up exercises marked by an earlier, interrupted sweep
+    marked_before = datetime.utcnow() - timedelta(seconds=ARCHIVE_GRACE_SECONDS)
+    archived = 0
+    bytes_reclaimed = 0
+    bytes_archived = 0
+    while True:
+        cursor = exercises_collection.find(
+            {"archiving": {"$lte": marked_before}}, projection={"_id": 1}, sort=[("_id", 1)], limit=ARCHIVE_BATCH_SIZE
+        )
+        batch = [doc["_id"] async for doc in cursor]
+        if not batch:
+            break
+
+        exercise_ids = await _archivable_ids(batch)
+        archivable = set(exercise_ids)
+        kept = [exercise_id for exercise_id in batch if exercise_id not in archivable]
+        if kept:
+            # Taken from the pool into a cache before they were marked; they go back into the pool
+            await exercises_collection.update_many({"_id": {"$in": kept}}, {"$unset": {"archiving": ""}})
+        if not exercise_ids:
+            continue
+        exercises = await exercises_collection.find({"_id": {"$in": exercise_ids}}).to_list(length=None)
+        for exercise in exercises:
+            exercise.pop("archiving", None)
+        archive_docs = [compress_exercise(exercise) for exercise in exercises]
+        try:
+            await exercise_archive_collection.insert_many(archive_docs, ordered=False)
+        except BulkWriteError as e:
+            # Exercises archived by an earlier, interrupted sweep are already there
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+        await exercises_collection.delete_many({"_id": {"$in": [exercise["_id"] for exercise in exercises]}})
+
+        archived += len(exercises)
+        bytes_reclaimed += sum(len(BSON.encode(exercise)) for exercise in exercises)
+        bytes_archived += sum(len(BSON.encode(doc)) for doc in archive_docs)
+    return {"exercises_archived": archived, "bytes_reclaimed": bytes_reclaimed, "bytes_archived": bytes_archived}
+
+async def run_retention_sweep() -> Dict[str, int]:
+    """
+    One retention pass. Returns what it removed, the bytes that took up in the hot collections,
+    and the bytes written to the archive.
+    """
+    cache_entries, cache_bytes = await sweep_used_cache_entries()
+    archive = await archive_exercises(timedelta(days=get_settings().exercise_archive_after_days))
+    RETENTION_DOCUMENTS_REMOVED.labels(exercise_cache.name).inc(cache_entries)
+    RETENTION_DOCUMENTS_REMOVED.labels(exercises_collection.name).inc(archive["exercises_archived"])
+    RETENTION_BYTES_RECLAIMED.labels(exercise_cache.name).inc(cache_bytes)
+    RETENTION_BYTES_RECLAIMED.labels(exercises_collection.name).inc(archive["bytes_reclaimed"])
+    RETENTION_BYTES_ARCHIVED.inc(archive["bytes_archived"])
+    return {
+        "cache_entries_deleted": cache_entries,
+        "exercises_archived": archive["exercises_archived"],
+        "bytes_reclaimed": cache_bytes + archive["bytes_reclaimed"],
+        "bytes_archived": archive["bytes_archived"]
+    }
+
+async def acquire_sweep_lease(owner: str) -> bool:
+    """
+    Try to take the sweep lease for RETENTION_SWEEP_INTERVAL_SECONDS. It is not released after a sweep,
+    so across all processes one sweep starts per interval. Returns False if another process holds it.
+    """
+    now = datetime.utcnow()
+    try:
+        # Only matches a missing or expired lease; otherwise the upsert collides on _id
+        await counters_collection.update_one(
+            {"_id": SWEEP_LEASE_ID, "expires_at": {"$lte": now}},
+            {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=RETENTION_SWEEP_INTERVAL_SECONDS)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+async def run_retention_sweeper(owner: str):
+    """
+    Every RETENTION_SWEEP_INTERVAL_SECONDS, run a retention sweep if no other process holds the
+    sweep lease, until cancelled
+    """
+    while True:
+        try:
+            if await acquire_sweep_lease(owner):
+                report = await run_retention_sweep()
+                if any(report.values()):
+                    logger.info(f"Retention sweep: {json.dumps(report)}")
+        except Exception as e:
+            logger.error(f"Retention sweep failed: {e!r}")
+        await asyncio.sleep(RETENTION_SWEEP_INTERVAL_SECONDS)
+
+async def main():
+    await connect()
+    if await acquire_sweep_lease(f"retention.py:{os.getpid()}"):
+        print(json.dumps(await run_retention_sweep(), indent=2))
+    else:
+        lease = await counters_collection.find_one({"_id": SWEEP_LEASE_ID})
+        print(f"Not sweeping: {lease['owner']} holds the sweep lease until {lease['expires_at']}")
+    await close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,26 @@
+from bson import ObjectId
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from typing import Any
+import orjson
+
+def _default(value: Any):
+    """Encode the types orjson does not handle natively (datetimes are native)"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json", by_alias=True)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+def dumps(content: Any) -> bytes:
+    """Serialize Mongo documents (with ObjectIds and datetimes) straight to JSON bytes"""
+    return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+class MongoJSONResponse(JSONResponse):
+    """
+    orjson-rendered JSON response that encodes ObjectIds as strings. Returning one directly
+    from an endpoint also skips FastAPI's jsonable_encoder pass over the content.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,45 @@
+from dotenv import load_dotenv
+from functools import lru_cache
+from pydantic import BaseModel
+from typing import Optional
+import os
+
+ENV_FILE = "secret.env"
+
+class Settings(BaseModel):
+    """
+    Configuration read from the environment (and ENV_FILE). Each field is set by the
+    environment variable of the same name in upper case, e.g. MONGODB_MAX_POOL_SIZE.
+    """
+    mongodb_url: Optional[str] = None
+    mongodb_database: str = "lexaglot"
+    # Connections per process; with many workers, total connections are workers x max pool size
+    mongodb_max_pool_size: int = 50
+    mongodb_min_pool_size: int = 0  # Kept open even when idle; 0 so boot opens no extra connections
+    mongodb_max_idle_time_ms: int = 60000
+    mongodb_server_selection_timeout_ms: int = 5000
+    jwt_secret_key: Optional[str] = None
+    job_worker_concurrency: int = 4  # Jobs each worker.py process runs at once, unless --concurrency is given
+    # Job loops inside each API process; 0 when dedicated worker.py processes run the jobs
+    api_job_concurrency: int = 1
+    exercise_archive_after_days: int = 30  # Attempted exercises older than this move to the cold archive
+    # Directory of <language>.txt word lists (one word per line) used to segment CJK text
+    tokenizer_dictionary_dir: str = "dictionaries"
+    tokenizer_processes: Optional[int] = None  # Size of the tokenizer process pool; the CPU count if not set
+    model_config = {"frozen": True}
+
+    def require(self, *fields: str):
+        """Raise if any of the given settings is not set"""
+        missing = [field.upper() for field in fields if not getattr(self, field)]
+        if missing:
+            raise RuntimeError(f"Environment variable(s) not set: {', '.join(missing)}")
+
+@lru_cache(maxsize=None)
+def get_settings() -> Settings:
+    """The process's settings, loaded on first call"""
+    load_dotenv(ENV_FILE)
+    return Settings(**{
+        field: os.environ[field.upper()]
+        for field in Settings.model_fields
+        if field.upper() in os.environ
+    })
@@ -0,0 +1,212 @@
+"""
+Learning statistics, rolled up per user, language and (UTC) day in daily_stats:
+  {user_id, language, day, attempts, completions, skips, total_time_spent_ms,
+   by_type: {<exercise type>: {attempts, completions}}}
+Recording an attempt $inc's its day's rollup, so stats are read in O(days) rather than
+O(attempts). To build the rollups for attempts recorded before they existed, from the repo root:
+
+    MONGODB_URL=mongodb://localhost:27017 python stats.py [--before YYYY-MM-DD]
+
+The backfill replaces every rollup it touches with one recomputed from the attempts, so it can be
+rerun safely. It only touches days before --before (default: today, UTC), one user and language at
+a time. It must not run while attempts for those days are being recorded (e.g. by clients syncing
+old offline attempts): their $inc's would be overwritten. Pick a --before that no client can still
+be syncing attempts for, or stop the API while it runs.
+"""
+from bson import ObjectId
+from datetime import datetime, timedelta, timezone
+from pymongo import UpdateOne
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+import argparse
+import asyncio
+from db import attempts_collection, daily_stats_collection, exercises_collection, connect, close
+from models import ExerciseAttempt
+from retention import get_archived_exercises
+
+UNKNOWN_EXERCISE_TYPE = "unknown"  # For attempts whose exercise no longer exists
+STATS_DAYS = 30  # Days of stats returned by default
+MAX_STATS_DAYS = 366
+BACKFILL_BATCH_SIZE = 1000
+ATTEMPT_FIELDS = {"user_id", "language", "exercise_id", "completed_at", "was_completed", "total_time_spent_ms"}
+
+Rollups = Dict[Tuple[str, str, datetime], Dict[str, int]]  # (user_id, language, day) -> counters
+
+def stats_day(completed_at: datetime) -> datetime:
+    """The day an attempt counts towards: midnight UTC of when it was completed"""
+    if completed_at.tzinfo is not None:
+        completed_at = completed_at.astimezone(timezone.utc).replace(tzinfo=None)
+    return completed_at.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def rollup_increments(attempt: dict, exercise_type: Optional[str]) -> Dict[str, int]:
+    """The counters one attempt adds to its day's rollup"""
+    # Exercise types become field names, so they must not contain a path separator
+    exercise_type = (exercise_type or UNKNOWN_EXERCISE_TYPE).replace(".", "_").lstrip("$")
+    completed = int(attempt["was_completed"])
+    return {
+        "attempts": 1,
+        "completions": completed,
+        "skips": 1 - completed,
+        "total_time_spent_ms": attempt["total_time_spent_ms"],
+        f"by_type.{exercise_type}.attempts": 1,
+        f"by_type.{exercise_type}.completions": completed,
+    }
+
+def _rollup_key(attempt: dict) -> Tuple[str, str, datetime]:
+    return attempt["user_id"], attempt["language"], stats_day(attempt["completed_at"])
+
+def sum_rollups(attempts: Iterable[Tuple[dict, Optional[str]]], rollups: Optional[Rollups] = None) -> Rollups:
+    """Add up the increments of (attempt, exercise type) pairs per user, language and day, onto rollups if given"""
+    rollups = {} if rollups is None else rollups
+    for attempt, exercise_type in attempts:
+        rollup = rollups.setdefault(_rollup_key(attempt), {})
+        for field, value in rollup_increments(attempt, exercise_type).items():
+            rollup[field] = rollup.get(field, 0) + value
+    return rollups
+
+async def record_attempt_stats(attempts: List[ExerciseAttempt], exercise_types: Dict[str, Optional[str]]):
+    """Add newly recorded attempts to their daily rollups, with one $inc upsert per rollup"""
+    rollups = sum_rollups(
+        (attempt.model_dump(include=ATTEMPT_FIELDS), exercise_types.get(attempt.exercise_id)) for attempt in attempts
+    )
+    if not rollups:
+        return
+    await daily_stats_collection.bulk_write(
+        [
+            UpdateOne({"user_id": user_id, "language": language, "day": day}, {"$inc": increments}, upsert=True)
+            for (user_id, language, day), increments in rollups.items()
+        ],
+        ordered=False
+    )
+
+def _add_accuracy(by_type: Dict[str, Dict[str, int]]):
+    """Add the accuracy (share completed) to each exercise type's counters"""
+    for counts in by_type.values():
+        counts["accuracy"] = counts["completions"] / counts["attempts"] if counts["attempts"] else 0.0
+
+async def get_daily_stats(user_id: str, language: str, days: int = STATS_DAYS) -> List[dict]:
+    """A user's rollups for the last days days (including today), oldest first; days without attempts are left out"""
+    since = stats_day(datetime.utcnow()) - timedelta(days=days - 1)
+    cursor = daily_stats_collection.find(
+        {"user_id": user_id, "language": language, "day": {"$gte": since}},
+        projection={"_id": 0, "user_id": 0, "language": 0},
+        sort=[("day", 1)]
+    )
+    daily = await cursor.to_list(length=None)
+    for day in daily:
+        _add_accuracy(day.setdefault("by_type", {}))
+    return daily
+
+def total_stats(daily: List[dict]) -> dict:
+    """Sum daily rollups into one"""
+    totals = {"attempts": 0, "completions": 0, "skips": 0, "total_time_spent_ms": 0, "by_type": {}}
+    for day in daily:
+        for field in ("attempts", "completions", "skips", "total_time_spent_ms"):
+            totals[field] += day.get(field, 0)
+        for exercise_type, counts in day.get("by_type", {}).items():
+            type_totals = totals["by_type"].setdefault(exercise_type, {"attempts": 0, "completions": 0})
+            type_totals["attempts"] += counts.get("attempts", 0)
+            type_totals["completions"] += counts.get("completions", 0)
+    _add_accuracy(totals["by_type"])
+    return totals
+
+async def get_exercise_types(exercise_ids: Iterable[str]) -> Dict[str, Optional[str]]:
+    """Exercise type by exercise id, looking in the archive for exercises that are no longer live"""
+    object_ids = [ObjectId(exercise_id) for exercise_id in set(exercise_ids) if ObjectId.is_valid(exercise_id)]
+    if not object_ids:
+        return {}
+    cursor = exercises_collection.find({"_id": {"$in": object_ids}}, projection={"type": 1})
+    types = {str(doc["_id"]): doc.get("type") async for doc in cursor}
+    archived = await get_archived_exercises([object_id for object_id in object_ids if str(object_id) not in types])
+    for object_id in object_ids:
+        if str(object_id) not in types:
+            types[str(object_id)] = archived.get(str(object_id), {}).get("type")
+    return types
+
+def _rollup_document(user_id: str, language: str, day: datetime, counters: Dict[str, int]) -> dict:
+    """A rollup document from summed increments, whose by_type counters are dotted field names"""
+    document = {"user_id": user_id, "language": language, "day": day, "by_type": {}}
+    for field, value in counters.items():
+        if field.startswith("by_type."):
+            _, exercise_type, counter = field.split(".")
+            document["by_type"].setdefault(exercise_type, {})[counter] = value
+        else:
+            document[field] = value
+    return document
+
+async def _backfill_user_language(user_id: str, language: str, before: datetime) -> int:
+    """Rebuild one user's rollups for a language, for days before before. Returns how many were written."""
+    rollups: Rollups = {}
+    cursor = attempts_collection.find(
+        {"user_id": user_id, "language": language, "completed_at": {"$lt": before}},
+        projection={"_id": 0, **{field: 1 for field in ATTEMPT_FIELDS}}
+    )
+    batch: List[dict] = []
+
+    async def add_batch():
+        exercise_types = await get_exercise_types(attempt["exercise_id"] for attempt in batch)
+        sum_rollups(((attempt, exercise_types.get(attempt["exercise_id"])) for attempt in batch), rollups)
+        batch.clear()
+
+    async for attempt in cursor:
+        batch.append(attempt)
+        if len(batch) >= BACKFILL_BATCH_SIZE:
+            await add_batch()
+    await add_batch()
+
+    requests = [
+        UpdateOne(
+            {"user_id": user_id, "language": language, "day": day},
+            {"$set": _rollup_document(user_id, language, day, counters)},
+            upsert=True
+        )
+        for (user_id, language, day), counters in rollups.items()
+    ]
+    for start in range(0, len(requests), BACKFILL_BATCH_SIZE):
+        await daily_stats_collection.bulk_write(requests[start:start + BACKFILL_BATCH_SIZE], ordered=False)
+    return len(requests)
+
+async def _attempt_user_languages() -> AsyncIterator[Tuple[str, str]]:
+    """
+    Each user and language with attempts, in order. Walks the (user_id, language, completed_at) index
+    with one seek per pair, rather than grouping the whole attempts collection.
+    """
+    last: Optional[Tuple[str, str]] = None
+    while True:
+        query = {} if last is None else {
+            "$or": [{"user_id": last[0], "language": {"$gt": last[1]}}, {"user_id": {"$gt": last[0]}}]
+        }
+        attempt = await attempts_collection.find_one(
+            query, projection={"_id": 0, "user_id": 1, "language": 1}, sort=[("user_id", 1), ("language", 1)]
+        )
+        if attempt is None:
+            return
+        last = attempt["user_id"], attempt["language"]
+        yield last
+
+async def backfill_stats(before: Optional[datetime] = None) -> int:
+    """
+    Rebuild the daily rollups of days before before (default: today, UTC) from the attempts collection,
+    one user and language at a time. Each rollup touched is replaced with one recomputed from all its
+    attempts, so this must not run while attempts for those days are being recorded.
+    Returns how many rollups were written.
+    """
+    before = stats_day(before or datetime.utcnow())
+    written = 0
+    async for user_id, language in _attempt_user_languages():
+        written += await _backfill_user_language(user_id, language, before)
+    return written
+
+async def main(before: Optional[datetime]):
+    await connect()
+    written = await backfill_stats(before)
+    print(f"Wrote {written} daily stats rollups")
+    await close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--before", type=datetime.fromisoformat, default=None,
+        help="only rebuild days before this date, UTC (default: today)"
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.before))
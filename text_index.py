@@ -0,0 +1,238 @@
+from bson import Binary, ObjectId
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from typing import Dict, List, Optional
+import asyncio
+import numpy as np
+import time
+from db import (
+    counters_collection, text_info_collection, text_token_index_collection,
+    token_texts_collection, token_vocabulary_collection
+)
+
+# Indexes used to match texts against a learner's tokenbank:
+# - token_vocabulary: {language, token, token_id}, a dense integer id per token per language
+# - text_token_index: {_id: text_info _id, language, token_ids: sorted int32 array, updated_at}
+# - token_texts: {language, token_id, text_ids: [...]}, the inverted index from token to texts
+# Each process also keeps the per-text arrays of a language in memory (LanguageTextIndex),
+# refreshed incrementally from text_token_index, so coverage ranking needs no database scan.
+
+TEXT_INDEX_REFRESH_SECONDS = 5  # How stale a process's in-memory text index may get
+# updated_at comes from each writer's clock and a write can commit after a later one has been read,
+# so every refresh re-reads texts updated this long before the newest one it has seen
+TEXT_INDEX_SYNC_OVERLAP = timedelta(seconds=60)
+
+async def assign_token_ids(language: str, tokens: List[str]) -> Dict[str, int]:
+    """
+    Get the ids of tokens in a language's vocabulary, assigning new ids to unseen tokens
+    """
+    token_ids = {}
+    async for doc in token_vocabulary_collection.find({"language": language, "token": {"$in": tokens}}):
+        token_ids[doc["token"]] = doc["token_id"]
+
+    missing = [token for token in tokens if token not in token_ids]
+    if missing:
+        # Reserve a block of ids for the new tokens
+        counter = await counters_collection.find_one_and_update(
+            {"_id": f"token_id:{language}"},
+            {"$inc": {"next": len(missing)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        first_id = counter["next"] - len(missing)
+        try:
+            await token_vocabulary_collection.insert_many(
+                [
+                    {"language": language, "token": token, "token_id": first_id + i}
+                    for i, token in enumerate(missing)
+                ],
+                ordered=False
+            )
+        except BulkWriteError:
+            # Another process added some of these tokens first; their ids win
+            pass
+        async for doc in token_vocabulary_collection.find({"language": language, "token": {"$in": missing}}):
+            token_ids[doc["token"]] = doc["token_id"]
+    return token_ids
+
+async def index_text(text_info_id: ObjectId, language: str, tokens: List[str]):
+    """
+    Add a text, or update it, in the token-id array and inverted indexes
+    """
+    token_ids = await assign_token_ids(language, tokens)
+    new_ids = np.unique(np.fromiter(token_ids.values(), dtype=np.int32, count=len(token_ids)))
+
+    previous = await text_token_index_collection.find_one({"_id": text_info_id}, projection={"token_ids": 1})
+    old_ids = np.frombuffer(previous["token_ids"], dtype=np.int32) if previous else np.empty(0, dtype=np.int32)
+
+    requests = [
+        UpdateOne(
+            {"language": language, "token_id": int(token_id)},
+            {"$addToSet": {"text_ids": text_info_id}},
+            upsert=True
+        )
+        for token_id in np.setdiff1d(new_ids, old_ids, assume_unique=True)
+    ]
+    requests += [
+        UpdateOne({"language": language, "token_id": int(token_id)}, {"$pull": {"text_ids": text_info_id}})
+        for token_id in np.setdiff1d(old_ids, new_ids, assume_unique=True)
+    ]
+    if requests:
+        await token_texts_collection.bulk_write(requests, ordered=False)
+
+    await text_token_index_collection.update_one(
+        {"_id": text_info_id},
+        {"$set": {
+            "language": language,
+            "token_ids": Binary(new_ids.tobytes()),
+            "updated_at": datetime.utcnow()
+        }},
+        upsert=True
+    )
+
+async def get_texts_with_token(language: str, token: str) -> List[str]:
+    """Ids of the texts that contain a token, from the inverted index"""
+    vocabulary_entry = await token_vocabulary_collection.find_one({"language": language, "token": token})
+    if not vocabulary_entry:
+        return []
+    entry = await token_texts_collection.find_one(
+        {"language": language, "token_id": vocabulary_entry["token_id"]},
+        projection={"text_ids": 1}
+    )
+    return [str(text_id) for text_id in entry["text_ids"]] if entry else []
+
+class LanguageTextIndex:
+    """
+    The token-id arrays of every indexed text in one language, concatenated into one array
+    (with per-text offsets) so coverage can be computed for all texts in a few vectorized operations
+    """
+
+    def __init__(self, language: str):
+        self.language = language
+        self.synced_at = datetime.min  # Newest updated_at seen
+        self.refreshed_at = 0.0
+        self._texts: Dict[ObjectId, np.ndarray] = {}
+        self._updated_at: Dict[ObjectId, datetime] = {}
+        self.text_ids: List[ObjectId] = []
+        self.token_ids = np.empty(0, dtype=np.int32)
+        self.starts = np.empty(0, dtype=np.int64)
+        self.ends = np.empty(0, dtype=np.int64)
+
+    async def refresh(self):
+        """
+        Load texts indexed or updated since the last refresh, less TEXT_INDEX_SYNC_OVERLAP,
+        and rebuild the arrays if any of them changed
+        """
+        since = max(self.synced_at, datetime.min + TEXT_INDEX_SYNC_OVERLAP) - TEXT_INDEX_SYNC_OVERLAP
+        cursor = text_token_index_collection.find(
+            {"language": self.language, "updated_at": {"$gte": since}},
+            sort=[("updated_at", 1)]
+        )
+        changed = False
+        async for doc in cursor:
+            self.synced_at = max(self.synced_at, doc["updated_at"])
+            if self._updated_at.get(doc["_id"]) == doc["updated_at"]:
+                # Already loaded by an earlier refresh within the overlap
+                continue
+            self._texts[doc["_id"]] = np.frombuffer(doc["token_ids"], dtype=np.int32)
+            self._updated_at[doc["_id"]] = doc["updated_at"]
+            changed = True
+        self.refreshed_at = time.monotonic()
+        if not changed:
+            return
+
+        self.text_ids = list(self._texts)
+        arrays = list(self._texts.values())
+        lengths = np.fromiter((len(array) for array in arrays), dtype=np.int64, count=len(arrays))
+        self.ends = np.cumsum(lengths)
+        self.starts = self.ends - lengths
+        self.token_ids = np.concatenate(arrays) if arrays else np.empty(0, dtype=np.int32)
+
+    def coverage(self, known_token_ids: np.ndarray):
+        """
+        For every text, the number of its tokens that are known and its total number of tokens
+        """
+        vocabulary_size = int(max(self.token_ids.max(initial=0), known_token_ids.max(initial=0))) + 1
+        known = np.zeros(vocabulary_size, dtype=bool)
+        known[known_token_ids] = True
+        known_counts = np.concatenate(([0], np.cumsum(known[self.token_ids], dtype=np.int64)))
+        return known_counts[self.ends] - known_counts[self.starts], self.ends - self.starts
+
+_language_indexes: Dict[str, LanguageTextIndex] = {}
+
+async def get_language_index(language: str) -> LanguageTextIndex:
+    index = _language_indexes.get(language)
+    if index is None:
+        index = _language_indexes[language] = LanguageTextIndex(language)
+    if time.monotonic() - index.refreshed_at > TEXT_INDEX_REFRESH_SECONDS:
+        await index.refresh()
+    return index
+
+async def rank_texts_by_coverage(
+    language: str,
+    known_tokens: List[str],
+    limit: int = 20,
+    type: Optional[str] = None
+) -> List[dict]:
+    """
+    Rank a language's texts by the share of their tokens that are in known_tokens, best first.
+    Returns text infos (without their token lists) with coverage, known_tokens and total_tokens added.
+    """
+    index = await get_language_index(language)
+    if not index.text_ids:
+        return []
+
+    known_ids = []
+    async for doc in token_vocabulary_collection.find(
+        {"language": language, "token": {"$in": known_tokens}},
+        projection={"token_id": 1}
+    ):
+        known_ids.append(doc["token_id"])
+
+    known_counts, totals = index.coverage(np.array(known_ids, dtype=np.int64))
+    coverage = known_counts / np.maximum(totals, 1)
+    # Best coverage first, then the most known tokens
+    order = np.lexsort((-known_counts, -coverage))
+
+    # With a type filter, walk candidates in rank order until enough texts of that type are found
+    candidates = order if type else order[:limit]
+    batch_size = max(limit, 1) * 4
+    ranked = []
+    for start in range(0, len(candidates), batch_size):
+        batch = candidates[start:start + batch_size]
+        query = {"_id": {"$in": [index.text_ids[i] for i in batch]}}
+        if type:
+            query["type"] = type
+        text_infos = {
+            doc["_id"]: doc
+            async for doc in text_info_collection.find(query, projection={"tokens": 0})
+        }
+        for i in batch:
+            text_info = text_infos.get(index.text_ids[i])
+            if text_info is None:
+                continue
+            text_info["coverage"] = float(coverage[i])
+            text_info["known_tokens"] = int(known_counts[i])
+            text_info["total_tokens"] = int(totals[i])
+            ranked.append(text_info)
+            if len(ranked) >= limit:
+                return ranked
+    return ranked
+
+async def index_existing_texts() -> int:
+    """
+    Index every text that has tokens but is not in the text index yet. Returns how many were indexed.
+    """
+    indexed = 0
+    async for text_info in text_info_collection.find({}, projection={"language": 1, "tokens": 1}):
+        if not text_info.get("tokens"):
+            continue
+        if await text_token_index_collection.find_one({"_id": text_info["_id"]}, projection={"_id": 1}):
+            continue
+        await index_text(text_info["_id"], text_info["language"], text_info["tokens"])
+        indexed += 1
+    return indexed
+
+if __name__ == "__main__":
+    print(f"Indexed {asyncio.run(index_existing_texts())} texts")
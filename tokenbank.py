@@ -1,33 +1,219 @@
-from typing import Dict
-from db import tokenbank_collection
+from typing import Dict, Iterable, List, Optional, Tuple
+from pymongo import DeleteMany, UpdateOne
+from pymongo.errors import BulkWriteError
+from db import tokenbank_collection, tokenbank_tokens_collection
+import asyncio
+import logging
+import uuid
+
+logger = logging.getLogger("uvicorn")
+
+COMPLETED_TOKEN_DELTA = 1  # Value added to an exercise's tokens when it is completed
+SKIPPED_TOKEN_DELTA = -1  # Value added to an exercise's tokens when it is skipped
+KNOWN_TOKEN_VALUE = 1  # Tokens valued at least this much count as known
+TOKEN_DELTA_FLUSH_SECONDS = 2.0  # How long token deltas are coalesced before being written
+MAX_FLUSH_ATTEMPTS = 5  # Failed writes of a batch of token deltas before it is dropped
+
+# Each token in a user's tokenbank is its own document in tokenbank_tokens:
+#   {"user_id": ..., "language": ..., "token": ..., "value": ..., "last_flush": ...}
+# indexed by (user_id, language, value, token), so the lowest-valued tokens can be read
+# without loading the whole tokenbank. tokenbank_collection holds the legacy
+# one-document-per-user layout and is only read by migrate_legacy_tokenbanks, which runs at startup.
 
 async def get_user_tokenbank(user_id: str, language: str) -> Dict[str, int]:
     """
     Retrieve the tokenbank for a specific user and language
     """
-    result = await tokenbank_collection.find_one({"user_id": user_id, "language": language})
-    if result:
-        return result.get("tokens", {})
-    return {} 
+    cursor = tokenbank_tokens_collection.find(
+        {"user_id": user_id, "language": language},
+        projection={"_id": 0, "token": 1, "value": 1}
+    )
+    return {doc["token"]: doc["value"] async for doc in cursor}
 
-async def set_user_tokenbank(user_id: str, language: str, tokens: Dict[str, int]) -> bool:
+async def get_lowest_tokens(user_id: str, language: str, k: int = 1) -> List[str]:
     """
-    Set or update the tokenbank for a specific user and language
+    Get the k lowest-valued tokens for a specific user and language, lowest first.
+    Served from the (user_id, language, value, token) index.
     """
-    result = await tokenbank_collection.update_one(
+    cursor = tokenbank_tokens_collection.find(
         {"user_id": user_id, "language": language},
-        {"$set": {"tokens": tokens}},
-        upsert=True
+        projection={"_id": 0, "token": 1},
+        sort=[("value", 1), ("token", 1)],
+        limit=k
     )
-    return result.acknowledged 
+    return [doc["token"] async for doc in cursor]
+
+async def get_known_tokens(user_id: str, language: str) -> List[str]:
+    """
+    Get the tokens valued at least KNOWN_TOKEN_VALUE for a specific user and language
+    """
+    cursor = tokenbank_tokens_collection.find(
+        {"user_id": user_id, "language": language, "value": {"$gte": KNOWN_TOKEN_VALUE}},
+        projection={"_id": 0, "token": 1}
+    )
+    return [doc["token"] async for doc in cursor]
+
+async def set_user_tokenbank(user_id: str, language: str, tokens: Dict[str, int]) -> bool:
+    """
+    Set or update the tokenbank for a specific user and language
+    """
+    key = {"user_id": user_id, "language": language}
+    requests = [DeleteMany({**key, "token": {"$nin": list(tokens)}})]
+    requests += [
+        UpdateOne({**key, "token": token}, {"$set": {"value": value}}, upsert=True)
+        for token, value in tokens.items()
+    ]
+    result = await tokenbank_tokens_collection.bulk_write(requests, ordered=False)
+    return result.acknowledged
 
 async def update_token_value(user_id: str, language: str, token: str, value: int) -> bool:
     """
     Update or set the count for a specific token in user's tokenbank
     """
-    result = await tokenbank_collection.update_one(
-        {"user_id": user_id, "language": language},
-        {"$set": {f"tokens.{token}": value}},
+    result = await tokenbank_tokens_collection.update_one(
+        {"user_id": user_id, "language": language, "token": token},
+        {"$set": {"value": value}},
         upsert=True
     )
-    return result.acknowledged 
\ No newline at end of file
+    return result.acknowledged
+
+async def migrate_legacy_tokenbanks() -> int:
+    """
+    Copy tokenbanks stored as one {"tokens": {...}} document per user/language into per-token
+    documents, deleting each legacy document once it is copied. Tokens that already have a
+    document are left alone, so values learned since are kept. Safe to rerun, also while
+    attempts are being recorded. Returns the number of tokenbanks migrated.
+    """
+    migrated = 0
+    async for doc in tokenbank_collection.find({"tokens": {"$exists": True}}):
+        key = {"user_id": doc["user_id"], "language": doc["language"]}
+        requests = [
+            UpdateOne({**key, "token": token}, {"$setOnInsert": {"value": value}}, upsert=True)
+            for token, value in doc["tokens"].items()
+        ]
+        if requests:
+            try:
+                await tokenbank_tokens_collection.bulk_write(requests, ordered=False)
+            except BulkWriteError as e:
+                # A concurrent migration or flush inserted the same token first
+                if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                    raise
+        await tokenbank_collection.delete_one({"_id": doc["_id"]})
+        migrated += 1
+    return migrated
+
+# Pending token value deltas, coalesced per (user_id, language) until the next flush
+_pending_deltas: Dict[Tuple[str, str], Dict[str, int]] = {}
+_flush_task: "asyncio.Task | None" = None
+
+DeltaKey = Tuple[str, str, str, int]  # (user_id, language, token, delta)
+# A flush whose write failed: its flush id, the deltas that may not have been applied and how often it failed
+_failed_flush: Optional[Tuple[str, List[DeltaKey], int]] = None
+
+def token_deltas_for_attempt(was_completed: bool, tokens: Iterable[str]) -> Dict[str, int]:
+    """
+    Per-token value deltas for an attempt at an exercise practicing the given tokens
+    """
+    delta = COMPLETED_TOKEN_DELTA if was_completed else SKIPPED_TOKEN_DELTA
+    return {token: delta for token in tokens}
+
+def buffer_token_deltas(user_id: str, language: str, deltas: Dict[str, int]):
+    """
+    Queue token value deltas. They are summed with any pending deltas for the same
+    user/language and written by the next flush, at most TOKEN_DELTA_FLUSH_SECONDS later.
+    """
+    global _flush_task
+    if not deltas:
+        return
+    pending = _pending_deltas.setdefault((user_id, language), {})
+    for token, delta in deltas.items():
+        pending[token] = pending.get(token, 0) + delta
+    if _flush_task is None or _flush_task.done():
+        _flush_task = asyncio.create_task(_flush_after_window())
+
+async def _flush_after_window():
+    global _flush_task
+    await asyncio.sleep(TOKEN_DELTA_FLUSH_SECONDS)
+    try:
+        await flush_token_deltas()
+    except Exception as e:
+        # The deltas that were not written are pending again; retry them after another window
+        logger.error(f"Failed to flush tokenbank deltas: {e!r}")
+        _flush_task = asyncio.create_task(_flush_after_window())
+
+async def flush_token_deltas() -> int:
+    """
+    Write all pending token deltas with a single bulk_write of $inc upserts.
+    Each flush has an id that it stores as last_flush on the tokens it updates, and only updates
+    tokens that do not carry it yet, so a flush whose outcome is unknown (e.g. the connection dropped
+    after the server applied it) can be written again without counting twice. A failed flush is
+    retried before any newer deltas are written, and dropped after MAX_FLUSH_ATTEMPTS.
+    Returns the number of tokens updated.
+    """
+    global _pending_deltas, _failed_flush
+    updated = 0
+    if _failed_flush is not None:
+        flush_id, keys, failures = _failed_flush
+        _failed_flush = None
+        updated += await _write_deltas(flush_id, keys, failures)
+    pending, _pending_deltas = _pending_deltas, {}
+    keys = [
+        (user_id, language, token, delta)
+        for (user_id, language), deltas in pending.items()
+        for token, delta in deltas.items()
+        if delta
+    ]
+    updated += await _write_deltas(uuid.uuid4().hex, keys, 0)
+    return updated
+
+async def _write_deltas(flush_id: str, keys: List[DeltaKey], failures: int) -> int:
+    """
+    Write deltas under flush_id. If that fails, the deltas that may not have been applied are kept
+    in _failed_flush for the next flush, unless this was their last attempt, and the error is raised.
+    """
+    global _failed_flush
+    if not keys:
+        return 0
+    unapplied = keys  # Until the outcome is known
+    try:
+        duplicates, failed = await _inc_deltas(flush_id, keys)
+        if duplicates:
+            # The token was inserted by a concurrent upsert, or already has this flush applied.
+            # Writing again tells them apart: now only an applied delta fails the last_flush filter.
+            unapplied = failed + duplicates
+            failed += (await _inc_deltas(flush_id, duplicates))[1]
+        unapplied = failed
+        if failed:
+            raise RuntimeError(f"{len(failed)} of {len(keys)} token deltas could not be written")
+    except Exception:
+        if failures + 1 >= MAX_FLUSH_ATTEMPTS:
+            logger.error(f"Dropping {len(unapplied)} token deltas after {failures + 1} failed flushes")
+        else:
+            _failed_flush = (flush_id, unapplied, failures + 1)
+        raise
+    return len(keys)
+
+async def _inc_deltas(flush_id: str, keys: List[DeltaKey]) -> Tuple[List[DeltaKey], List[DeltaKey]]:
+    """One unordered bulk_write of $inc upserts. Returns the deltas that hit a duplicate key error, and those that failed otherwise."""
+    try:
+        await tokenbank_tokens_collection.bulk_write(
+            [
+                UpdateOne(
+                    {"user_id": user_id, "language": language, "token": token, "last_flush": {"$ne": flush_id}},
+                    {"$inc": {"value": delta}, "$set": {"last_flush": flush_id}},
+                    upsert=True
+                )
+                for user_id, language, token, delta in keys
+            ],
+            ordered=False
+        )
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        return (
+            [keys[error["index"]] for error in errors if error.get("code") == 11000],
+            [keys[error["index"]] for error in errors if error.get("code") != 11000]
+        )
+    return [], []
+
+if __name__ == "__main__":
+    print(f"Migrated {asyncio.run(migrate_legacy_tokenbanks())} tokenbanks")
@@ -0,0 +1,185 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Deque, FrozenSet, Iterable, Iterator, List, Optional, Tuple
+import asyncio
+import codecs
+import os
+import re
+from settings import get_settings
+
+# Languages written without spaces between words, segmented by dictionary longest-match
+CJK_LANGUAGES = {"cmn", "yue", "zho", "wuu", "hak", "nan", "gan", "hsn", "lzh", "jpn"}
+
+TOKENIZE_CHUNK_SIZE = 256 * 1024  # Characters per chunk handed to a worker process
+BOUNDARY_LOOKBACK = 1024  # How far back from a chunk's end to look for a safe place to cut it
+
+# Kana, CJK unified ideographs (incl. extension A and the supplementary planes) and compatibility ideographs
+_CJK_CHARS = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\U00020000-\U0002ffff"
+# Words in alphabetic scripts, keeping inner apostrophes and hyphens ("don't", "porte-monnaie")
+WORD_RE = re.compile(r"[^\W_]+(?:['’\-][^\W_]+)*")
+# For CJK languages: runs of CJK characters, or words in any other script mixed in
+CJK_RUN_RE = re.compile(rf"([{_CJK_CHARS}]+)|[^\W_{_CJK_CHARS}]+(?:['’\-][^\W_{_CJK_CHARS}]+)*")
+# Never ' or ’, which WORD_RE keeps inside words
+BOUNDARY_CHARS = frozenset(" \t\r\n\f\v.,;:!?\"()[]{}“”‘。，、！？；：「」『』（）《》…")
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+@lru_cache(maxsize=None)
+def load_dictionary(language: str) -> Tuple[FrozenSet[str], int]:
+    """
+    Load the word list for a language from the TOKENIZER_DICTIONARY_DIR setting.
+    Returns the words and the length of the longest one; empty if there is no word list.
+    """
+    path = os.path.join(get_settings().tokenizer_dictionary_dir, f"{language}.txt")
+    if not os.path.exists(path):
+        return frozenset(), 1
+    with open(path, encoding="utf-8") as f:
+        words = frozenset(line.strip() for line in f if line.strip())
+    return words, max(map(len, words), default=1)
+
+def segment_cjk_run(run: str, words: FrozenSet[str], max_word_length: int) -> Iterator[str]:
+    """
+    Forward maximum matching: repeatedly take the longest dictionary word at the current position,
+    falling back to a single character when nothing matches
+    """
+    if not words:
+        yield from run
+        return
+    i = 0
+    while i < len(run):
+        for length in range(min(max_word_length, len(run) - i), 0, -1):
+            candidate = run[i:i + length]
+            if length == 1 or candidate in words:
+                yield candidate
+                i += length
+                break
+
+def segment(text: str, language: str) -> Iterator[str]:
+    """
+    Yield the tokens of a text in order. Alphabetic scripts are split into words and case-folded;
+    CJK languages are segmented with their dictionary.
+    """
+    text = text.casefold()
+    if language in CJK_LANGUAGES:
+        words, max_word_length = load_dictionary(language)
+        for match in CJK_RUN_RE.finditer(text):
+            if match.group(1):
+                yield from segment_cjk_run(match.group(1), words, max_word_length)
+            else:
+                yield match.group(0)
+    else:
+        yield from WORD_RE.findall(text)
+
+class TextChunker:
+    """
+    Re-chunks a stream of text into pieces of about chunk_size characters that end on whitespace
+    or punctuation, so no token is split across two chunks
+    """
+
+    def __init__(self, chunk_size: int = TOKENIZE_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self._buffer = ""
+
+    def feed(self, text: str) -> List[str]:
+        buffer = self._buffer + text
+        chunks = []
+        start = 0
+        while len(buffer) - start >= self.chunk_size:
+            end = start + self.chunk_size
+            cut = end
+            for i in range(end - 1, max(end - BOUNDARY_LOOKBACK, start) - 1, -1):
+                if buffer[i] in BOUNDARY_CHARS:
+                    cut = i + 1
+                    break
+            chunks.append(buffer[start:cut])
+            start = cut
+        self._buffer = buffer[start:]
+        return chunks
+
+    def flush(self) -> str:
+        rest, self._buffer = self._buffer, ""
+        return rest
+
+def iter_chunks(texts: Iterable[str], chunk_size: int = TOKENIZE_CHUNK_SIZE) -> Iterator[str]:
+    """Re-chunk an iterable of text pieces on token boundaries"""
+    chunker = TextChunker(chunk_size)
+    for text in texts:
+        yield from chunker.feed(text)
+    rest = chunker.flush()
+    if rest:
+        yield rest
+
+def iter_tokens(texts: Iterable[str], language: str) -> Iterator[str]:
+    """Yield the tokens of a text given as an iterable of pieces, without holding it all in memory"""
+    for chunk in iter_chunks(texts):
+        yield from segment(chunk, language)
+
+def unique_tokens(chunk: str, language: str) -> List[str]:
+    """The unique tokens of a chunk in order of first appearance. Runs in worker processes."""
+    return list(dict.fromkeys(segment(chunk, language)))
+
+def tokenizer_processes() -> int:
+    """Size of the tokenizer process pool: the TOKENIZER_PROCESSES setting, or the CPU count"""
+    return get_settings().tokenizer_processes or os.cpu_count() or 1
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=tokenizer_processes())
+    return _process_pool
+
+def tokenize_corpus(texts: Iterable[str], language: str) -> Tuple[List[str], int]:
+    """
+    Tokenize a large text across the process pool, keeping only a few chunks in flight at a time.
+    Returns its unique tokens in order of first appearance and its length in characters.
+    """
+    pool = get_process_pool()
+    max_in_flight = 2 * tokenizer_processes()
+    in_flight = deque()
+    tokens = {}
+    length = 0
+    for chunk in iter_chunks(texts):
+        length += len(chunk)
+        in_flight.append(pool.submit(unique_tokens, chunk, language))
+        if len(in_flight) >= max_in_flight:
+            tokens.update(dict.fromkeys(in_flight.popleft().result()))
+    while in_flight:
+        tokens.update(dict.fromkeys(in_flight.popleft().result()))
+    return list(tokens), length
+
+class CorpusTokenizer:
+    """
+    Tokenizes UTF-8 bytes as they are fed in (e.g. while a text is being uploaded), handing each
+    full chunk to the process pool straight away. Like tokenize_corpus, only a few chunks are kept
+    in flight: feed waits for the oldest to finish once there are 2 x tokenizer_processes().
+    Must be used from a running event loop.
+    """
+
+    def __init__(self, language: str):
+        self.language = language
+        self.length = 0
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._chunker = TextChunker()
+        self._pending: Deque[asyncio.Future] = deque()
+        self._tokens = {}
+
+    async def feed(self, data: bytes):
+        for chunk in self._chunker.feed(self._decoder.decode(data)):
+            self.length += len(chunk)
+            loop = asyncio.get_running_loop()
+            self._pending.append(loop.run_in_executor(get_process_pool(), unique_tokens, chunk, self.language))
+            if len(self._pending) >= 2 * tokenizer_processes():
+                self._tokens.update(dict.fromkeys(await self._pending.popleft()))
+
+    async def result(self) -> Tuple[List[str], int]:
+        """Unique tokens in order of first appearance, and length in characters"""
+        # The tail can be up to a chunk long (a small text is all tail), so it goes to the pool too
+        loop = asyncio.get_running_loop()
+        for chunk in self._chunker.feed(self._decoder.decode(b"", final=True)) + [self._chunker.flush()]:
+            if chunk:
+                self.length += len(chunk)
+                self._pending.append(loop.run_in_executor(get_process_pool(), unique_tokens, chunk, self.language))
+        while self._pending:
+            self._tokens.update(dict.fromkeys(await self._pending.popleft()))
+        return list(self._tokens), self.length
@@ -0,0 +1,164 @@
+"""
+Job worker: claims jobs from the queue in jobs.py and runs them, so exercise generation can be
+scaled separately from the API. Run from the repo root:
+
+    MONGODB_URL=mongodb://localhost:27017 python worker.py --concurrency 8
+
+Each API process also runs API_JOB_CONCURRENCY job loops of its own (1 by default, so a single
+uvicorn process works on its own); set it to 0 when running dedicated workers.
+"""
+import argparse
+import asyncio
+import logging
+import signal
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List
+import database
+from jobs import (
+    JOB_LEASE_SECONDS, claim_job, complete_job, count_queued_jobs, extend_job_lease, fail_job,
+    release_job, requeue_expired_jobs
+)
+from metrics import JOB_DURATION, JOB_QUEUE_WAIT, JOBS_QUEUED, JOBS_RUNNING
+from settings import get_settings
+
+logger = logging.getLogger("uvicorn")
+
+POLL_INTERVAL_SECONDS = 0.2  # Wait before polling an empty queue again
+MAX_POLL_INTERVAL_SECONDS = 2.0  # Polling backs off to this while the queue stays empty
+MAINTENANCE_INTERVAL_SECONDS = JOB_LEASE_SECONDS / 2  # How often expired leases are requeued
+SHUTDOWN_GRACE_SECONDS = 10  # Running jobs get this long to finish on shutdown before they are released
+
+# Job type -> coroutine function called with the job's payload as keyword arguments
+JOB_HANDLERS: Dict[str, Callable[..., Awaitable]] = {
+    "replenish_cache": database.replenish_cache,
+}
+
+class Worker:
+    """Runs concurrency loops that each claim and run one job at a time, until stopped"""
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.stopping = asyncio.Event()
+
+    def stop(self):
+        self.stopping.set()
+
+    async def _sleep(self, seconds: float):
+        """Sleep, waking early if the worker is stopped"""
+        try:
+            await asyncio.wait_for(self.stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _heartbeat(self, job: dict):
+        """Keep extending the job's lease until cancelled. A failed extension is retried until the lease has run out."""
+        lease_expires_at = job["lease_expires_at"]
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            now = datetime.utcnow()
+            try:
+                extended = await extend_job_lease(job)
+            except Exception as e:
+                if now >= lease_expires_at:
+                    logger.warning(f"The lease on job {job['_id']} ({job['type']}) expired while it could not be extended: {e!r}")
+                    return
+                logger.error(f"Extending the lease on job {job['_id']} ({job['type']}) failed, will retry: {e!r}")
+                continue
+            if not extended:
+                logger.warning(f"Lost the lease on job {job['_id']} ({job['type']})")
+                return
+            lease_expires_at = now + timedelta(seconds=JOB_LEASE_SECONDS)
+
+    async def run_job(self, job: dict):
+        JOB_QUEUE_WAIT.labels(job["type"]).observe(max((job["claimed_at"] - job["run_at"]).total_seconds(), 0))
+        JOBS_RUNNING.labels(job["type"]).inc()
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            await JOB_HANDLERS[job["type"]](**job["payload"])
+            outcome = "success"
+        except asyncio.CancelledError:
+            outcome = "released"
+            await release_job(job)
+            raise
+        except Exception as e:
+            retry = await fail_job(job, repr(e))
+            logger.error(
+                f"Job {job['_id']} ({job['type']}) failed on attempt {job['attempts']}"
+                f"{', will retry' if retry else ', giving up'}: {e!r}"
+            )
+        finally:
+            heartbeat.cancel()
+            JOBS_RUNNING.labels(job["type"]).dec()
+            JOB_DURATION.labels(job["type"], outcome).observe(time.perf_counter() - started)
+        if outcome == "success":
+            await complete_job(job)
+
+    async def work(self):
+        poll_interval = POLL_INTERVAL_SECONDS
+        while not self.stopping.is_set():
+            try:
+                job = await claim_job(database.WORKER_ID, list(JOB_HANDLERS))
+            except Exception as e:
+                logger.error(f"Claiming a job failed: {e!r}")
+                job = None
+            if job is None:
+                await self._sleep(poll_interval)
+                poll_interval = min(poll_interval * 2, MAX_POLL_INTERVAL_SECONDS)
+                continue
+            poll_interval = POLL_INTERVAL_SECONDS
+            try:
+                await self.run_job(job)
+            except Exception as e:
+                # Recording the outcome failed; the job is requeued once its lease expires
+                logger.error(f"Finishing job {job['_id']} ({job['type']}) failed: {e!r}")
+
+    async def maintain(self):
+        """Requeue jobs whose worker died, and report the queue depth"""
+        while not self.stopping.is_set():
+            try:
+                requeued = await requeue_expired_jobs()
+                if requeued:
+                    logger.warning(f"Requeued {requeued} jobs whose lease expired")
+                queued = await count_queued_jobs()
+                for job_type in JOB_HANDLERS:
+                    JOBS_QUEUED.labels(job_type).set(queued.get(job_type, 0))
+            except Exception as e:
+                logger.error(f"Job queue maintenance failed: {e!r}")
+            await self._sleep(MAINTENANCE_INTERVAL_SECONDS)
+
+    async def run(self):
+        loops: List[asyncio.Task] = [asyncio.create_task(self.work()) for _ in range(self.concurrency)]
+        loops.append(asyncio.create_task(self.maintain()))
+        try:
+            await self.stopping.wait()
+            await asyncio.wait(loops, timeout=SHUTDOWN_GRACE_SECONDS)
+        finally:
+            # Jobs still running are released back to the queue
+            for loop in loops:
+                loop.cancel()
+            await asyncio.gather(*loops, return_exceptions=True)
+
+async def main(concurrency: int):
+    await database.connect_to_mongo()
+    worker = Worker(concurrency)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stop)
+    logger.info(f"Job worker {database.WORKER_ID} started with concurrency {concurrency}")
+    try:
+        await worker.run()
+    finally:
+        await database.close_mongo_connection()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--concurrency", type=int, default=get_settings().job_worker_concurrency,
+        help="jobs run at once (default: JOB_WORKER_CONCURRENCY or 4)"
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.concurrency))